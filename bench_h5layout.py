@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+""" Benchmark of the two HDF5 layouts written by ModelData.save: open time,
+reading a single series and saving the whole file. """
+
+import os
+import time
+import tempfile
+import shutil
+from optparse import OptionParser
+
+import numpy as np
+
+from modeldata import ModelData, HDF5Data, LAYOUT_GROUPS, LAYOUT_MATRIX
+
+
+class ArrayData(ModelData):
+    """ ModelData from synthetic in-memory arrays. """
+    def __init__(self, n_t, n_species, n_reactions, n_conditions):
+        self.species = ['S%d' % i for i in xrange(n_species)]
+        self.reactions = ['R%d' % i for i in xrange(n_reactions)]
+        self.conditions = ['C%d' % i for i in xrange(n_conditions)]
+
+        self.t = np.logspace(-12, -3, n_t)
+        self.raw_density = np.exp(np.random.uniform(0, 40,
+                                                    (n_t, n_species)))
+        self.raw_rates = np.exp(np.random.uniform(-20, 40,
+                                                  (n_t, n_reactions)))
+        self.raw_conditions = np.random.uniform(0, 1000, (n_t, n_conditions))
+        self.source_matrix = np.random.randint(-1, 2, (n_species,
+                                                       n_reactions))
+
+        super(ArrayData, self).__init__()
+
+
+    def bulk(self, name):
+        return {'density': self.raw_density,
+                'rate': self.raw_rates,
+                'condition': self.raw_conditions}[name]
+
+
+    def density(self, key):
+        return self.raw_density[:, key - 1]
+
+
+    def rate(self, key):
+        return self.raw_rates[:, key - 1]
+
+
+    def condition(self, key):
+        return self.raw_conditions[:, key - 1]
+
+
+def timed(f):
+    t0 = time.time()
+    r = f()
+    return time.time() - t0, r
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--steps", dest="steps", type="int", default=20000,
+                      help="Number of timesteps [%default]")
+    parser.add_option("--species", dest="species", type="int", default=100,
+                      help="Number of species [%default]")
+    parser.add_option("--reactions", dest="reactions", type="int",
+                      default=2000, help="Number of reactions [%default]")
+    parser.add_option("--compression", dest="compression", type="str",
+                      default="gzip", help="Compression profile [%default]")
+    (opts, args) = parser.parse_args()
+
+    data = ArrayData(opts.steps, opts.species, opts.reactions, 10)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name, layout in (('groups', LAYOUT_GROUPS),
+                             ('matrix', LAYOUT_MATRIX)):
+            fname = os.path.join(tmpdir, '%s.h5' % name)
+
+            t_save, _ = timed(lambda: data.save(fname, layout=layout,
+                                                 compression=opts.compression))
+            t_open, h5data = timed(lambda: HDF5Data(fname))
+            key = opts.reactions // 2
+            t_read, r = timed(lambda: h5data.rate(key))
+            assert np.array_equal(r, data.rate(key))
+            h5data.h5.close()
+
+            print ("%-7s save %8.2f s  open %8.3f s  read one series "
+                   "%8.4f s  size %8.1f MB"
+                   % (name, t_save, t_open, t_read,
+                      os.path.getsize(fname) / 1e6))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
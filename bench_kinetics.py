@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+""" Benchmark of the time that runner.run spends per step reading the state
+of the kinetic module, before and after the bulk interface of Kinetics
+(Kinetics.snapshot and the vectorized truncate_densities).
+
+No compiled module is needed: a fake one with the same interface as those
+built by f2py from zdplaskin stands in for it.  Its subroutines only copy
+data and build the same outputs, so the timings measure the overhead of
+the wrapper, not the chemistry. """
+
+import sys
+import time
+import types
+from optparse import OptionParser
+
+import numpy as np
+
+from zdplaskin import Kinetics
+import protocol
+
+NAME_LENGTH = 32
+
+
+def _names(prefix, n):
+    a = np.empty((NAME_LENGTH, n), dtype='S1')
+    a[:] = ' '
+    for i in xrange(n):
+        name = '%s%d' % (prefix, i)
+        a[:len(name), i] = list(name)
+    return a
+
+
+def fake_module(n_species, n_reactions):
+    """ Returns a module that looks like a kinetic module compiled with
+    f2py. """
+    z = types.ModuleType('zdplaskin')
+    z.species_max = n_species
+    z.reactions_max = n_reactions
+    z.species_name = _names('S', n_species)
+    z.reaction_sign = _names('R', n_reactions)
+    z.density = np.random.uniform(size=n_species)
+    z.rrt = np.zeros(n_reactions)
+    z.lreaction_block = np.zeros(n_reactions, dtype=bool)
+    names = [''.join(z.species_name[:, i]).strip() for i in xrange(n_species)]
+
+    def index(s):
+        # zdplaskin_get_species_index compares the string with every name.
+        for i, name in enumerate(names):
+            if name == s:
+                return i
+        raise ValueError(s)
+
+    def get_density(s):
+        return z.density[index(s)], False
+
+    def set_density(s, dens, const=False):
+        z.density[index(s)] = dens
+
+    def fex(t, y):
+        z.rrt[:] = y[np.arange(n_reactions) % n_species]
+        return np.zeros(n_species)
+
+    def get_rates():
+        # f2py returns every optional output, including both matrices.
+        fex(0.0, z.density)
+        return (np.zeros(n_species), z.rrt.copy(),
+                np.zeros((n_species, n_reactions)), z.density.copy(),
+                np.zeros(n_species), z.rrt.copy(),
+                np.zeros((n_species, n_reactions)))
+
+    def get_conditions():
+        return tuple(np.random.uniform(size=10)) + (np.zeros((2, 128)),)
+
+    def noop(*args, **kwargs):
+        pass
+
+    z.zdplaskin_get_density = get_density
+    z.zdplaskin_set_density = set_density
+    z.zdplaskin_fex = fex
+    z.zdplaskin_get_rates = get_rates
+    z.zdplaskin_get_conditions = get_conditions
+    for f in ('init', 'set_conditions', 'get_density_total', 'timestep',
+              'reset', 'set_config', 'write_file', 'reac_source_matrix'):
+        setattr(z, 'zdplaskin_' + f, noop)
+
+    mod = types.ModuleType('fake_kinetics')
+    mod.zdplaskin = z
+    return mod
+
+
+def step_before(model, record, layout, conditions):
+    """ A step as runner.run did it with the per-species interface.  Then
+    truncate_densities looped over species(), which decoded the names from
+    the fortran array on every call. """
+    mod = model.mod
+    species = [''.join(mod.species_name[:, i]).strip()
+               for i in xrange(mod.species_max)]
+    for s in species:
+        if model.get_density(s) < 1e-10:
+            model.set_density_(s, 0.0, False)
+
+    density = [model.get_density(s) for s in model.SPECIES]
+    rates = model.get_reaction_rates()
+    current_conditions = model.get_conditions()
+    layout.pack(record, 0, 0.0, density, rates,
+                [current_conditions[k] for k in conditions])
+
+
+def step_after(model, record, layout, conditions):
+    model.truncate_densities()
+    record[0], record[1] = 0, 0.0
+    model.snapshot(0.0, conditions,
+                   out=(record[layout.density], record[layout.rates],
+                        record[layout.conditions]))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--steps", dest="steps", type="int", default=2000,
+                      help="Number of timesteps [%default]")
+    parser.add_option("--species", dest="species", type="int", default=100,
+                      help="Number of species [%default]")
+    parser.add_option("--reactions", dest="reactions", type="int",
+                      default=1000, help="Number of reactions [%default]")
+    (opts, args) = parser.parse_args()
+
+    sys.modules['fake_kinetics'] = fake_module(opts.species, opts.reactions)
+    model = Kinetics('fake_kinetics')
+    conditions = protocol.TRACKED_CONDITIONS
+    layout = protocol.RecordLayout(model.N_SPECIES, model.N_REACTIONS,
+                                   len(conditions))
+    record = layout.empty()
+
+    results = {}
+    for name, step in (('before', step_before), ('after', step_after)):
+        t0 = time.time()
+        for i in xrange(opts.steps):
+            step(model, record, layout, conditions)
+        results[name] = (time.time() - t0) / opts.steps
+        print "%-7s %10.1f us/step" % (name, 1e6 * results[name])
+
+    print "speedup %10.1f" % (results['before'] / results['after'])
+
+
+if __name__ == '__main__':
+    main()
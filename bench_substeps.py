@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+""" Benchmark of the adaptive substepping of Kinetics.controlled_timestep
+against the split of every step into equal substeps.
+
+The mechanisms are integrated by a fake kinetic module (see
+bench_kinetics.fake_module) whose zdplaskin_timestep takes one linearly
+implicit Euler step, so that, as with the real solver, the error of a
+substep grows with its size.  Two mechanisms are available:
+
+  2reac      The argon mechanism of samples/test_2reac.f90: ionization by
+             electron impact and three-body recombination.
+  synthetic  A random mechanism with --species species and --reactions
+             reactions of up to three reactants and as many products.
+
+The field profile is quiet with a few sharp pulses.  Each method is timed
+and its densities at the output times are compared with those of a
+reference run: an adaptive one with changes per substep 20 times
+smaller. """
+
+import sys
+import time
+from optparse import OptionParser
+
+import numpy as np
+
+from zdplaskin import Kinetics
+from bench_kinetics import fake_module
+
+# Reactants of each reaction are padded with this many slots.
+MAX_REACTANTS = 3
+
+
+class Mechanism(object):
+    """ A mass-action mechanism.  reactants is a (reactions x MAX_REACTANTS)
+    array of species indices, padded with n_species, an extra species with
+    density 1.  net is the (species x reactions) net stoichiometry.  The
+    rate coefficients of reactions with activation energy ea (in Td) are
+    multiplied by exp(-ea / E/N) and those of blocked reactions are 0. """
+
+    def __init__(self, species, reactants, net, k0, ea):
+        self.species = species
+        self.reactants = np.asarray(reactants)
+        self.net = np.asarray(net, dtype='d')
+        self.k0 = np.asarray(k0, dtype='d')
+        self.ea = np.asarray(ea, dtype='d')
+        self.blocked = np.zeros(len(self.k0), dtype=bool)
+
+
+    def coefficients(self, EN):
+        return np.where(self.blocked, 0.0, self.k0 * np.exp(-self.ea / EN))
+
+
+    def rates(self, density, EN):
+        n = np.append(density, 1.0)
+        return self.coefficients(EN) * n[self.reactants].prod(axis=1)
+
+
+    def jacobian(self, density, EN):
+        """ Returns the rates and the jacobian of the source terms. """
+        n = np.append(density, 1.0)
+        k = self.coefficients(EN)
+        factors = n[self.reactants]
+        m = len(k)
+
+        d = np.zeros((m, len(n)))
+        for s in xrange(MAX_REACTANTS):
+            others = np.delete(factors, s, axis=1).prod(axis=1)
+            np.add.at(d, (np.arange(m), self.reactants[:, s]), k * others)
+
+        return k * factors.prod(axis=1), self.net.dot(d[:, :-1])
+
+
+def two_reactions():
+    # e + Ar -> e + e + Ar^+ and e + e + Ar^+ -> e + Ar
+    e, ar, ion, one = 0, 1, 2, 3
+    net = [[1, -1],
+           [-1, 1],
+           [1, -1]]
+    return Mechanism(['e', 'Ar', 'Ar^+'],
+                     [[e, ar, one], [e, e, ion]], net,
+                     k0=[1.2e-8, 1e-25], ea=[450.0, 0.0]), \
+        [1.0, 2.5e19, 1.0]
+
+
+def synthetic(n_species, n_reactions, seed=0):
+    rnd = np.random.RandomState(seed)
+    reactants = np.full((n_reactions, MAX_REACTANTS), n_species)
+    net = np.zeros((n_species, n_reactions))
+    k0 = np.empty(n_reactions)
+    for j in xrange(n_reactions):
+        order = rnd.randint(1, MAX_REACTANTS + 1)
+        reactants[j, :order] = rnd.randint(n_species, size=order)
+        for i in reactants[j, :order]:
+            net[i, j] -= 1
+        # As many products as reactants, so that nothing runs out.
+        for i in rnd.randint(n_species, size=order):
+            net[i, j] += 1
+        # Rates of 1e6-1e9 s^-1 per particle at densities ~1e15 cm^-3
+        k0[j] = 10 ** rnd.uniform(6, 9) * 1e-15 ** (order - 1)
+
+    ea = np.where(rnd.uniform(size=n_reactions) < 0.3,
+                  rnd.uniform(50, 500, size=n_reactions), 0.0)
+    species = ['S%d' % i for i in xrange(n_species)]
+    return (Mechanism(species, reactants, net, k0, ea),
+            rnd.uniform(1e14, 1e15, size=n_species))
+
+
+def kinetic_module(mech):
+    """ Returns a fake kinetic module that integrates mech. """
+    mod = fake_module(len(mech.species), len(mech.k0))
+    z = mod.zdplaskin
+    z.lreaction_block = mech.blocked
+    field = [1.0]
+
+    def timestep(t, dt):
+        n = z.density
+        rates, jac = mech.jacobian(n, field[0])
+        a = np.eye(len(n)) - dt * jac
+        n[:] = np.maximum(n + np.linalg.solve(a, dt * mech.net.dot(rates)),
+                          0.0)
+
+    def fex(t, y):
+        z.rrt[:] = mech.rates(y, field[0])
+        return mech.net.dot(z.rrt)
+
+    def set_conditions(reduced_field=None, **kwargs):
+        if reduced_field is not None:
+            field[0] = reduced_field
+
+    def get_conditions():
+        return (300.0, 0.0, field[0]) + (0.0,) * 7 + (np.zeros((2, 128)),)
+
+    z.zdplaskin_timestep = timestep
+    z.zdplaskin_fex = fex
+    z.zdplaskin_set_conditions = set_conditions
+    z.zdplaskin_get_conditions = get_conditions
+    return mod
+
+
+def field_profile(t_end, n_out, base=50.0, peak=500.0, n_pulses=3):
+    t = np.linspace(0, t_end, n_out + 1)
+    EN = np.full_like(t, base)
+    for tc in t_end * (np.arange(n_pulses) + 0.5) / n_pulses:
+        EN += (peak - base) * np.exp(-((t - tc) / (0.01 * t_end)) ** 2)
+    return t, EN
+
+
+def simulate(mech, density, t, EN, max_dt, **substepping):
+    """ Runs mech through the field profile as runner.run does.  Returns the
+    densities at the output times, the elapsed time and the total accepted
+    and rejected substeps. """
+    sys.modules['bench_substeps_kinetics'] = kinetic_module(mech)
+    model = Kinetics('bench_substeps_kinetics')
+    model.set_substepping(**substepping)
+    model.mod.density[:] = density
+
+    out = np.empty((len(t), len(density)))
+    accepted = rejected = 0
+    t0 = time.time()
+    for i, (it, idt, iEN) in enumerate(zip(t[:-1], np.diff(t), EN)):
+        model.set_conditions(reduced_field=iEN)
+        model.truncate_densities()
+        out[i] = model.mod.density
+        a, r = model.controlled_timestep(it, idt, max_dt)
+        accepted += a
+        rejected += r
+    out[-1] = model.mod.density
+    return out, time.time() - t0, accepted, rejected
+
+
+def error(out, ref, floor):
+    return np.amax(np.abs(out - ref) / np.maximum(ref, floor))
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--mechanism", dest="mechanism", type="choice",
+                      choices=['2reac', 'synthetic'], default='2reac',
+                      help="2reac or synthetic [%default]")
+    parser.add_option("--species", dest="species", type="int", default=50,
+                      help="Species of the synthetic mechanism [%default]")
+    parser.add_option("--reactions", dest="reactions", type="int",
+                      default=300,
+                      help="Reactions of the synthetic mechanism [%default]")
+    parser.add_option("--t-end", dest="t_end", type="float", default=3e-7,
+                      help="Simulated time [%default]")
+    parser.add_option("--outputs", dest="outputs", type="int", default=100,
+                      help="Number of output steps [%default]")
+    parser.add_option("--max-dt", dest="max_dt", type="float", default=1e-11,
+                      help="Substep of the fixed split [%default]")
+    parser.add_option("--max-change", dest="max_change", type="float",
+                      default=Kinetics.MAX_CHANGE,
+                      help="Relative change per adaptive substep [%default]")
+    (opts, args) = parser.parse_args()
+
+    if opts.mechanism == '2reac':
+        mech, density = two_reactions()
+    else:
+        mech, density = synthetic(opts.species, opts.reactions)
+
+    t, EN = field_profile(opts.t_end, opts.outputs)
+    floor = Kinetics.DENSITY_FLOOR
+
+    ref, _, _, _ = simulate(mech, density, t, EN, np.inf, adaptive=True,
+                            max_change=opts.max_change / 20)
+
+    print "%-9s %10s %10s %10s %10s %10s" % ('', 'seconds', 'steps/s',
+                                             'accepted', 'rejected',
+                                             'max error')
+    for name, max_dt, kwargs in (
+            ('fixed', opts.max_dt, dict(adaptive=False)),
+            ('adaptive', np.inf, dict(adaptive=True,
+                                      max_change=opts.max_change))):
+        out, elapsed, accepted, rejected = simulate(mech, density, t, EN,
+                                                    max_dt, **kwargs)
+        print "%-9s %10.3f %10.0f %10d %10d %10.2e" % (
+            name, elapsed, opts.outputs / elapsed, accepted, rejected,
+            error(out, ref, floor))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+""" Benchmark of textio.read_table against np.loadtxt on synthetic tables
+with the layout of the ZdPlasKin qt_*.txt files. """
+
+import os
+import time
+import tempfile
+import shutil
+from optparse import OptionParser
+
+import numpy as np
+
+from textio import read_table
+
+
+def write_table(fname, nrows, ncols, block=10000):
+    """ Writes a synthetic table with a header line and a time column,
+    formatted as ZdPlasKin does. """
+    with open(fname, 'w') as fp:
+        fp.write(' '.join(['time'] + ['%d' % (i + 1) for i in xrange(ncols)])
+                 + '\n')
+        for start in xrange(0, nrows, block):
+            n = min(block, nrows - start)
+            t = np.arange(start, start + n) * 1e-9
+            values = np.exp(np.random.uniform(-50, 40, size=(n, ncols)))
+            np.savetxt(fp, np.c_[t, values], fmt='%.4E')
+
+
+def best_of(f, repeat):
+    r = []
+    for i in xrange(repeat):
+        t0 = time.time()
+        f()
+        r.append(time.time() - t0)
+    return min(r)
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--rows", dest="rows", type="int", default=100000,
+                      help="Number of rows (timesteps) [%default]")
+    parser.add_option("--cols", dest="cols", type="str", default="100,1000",
+                      help="Comma-separated numbers of columns [%default]")
+    parser.add_option("--repeat", dest="repeat", type="int", default=3,
+                      help="Repetitions; the best time is reported [%default]")
+    (opts, args) = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for ncols in [int(c) for c in opts.cols.split(',')]:
+            fname = os.path.join(tmpdir, 'qt_rates.txt')
+            write_table(fname, opts.rows, ncols)
+            size = os.path.getsize(fname) / 1e6
+
+            a = read_table(fname, skiprows=1)
+            b = np.loadtxt(fname, skiprows=1)
+            assert np.array_equal(a, b)
+
+            t_fast = best_of(lambda: read_table(fname, skiprows=1),
+                             opts.repeat)
+            t_loadtxt = best_of(lambda: np.loadtxt(fname, skiprows=1),
+                                opts.repeat)
+
+            print ("%7d x %5d (%7.1f MB): loadtxt %8.2f s  "
+                   "read_table %8.2f s  speedup %5.1fx"
+                   % (opts.rows, ncols + 1, size, t_loadtxt, t_fast,
+                      t_loadtxt / t_fast))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
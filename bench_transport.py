@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+""" Benchmark of the transports of timesteps from a simulation process to
+its receiver (see transport.py), in steps per second.  'pickle' is the
+former protocol, where every step was a pickled list.  By default each
+step is sent on its own; use --batch-steps to batch them. """
+
+import time
+from multiprocessing import Process, Pipe
+from optparse import OptionParser
+
+import numpy as np
+
+import protocol
+from transport import open_sender, open_receiver, TRANSPORTS, BATCH_MS
+
+
+def sender(conn, transport, steps, n_species, n_reactions, batch_steps,
+           batch_ms):
+    header = protocol.make_header(np.arange(steps),
+                                  ['S%d' % i for i in xrange(n_species)],
+                                  ['R%d' % i for i in xrange(n_reactions)],
+                                  np.zeros((n_species, n_reactions)))
+    layout = protocol.RecordLayout.from_header(header)
+    density = np.random.uniform(size=n_species)
+    rates = np.random.uniform(size=n_reactions)
+    conditions = np.random.uniform(size=len(header['conditions']))
+
+    if transport == 'pickle':
+        conn.send(header)
+        cond = dict(zip(header['conditions'], conditions))
+        for i in xrange(steps):
+            conn.send([i, list(density), rates, cond])
+        conn.send(None)
+        return
+
+    s = open_sender(transport, conn, layout, batch_steps=batch_steps,
+                    batch_ms=batch_ms)
+    header.update(s.header)
+    conn.send(header)
+    record = layout.empty()
+    for i in xrange(steps):
+        layout.pack(record, i, i, density, rates, conditions)
+        s.send(record)
+    s.end()
+
+
+def receive(conn, transport):
+    header = protocol.receive_header(conn)
+    n = 0
+    if transport == 'pickle':
+        while conn.recv() is not None:
+            n += 1
+        return n
+
+    for block in open_receiver(conn, header):
+        n += len(block)
+    return n
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--steps", dest="steps", type="int", default=20000,
+                      help="Number of timesteps [%default]")
+    parser.add_option("--species", dest="species", type="int", default=100,
+                      help="Number of species [%default]")
+    parser.add_option("--reactions", dest="reactions", type="int",
+                      default=1000, help="Number of reactions [%default]")
+    parser.add_option("--batch-steps", dest="batch_steps", type="int",
+                      default=1, help="Steps per message [%default]")
+    parser.add_option("--batch-ms", dest="batch_ms", type="float",
+                      default=BATCH_MS,
+                      help="Longest wait to fill a batch [%default]")
+    (opts, args) = parser.parse_args()
+
+    for transport in ('pickle',) + TRANSPORTS:
+        conn_recv, conn_send = Pipe(False)
+        p = Process(target=sender, args=(conn_send, transport, opts.steps,
+                                         opts.species, opts.reactions,
+                                         opts.batch_steps, opts.batch_ms))
+        t0 = time.time()
+        p.start()
+        n = receive(conn_recv, transport)
+        elapsed = time.time() - t0
+        p.join()
+        assert n == opts.steps
+
+        print "%-7s %10.0f steps/s" % (transport, n / elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+""" Checkpoints of a running simulation.
+
+runner.run can save the state of the kinetic module (Kinetics.state) every
+some steps or seconds into a directory of checkpoints, one .npz file each,
+named after the index of the step where the run would continue.  The
+files are written by a thread, so the timesteps go on while they are
+saved: if the previous checkpoint is still being written when a new one is
+due, the new one is skipped.  Each file is written under a temporary name
+and renamed, so a crash never leaves a broken checkpoint.
+
+A checkpoint only makes sense with the output up to its step, which the
+run has streamed into an HDF5 file (see h5stream.py).  The output may lag
+behind the checkpoints by up to h5stream.FLUSH_SECONDS, so we keep a few
+of them, and all the recent ones, and restart from the newest one that
+the output has reached (see newest).
+"""
+
+import os
+import sys
+import glob
+import time
+import threading
+from Queue import Queue, Full
+
+import numpy as np
+
+# Default interval between checkpoints.
+CHECKPOINT_SECONDS = 600
+
+# Checkpoints are removed when there are KEEP newer ones and they are
+# older than KEEP_SECONDS.
+KEEP = 3
+KEEP_SECONDS = 60
+
+# Longest wait for the pending checkpoint when the writer is closed.
+CLOSE_SECONDS = 60
+
+PREFIX = 'checkpoint-'
+SUFFIX = '.npz'
+
+
+def _fname(dirname, step):
+    return os.path.join(dirname, '%s%.10d%s' % (PREFIX, step, SUFFIX))
+
+
+def list_checkpoints(dirname):
+    """ Returns a list of (step, file name) of the checkpoints in dirname,
+    sorted by step. """
+    r = []
+    for fname in glob.glob(os.path.join(dirname, PREFIX + '*' + SUFFIX)):
+        step = os.path.basename(fname)[len(PREFIX):-len(SUFFIX)]
+        if step.isdigit():
+            r.append((int(step), fname))
+    r.sort()
+    return r
+
+
+def load(fname):
+    """ Reads a checkpoint into a dictionary of arrays. """
+    with np.load(fname) as f:
+        return dict(f)
+
+
+def newest(dirname, max_step=None):
+    """ Returns the newest checkpoint in dirname whose step is not above
+    max_step, or None. """
+    for step, fname in reversed(list_checkpoints(dirname)):
+        if max_step is None or step <= max_step:
+            return load(fname)
+    return None
+
+
+def discard(dirname, after=0):
+    """ Removes the checkpoints of steps after the given one. """
+    for step, fname in list_checkpoints(dirname):
+        if step > after:
+            os.remove(fname)
+
+
+class CheckpointWriter(object):
+    """ Saves checkpoints into dirname in a background thread, every
+    every_steps steps or every_seconds seconds, whichever comes first
+    (None disables either). """
+
+    def __init__(self, dirname, every_steps=None,
+                 every_seconds=CHECKPOINT_SECONDS, keep=KEEP):
+        self.dirname = dirname
+        self.every_steps = every_steps
+        self.every_seconds = every_seconds
+        self.keep = keep
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+        self.last_step = None
+        self.last_time = time.time()
+        self.skipped = 0
+        self.failed = 0
+
+        self.queue = Queue(maxsize=1)
+        self.thread = threading.Thread(target=self._write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+
+    def due(self, step):
+        """ Says whether a checkpoint is due at step. """
+        if self.last_step is None:
+            self.last_step = step
+
+        return ((self.every_steps is not None
+                 and step - self.last_step >= self.every_steps)
+                or (self.every_seconds is not None
+                    and time.time() - self.last_time >= self.every_seconds))
+
+
+    def save(self, step, state):
+        """ Queues state, a dictionary of arrays that must not change
+        afterwards, to be saved as the checkpoint of step.  Returns False if
+        it was skipped. """
+        self.last_step = step
+        self.last_time = time.time()
+        try:
+            self.queue.put_nowait((step, state))
+        except Full:
+            self.skipped += 1
+            return False
+        return True
+
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            step, state = item
+            try:
+                self._write(step, state)
+            except Exception as e:
+                # A full disk should not stop the run: we try again with
+                # the next checkpoint.
+                self.failed += 1
+                sys.stderr.write("Checkpoint of step %d failed: %s\n"
+                                 % (step, e))
+
+
+    def _write(self, step, state):
+        fname = _fname(self.dirname, step)
+        tmp = fname + '.tmp'
+        try:
+            with open(tmp, 'wb') as fp:
+                np.savez(fp, **state)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.rename(tmp, fname)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        limit = time.time() - KEEP_SECONDS
+        for _, old in list_checkpoints(self.dirname)[:-self.keep]:
+            if os.path.getmtime(old) < limit:
+                os.remove(old)
+
+
+    def close(self):
+        """ Waits up to CLOSE_SECONDS for the pending checkpoint to be
+        written. """
+        if not self.thread.is_alive():
+            return
+
+        try:
+            self.queue.put(None, timeout=CLOSE_SECONDS)
+        except Full:
+            sys.stderr.write("The checkpoint writer does not respond\n")
+            return
+        self.thread.join(CLOSE_SECONDS)
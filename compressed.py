@@ -0,0 +1,315 @@
+""" Reading of compressed tables.
+
+Result directories are often archived with their qt_*.txt files compressed.
+open_file returns a file-like object that reads the decompressed bytes of
+a .gz, .bz2 or .xz file (or of a plain file) so that the tables can be
+parsed straight from the archive.
+
+Files made of many gzip members (e.g. by bgzip, pigz --independent or by
+concatenating .gz files) are decompressed member by member in a thread
+pool: zlib releases the GIL while it inflates.
+"""
+
+import os
+import zlib
+import bz2
+import struct
+import signal
+import threading
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# Suffixes of the compressed files that we can read, in the order in which
+# they are looked for.
+SUFFIXES = ('.gz', '.bz2', '.xz')
+
+# Bytes of compressed data that are split into gzip members and inflated
+# in parallel at a time.
+GZIP_WINDOW = 8 * 1024 * 1024
+
+# Threads that inflate gzip members.  The pool is shared by all readers.
+GZIP_THREADS = 4
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def find_file(fname):
+    """ Returns fname if it exists or else the name of its compressed
+    version.  If there is none, returns fname, so opening it gives the
+    usual error. """
+    if os.path.exists(fname):
+        return fname
+
+    for suffix in SUFFIXES:
+        if os.path.exists(fname + suffix):
+            return fname + suffix
+
+    return fname
+
+
+def is_compressed(fname):
+    return fname.endswith(SUFFIXES)
+
+
+def open_file(fname):
+    """ Opens a file for reading its decompressed bytes. """
+    if fname.endswith('.gz'):
+        return GzipReader(fname)
+
+    if fname.endswith('.bz2'):
+        return StreamReader(fname, bz2.BZ2Decompressor)
+
+    if fname.endswith('.xz'):
+        if lzma is not None:
+            return StreamReader(fname, lzma.LZMADecompressor)
+        return _xz_command(fname)
+
+    return open(fname, 'rb')
+
+
+def _xz_command(fname):
+    # Without the lzma module (backports.lzma in Python 2) we use xz itself.
+    if not os.path.exists(fname):
+        raise IOError("No such file: %s" % fname)
+    try:
+        return XzCommandReader(fname)
+    except OSError:
+        raise IOError("Reading %s requires the lzma module or the xz "
+                      "command" % fname)
+
+
+def _get_pool():
+    # Readers in several threads may ask for the pool at once.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(GZIP_THREADS)
+    return _pool
+
+
+class XzCommandReader(object):
+    """ Reads the output of xz -dc fname.  A failure of xz (e.g. a corrupt
+    or truncated file) raises IOError when the end of its output is read
+    or when the reader is closed. """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.proc = subprocess.Popen(['xz', '-dc', fname],
+                                     stdout=subprocess.PIPE)
+
+
+    def read(self, n=-1):
+        data = self.proc.stdout.read(n)
+        if not data or n < 0:
+            self._check(self.proc.wait())
+        return data
+
+
+    def _check(self, returncode):
+        if returncode != 0:
+            raise IOError("xz failed (status %d) reading %s"
+                          % (returncode, self.fname))
+
+
+    def close(self):
+        self.proc.stdout.close()
+        returncode = self.proc.wait()
+        # Closing before the end kills xz with SIGPIPE, which is fine.
+        if returncode != -signal.SIGPIPE:
+            self._check(returncode)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class _Reader(object):
+    """ A minimal read-only file built on a generator of decompressed
+    blocks. """
+
+    def __init__(self, fname):
+        self.fp = open(fname, 'rb')
+        self.blocks = self._blocks()
+        self.pending = b''
+
+
+    def read(self, n=-1):
+        parts = [self.pending]
+        size = len(self.pending)
+        while n < 0 or size < n:
+            try:
+                block = next(self.blocks)
+            except StopIteration:
+                break
+            parts.append(block)
+            size += len(block)
+
+        data = b''.join(parts)
+        if n < 0:
+            n = len(data)
+        self.pending = data[n:]
+        return data[:n]
+
+
+    def close(self):
+        self.fp.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StreamReader(_Reader):
+    """ Decompresses a file made of one or more concatenated streams, each
+    one with a new decompressor. """
+
+    CHUNK = 1024 * 1024
+
+    def __init__(self, fname, decompressor):
+        self.decompressor = decompressor
+        super(StreamReader, self).__init__(fname)
+
+
+    def _blocks(self):
+        d = self.decompressor()
+        while True:
+            data = self.fp.read(self.CHUNK)
+            if not data:
+                return
+
+            while data:
+                try:
+                    out = d.decompress(data)
+                except EOFError:
+                    # The previous stream ended right at the end of a chunk.
+                    d = self.decompressor()
+                    continue
+
+                yield out
+                data = d.unused_data
+                if data:
+                    d = self.decompressor()
+
+
+def _member_starts(buf):
+    # Offsets that look like the start of a gzip member: the magic bytes,
+    # deflate and no reserved flags.  Some are just compressed data.
+    r = []
+    i = buf.find(b'\x1f\x8b\x08')
+    while i >= 0:
+        if not ord(buf[i + 3:i + 4] or b'\0') & 0xe0:
+            r.append(i)
+        i = buf.find(b'\x1f\x8b\x08', i + 1)
+    return r
+
+
+def _inflate(buf, start):
+    """ Inflates the gzip member at buf[start:].  Returns the data, the end
+    of the member and its decompressor.  If the member does not end inside
+    buf the end is None and the decompressor can be fed what follows.
+    Returns None if start is not the beginning of a member. """
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = d.decompress(buffer(buf, start))
+    except zlib.error:
+        return None
+
+    if d.unused_data:
+        return data, len(buf) - len(d.unused_data), d
+
+    # All of buf was consumed: the member ends here only if buf ends with
+    # its CRC and length.
+    if len(buf) - start >= 18 and buf[-8:] == struct.pack(
+            '<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff):
+        return data, len(buf), d
+
+    return data, None, d
+
+
+class GzipReader(_Reader):
+    """ Decompresses a gzip file.  The compressed data is read in windows
+    of GZIP_WINDOW bytes and the members that start in a window are
+    inflated in parallel.  A member that goes on after its window (such as
+    the single member of most .gz files) is then inflated as a stream. """
+
+    def __init__(self, fname, window=GZIP_WINDOW):
+        self.window = window
+        super(GzipReader, self).__init__(fname)
+
+
+    def _blocks(self):
+        pool = _get_pool()
+
+        buf = b''
+        eof = False
+        while buf or not eof:
+            if not eof:
+                new = self.fp.read(self.window)
+                eof = not new
+                buf += new
+
+            if not buf:
+                return
+
+            starts = _member_starts(buf)
+            if not starts or starts[0] != 0:
+                raise IOError("Not a gzip file: %s" % self.fp.name)
+
+            # We inflate from every candidate start but use only those
+            # that are reached by chaining members from the first one.
+            results = dict(zip(starts, pool.map(lambda s: _inflate(buf, s),
+                                                 starts)))
+            pos, d = 0, None
+            while pos < len(buf) and pos in results:
+                if results[pos] is None:
+                    raise IOError("Corrupt gzip file: %s" % self.fp.name)
+
+                data, end, d = results[pos]
+                yield data
+                if end is None:
+                    break
+                pos, d = end, None
+
+            if d is not None:
+                # The last member goes on after the window.
+                for data in self._stream(d):
+                    yield data
+                buf, eof = self.rest, self.rest_eof
+            elif eof and pos < len(buf):
+                raise IOError("Corrupt gzip file: %s" % self.fp.name)
+            else:
+                # A member header split by the end of the window.
+                buf = buf[pos:]
+
+
+    def _stream(self, d):
+        # Feeds the rest of a member to its decompressor.  What follows the
+        # member is left in self.rest.
+        self.rest, self.rest_eof = b'', False
+        while True:
+            buf = self.fp.read(self.window)
+            if not buf:
+                self.rest_eof = True
+                return
+
+            yield d.decompress(buf)
+            if d.unused_data:
+                self.rest = d.unused_data
+                return
@@ -0,0 +1,175 @@
+""" Binary sidecar cache of the tables of a result directory.
+
+After a directory has been imported, the parsed tables are stored as .npy
+files in a .qtplaskin_cache/ subdirectory, together with a manifest that
+records which part of each text file they come from.  Later imports
+memory-map those arrays and parse only what has been appended to the text
+files since then.
+"""
+
+import os
+import json
+import zlib
+from warnings import warn
+
+import numpy as np
+
+from storage import NpyAppender
+
+CACHE_DIR = '.qtplaskin_cache'
+MANIFEST = 'manifest.json'
+
+# Increase this when the layout of the cache changes.
+CACHE_VERSION = 1
+
+# To check that the text file has only been appended to, we compare a
+# checksum of the last bytes that were parsed.
+TAIL_BYTES = 4096
+
+
+def _tail_crc(fname, offset):
+    start = max(0, offset - TAIL_BYTES)
+    with open(fname, 'rb') as fp:
+        fp.seek(start)
+        tail = fp.read(offset - start)
+
+    if len(tail) != offset - start:
+        return None
+
+    return zlib.crc32(tail) & 0xffffffff
+
+
+class DirectoryCache(object):
+    """ The cache of parsed tables of a result directory. """
+
+    def __init__(self, dirname):
+        self.path = os.path.join(dirname, CACHE_DIR)
+        self.manifest = self._read_manifest()
+
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as fp:
+                manifest = json.load(fp)
+        except (IOError, ValueError):
+            return {}
+
+        if manifest.get('version') != CACHE_VERSION:
+            return {}
+
+        return manifest.get('files', {})
+
+
+    def _npy(self, fname):
+        return os.path.join(self.path,
+                            os.path.splitext(os.path.basename(fname))[0]
+                            + '.npy')
+
+
+    def spill(self, fname):
+        """ Returns the name of the .npy file where the rows of the table
+        fname are cached.  An out-of-core TailReader can write its rows
+        there directly. """
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+
+        return self._npy(fname)
+
+
+    def restore(self, reader):
+        """ Restores the state of a TailReader from the cache, if the cache
+        is still valid for its file.  Returns True on success. """
+        key = os.path.basename(reader.fname)
+        entry = self.manifest.get(key)
+        if entry is None:
+            return False
+
+        try:
+            if reader.compressed:
+                # Offsets are in the decompressed data, so we can only check
+                # that the file is the same.
+                st = os.stat(reader.fname)
+                if (st.st_size, st.st_mtime) != (entry['size'],
+                                                 entry['mtime']):
+                    return False
+
+            elif (os.path.getsize(reader.fname) < entry['offset']
+                  or _tail_crc(reader.fname, entry['offset'])
+                     != entry['tail_crc']):
+                return False
+
+            if entry['rows'] > 0:
+                array = np.load(self._npy(reader.fname), mmap_mode='r')
+                if array.shape != (entry['rows'], entry['ncols']):
+                    return False
+            else:
+                array = np.zeros((0, 0))
+
+        except (IOError, OSError, ValueError):
+            return False
+
+        reader.restore(array, entry['offset'], entry['skipped'])
+        return True
+
+
+    def store(self, readers):
+        """ Writes to the cache what the readers have parsed that is not
+        there yet.  Failures (e.g. a read-only directory) are only warned
+        about. """
+        try:
+            if not os.path.isdir(self.path):
+                os.mkdir(self.path)
+
+            for reader in readers:
+                self._store(reader)
+
+            with open(os.path.join(self.path, MANIFEST), 'w') as fp:
+                json.dump({'version': CACHE_VERSION,
+                           'files': self.manifest}, fp, indent=1)
+
+        except (IOError, OSError) as e:
+            warn("Could not write cache in %s: %s" % (self.path, e))
+
+
+    def _store(self, reader):
+        key = os.path.basename(reader.fname)
+        entry = self.manifest.get(key)
+        data = reader.data
+        st = os.stat(reader.fname)
+        if reader.compressed and entry is not None and (
+                (entry['size'], entry['mtime']) != (st.st_size, st.st_mtime)):
+            # A compressed file is re-read whole when it changes.
+            entry = None
+
+        if entry is not None and entry['offset'] == reader.offset:
+            return
+
+        # If the text file has grown we can append to the cached array.
+        append = (entry is not None and entry['offset'] < reader.offset
+                  and entry['rows'] > 0 and entry['ncols'] == data.shape[1]
+                  and entry['rows'] <= data.shape[0])
+        start = entry['rows'] if append else 0
+
+        if reader.spill == self._npy(reader.fname):
+            # Out-of-core reader: the rows are already in our file.
+            if reader.table is not None:
+                reader.table.flush()
+
+        elif data.shape[0] > 0:
+            npy = NpyAppender(self._npy(reader.fname), data.shape[1],
+                              append=append)
+            # The first rows may be memory-mapped from the file that we are
+            # writing to, so we never rewrite them.
+            npy.nrows = start
+            npy.append(data[start:])
+            npy.close()
+
+        self.manifest[key] = {'size': st.st_size,
+                              'mtime': st.st_mtime,
+                              'offset': reader.offset,
+                              'skipped': reader.skipped,
+                              'tail_crc': (None if reader.compressed
+                                           else _tail_crc(reader.fname,
+                                                          reader.offset)),
+                              'rows': data.shape[0],
+                              'ncols': data.shape[1]}
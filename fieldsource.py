@@ -0,0 +1,273 @@
+""" Sources of the electric field profile of a run.
+
+runner.run used to load the whole profile, a table of t and E/N, before the
+first timestep.  A FieldSource instead reads it in chunks of rows, so the
+memory used does not depend on the length of the profile, and runner.run
+iterates over its steps().  The field is raised to min_EN chunk by chunk.
+
+  TextSource      a whitespace-separated text table, as read by np.loadtxt
+                  (compressed files too, see compressed.py).
+  NpySource       a (points x 2) .npy file, read through a memory map.  It
+                  may be written with storage.NpyAppender.
+  FunctionSource  an analytic profile EN = func(t) at evenly spaced times.
+  IterSource      any iterable of (t, EN) points or of (t, EN) chunks of
+                  arrays, e.g. a generator.
+
+With follow, a TextSource or NpySource keeps waiting for the file to grow,
+so a run can start while another program is still writing its profile.
+The profile ends when the file has not grown for follow seconds.
+"""
+
+import time
+import itertools
+
+import numpy as np
+
+from textio import parse_block, CHUNK_SIZE
+from compressed import open_file, is_compressed
+
+# Fields below this (in Td) are raised to it.
+MIN_EN = 1.0
+
+# Points per chunk of the sources that do not read bytes.
+CHUNK_POINTS = 64 * 1024
+
+# Seconds between looks at a file that is followed.
+POLL_SECONDS = 0.5
+
+
+class FieldSource(object):
+    """ Base class of the sources: subclasses implement _chunks, which
+    yields the profile as (t, EN) pairs of arrays. """
+
+    def __init__(self, min_EN=MIN_EN):
+        self.min_EN = min_EN
+
+
+    def _chunks(self):
+        raise NotImplementedError
+
+
+    def chunks(self):
+        """ Yields the profile as (t, EN) chunks, with EN raised to
+        min_EN. """
+        for t, EN in self._chunks():
+            t = np.asarray(t, dtype='d')
+            EN = np.asarray(EN, dtype='d')
+            if len(t) == 0:
+                continue
+            yield t, np.where(EN > self.min_EN, EN, self.min_EN)
+
+
+    def steps(self, start=0):
+        """ Yields (i, t, dt, EN) for each timestep of the profile from the
+        start-th on.  There is one step less than points: the last point
+        only gives the end of the last step. """
+        i = 0
+        last = None
+        for t, EN in self.chunks():
+            if last is not None:
+                # The last point of the previous chunk starts a step that
+                # ends in this one.
+                t = np.concatenate(([last[0]], t))
+                EN = np.concatenate(([last[1]], EN))
+
+            n = len(t) - 1
+            if i + n > start:
+                dt = t[1:] - t[:-1]
+                for j in xrange(max(start - i, 0), n):
+                    yield i + j, t[j], dt[j], EN[j]
+
+            i += n
+            last = t[-1], EN[-1]
+
+
+    def times(self):
+        """ Returns all the times of the profile in one array. """
+        return np.concatenate([t for t, _ in self.chunks()] or [[]])
+
+
+class TextSource(FieldSource):
+    """ A profile in a text file with t and E/N columns, read chunk_size
+    bytes at a time. """
+
+    def __init__(self, fname, min_EN=MIN_EN, chunk_size=CHUNK_SIZE,
+                 follow=None):
+        super(TextSource, self).__init__(min_EN)
+        self.fname = fname
+        self.chunk_size = chunk_size
+        self.follow = follow
+
+
+    def _chunks(self):
+        if self.follow is not None and not is_compressed(self.fname):
+            fp = _wait_open(self.fname, self.follow)
+        else:
+            fp = open_file(self.fname)
+
+        try:
+            rest = b''
+            for new in self._read(fp):
+                chunk = rest + new
+                end = chunk.rfind(b'\n')
+                rest = chunk[end + 1:]
+                if end >= 0:
+                    block = self._parse(chunk[:end + 1])
+                    if block is not None:
+                        yield block
+
+            # The last line may lack its newline.
+            block = self._parse(rest + b'\n')
+            if block is not None:
+                yield block
+        finally:
+            fp.close()
+
+
+    def _read(self, fp):
+        idle = 0.0
+        while True:
+            new = fp.read(self.chunk_size)
+            if new:
+                idle = 0.0
+                yield new
+                continue
+
+            if self.follow is None or idle >= self.follow:
+                return
+
+            time.sleep(POLL_SECONDS)
+            idle += POLL_SECONDS
+
+
+    def _parse(self, chunk):
+        if not chunk.strip():
+            return None
+
+        block = parse_block(chunk, 2)
+        if block.size == 0:
+            # Only comments.
+            return None
+        return block[:, 0], block[:, 1]
+
+
+class NpySource(FieldSource):
+    """ A profile in a (points x 2) .npy file of t and E/N. """
+
+    def __init__(self, fname, min_EN=MIN_EN, chunk_points=CHUNK_POINTS,
+                 follow=None):
+        super(NpySource, self).__init__(min_EN)
+        self.fname = fname
+        self.chunk_points = chunk_points
+        self.follow = follow
+
+
+    def _map(self):
+        a = np.load(self.fname, mmap_mode='r')
+        if a.ndim != 2 or a.shape[1] != 2:
+            raise ValueError("%s is not a table of t and E/N" % self.fname)
+        return a
+
+
+    def _chunks(self):
+        if self.follow is not None:
+            _wait_open(self.fname, self.follow).close()
+
+        start = 0
+        idle = 0.0
+        while True:
+            # A file that grows has its header rewritten, so we map it again
+            # to see the new rows.
+            a = self._map()
+            while start < a.shape[0]:
+                end = min(start + self.chunk_points, a.shape[0])
+                block = np.array(a[start:end])
+                yield block[:, 0], block[:, 1]
+                start = end
+                idle = 0.0
+            del a
+
+            if self.follow is None or idle >= self.follow:
+                return
+
+            time.sleep(POLL_SECONDS)
+            idle += POLL_SECONDS
+
+
+class FunctionSource(FieldSource):
+    """ An analytic profile: E/N = func(t), with func taking an array of
+    times, at npoints evenly spaced times from start to end. """
+
+    def __init__(self, func, start, end, npoints, min_EN=MIN_EN,
+                 chunk_points=CHUNK_POINTS):
+        super(FunctionSource, self).__init__(min_EN)
+        self.func = func
+        self.start = start
+        self.end = end
+        self.npoints = npoints
+        self.chunk_points = chunk_points
+
+
+    def _chunks(self):
+        step = (self.end - self.start) / float(max(self.npoints - 1, 1))
+        for i in xrange(0, self.npoints, self.chunk_points):
+            k = np.arange(i, min(i + self.chunk_points, self.npoints))
+            t = self.start + k * step
+            yield t, np.broadcast_to(self.func(t), t.shape)
+
+
+class IterSource(FieldSource):
+    """ A profile given by an iterable (e.g. a generator) of (t, EN) points,
+    which are gathered into chunks, or of (t, EN) chunks of arrays.  It
+    can be iterated only once if the iterable can. """
+
+    def __init__(self, iterable, min_EN=MIN_EN, chunk_points=CHUNK_POINTS):
+        super(IterSource, self).__init__(min_EN)
+        self.iterable = iterable
+        self.chunk_points = chunk_points
+
+
+    def _chunks(self):
+        it = iter(self.iterable)
+        for first in it:
+            if np.ndim(first[0]) > 0:
+                yield first
+                for chunk in it:
+                    yield chunk
+                return
+
+            it = itertools.chain([first], it)
+            while True:
+                points = list(itertools.islice(it, self.chunk_points))
+                if not points:
+                    return
+                a = np.array(points, dtype='d')
+                yield a[:, 0], a[:, 1]
+
+
+def open_source(field, **kwargs):
+    """ Returns a FieldSource for field, which may already be one, the name
+    of a .npy or text file or an iterable (see IterSource).  kwargs go to
+    the constructor. """
+    if isinstance(field, FieldSource):
+        return field
+
+    if isinstance(field, basestring):
+        if field.endswith('.npy'):
+            return NpySource(field, **kwargs)
+        return TextSource(field, **kwargs)
+
+    return IterSource(field, **kwargs)
+
+
+def _wait_open(fname, timeout):
+    """ Opens fname, waiting up to timeout seconds for it to exist. """
+    waited = 0.0
+    while True:
+        try:
+            return open(fname, 'rb')
+        except IOError:
+            if waited >= timeout:
+                raise
+        time.sleep(POLL_SECONDS)
+        waited += POLL_SECONDS
@@ -0,0 +1,219 @@
+""" Streaming output of a running simulation to an HDF5 file.
+
+The file uses the matrix layout of ModelData.save but its datasets are
+extendable and rows are appended as the simulation advances.  The file is
+kept in single-writer/multiple-reader (SWMR) mode, so it can be opened with
+HDF5Data(fname, swmr=True) while it is being written and whatever has been
+flushed survives a crash of the writer.
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import h5py
+
+from modeldata import LAYOUT_MATRIX, DEF_COMPRESSION, compression_options
+
+# Rows per chunk of the streamed datasets.  This is smaller than the
+# CHUNK_ROWS of save because a whole row of chunks is buffered in memory
+# before it is written.
+STREAM_CHUNK_ROWS = 1024
+
+# Buffered rows are also written if this many seconds have passed since the
+# last write, so readers see recent data.
+FLUSH_SECONDS = 5.0
+
+
+def _check_names(g, species, reactions, conditions):
+    for names_name, names in (('conditions', conditions),
+                              ('species', species),
+                              ('reactions', reactions)):
+        if list(g[names_name]) != list(names):
+            raise ValueError("%s was written with other %s"
+                             % (g.file.filename, names_name))
+
+
+class StreamWriter(object):
+    """ Appends timesteps to an HDF5 file opened in SWMR mode.  With append,
+    an existing file written by a StreamWriter is continued after its first
+    nrows timesteps (or all of them, if nrows is None). """
+
+    def __init__(self, fname, species, reactions, conditions, source_matrix,
+                 compression=DEF_COMPRESSION, metadata={},
+                 chunk_rows=STREAM_CHUNK_ROWS, flush_seconds=FLUSH_SECONDS,
+                 append=False, nrows=None):
+        self.fname = fname
+        self.chunk_rows = chunk_rows
+        self.flush_seconds = flush_seconds
+
+        if append and os.path.exists(fname):
+            try:
+                self._reopen(species, reactions, conditions, nrows)
+            except IOError:
+                # HDF5 refuses to write again a file whose SWMR writer
+                # crashed, so we copy it.
+                self._recover(species, reactions, conditions, source_matrix,
+                              compression, metadata, nrows)
+        else:
+            self._create(species, reactions, conditions, source_matrix,
+                         compression, metadata)
+
+        self.f.swmr_mode = True
+
+        self.buffers = [np.empty((chunk_rows, ds.shape[1]))
+                        for ds in self.datasets]
+        self.t_buffer = np.empty((chunk_rows,))
+        self.n_buffered = 0
+        self.last_flush = time.time()
+
+
+    def _create(self, species, reactions, conditions, source_matrix,
+                compression, metadata):
+        chunk_rows = self.chunk_rows
+        self.f = h5py.File(self.fname, 'w', libver='latest')
+        g = self.f.create_group('main')
+
+        for k, val in metadata.iteritems():
+            g.attrs[k] = val
+
+        g.attrs['command'] = ' '.join(sys.argv)
+        g.attrs['timestamp'] = time.ctime()
+        g.attrs['layout'] = LAYOUT_MATRIX
+
+        str_dtype = h5py.special_dtype(vlen=str)
+        opts = compression_options(compression)
+
+        self.datasets = []
+        for name, names_name, names in (('condition', 'conditions',
+                                         conditions),
+                                        ('density', 'species', species),
+                                        ('rate', 'reactions', reactions)):
+            g.create_dataset(names_name,
+                             data=np.array(names, dtype=object),
+                             dtype=str_dtype)
+            n = len(names)
+            if n == 0:
+                # Nothing will ever be written here.
+                self.datasets.append(g.create_dataset(name, shape=(0, 0),
+                                                      dtype='d'))
+                continue
+
+            self.datasets.append(
+                g.create_dataset(name, shape=(0, n), maxshape=(None, n),
+                                 dtype='d', chunks=(chunk_rows, 1), **opts))
+
+        # t is written last so readers can trust that all the other
+        # datasets have at least len(t) rows.
+        self.t = g.create_dataset('t', shape=(0,), maxshape=(None,),
+                                  dtype='d', chunks=(chunk_rows,))
+        g.create_dataset('source_matrix', data=source_matrix, **opts)
+        self.n_written = 0
+
+
+    def _reopen(self, species, reactions, conditions, nrows):
+        self.f = h5py.File(self.fname, 'r+', libver='latest')
+        g = self.f['main']
+        try:
+            _check_names(g, species, reactions, conditions)
+        except ValueError:
+            self.f.close()
+            raise
+
+        self.datasets = [g['condition'], g['density'], g['rate']]
+        self.t = g['t']
+        self.n_written = len(self.t)
+        if nrows is not None and nrows < self.n_written:
+            # Drop the timesteps written after the ones that we continue.
+            self.n_written = nrows
+            for ds in self.datasets:
+                if ds.shape[1] > 0:
+                    ds.resize((nrows, ds.shape[1]))
+            self.t.resize((nrows,))
+
+
+    def _recover(self, species, reactions, conditions, source_matrix,
+                 compression, metadata, nrows):
+        old = self.fname + '.recover'
+        os.rename(self.fname, old)
+        with h5py.File(old, 'r', libver='latest', swmr=True) as f:
+            g = f['main']
+            _check_names(g, species, reactions, conditions)
+            n = len(g['t'])
+            if nrows is not None:
+                n = min(n, nrows)
+
+            self._create(species, reactions, conditions, source_matrix,
+                         compression, metadata)
+            sources = [g['condition'], g['density'], g['rate']]
+            for start in xrange(0, n, self.chunk_rows):
+                end = min(n, start + self.chunk_rows)
+                for ds, src in zip(self.datasets, sources):
+                    if ds.shape[1] > 0:
+                        ds.resize((end, ds.shape[1]))
+                        ds[start:end] = src[start:end]
+                self.t.resize((end,))
+                self.t[start:end] = g['t'][start:end]
+
+        self.n_written = n
+        os.remove(old)
+
+
+    def append(self, t, density, rates, conditions):
+        """ Appends one timestep.  conditions is a sequence in the order
+        given to the constructor. """
+        j = self.n_buffered
+        self.t_buffer[j] = t
+        for buf, row in zip(self.buffers, (conditions, density, rates)):
+            buf[j, :] = row
+
+        self.n_buffered += 1
+        if (self.n_buffered == self.chunk_rows
+            or time.time() - self.last_flush > self.flush_seconds):
+            self.flush()
+
+
+    def append_block(self, t, density, rates, conditions):
+        """ Appends several timesteps.  t has one item and the other arrays
+        one row per timestep. """
+        start = 0
+        while start < len(t):
+            j = self.n_buffered
+            m = min(len(t) - start, self.chunk_rows - j)
+            self.t_buffer[j:j + m] = t[start:start + m]
+            for buf, rows in zip(self.buffers, (conditions, density, rates)):
+                buf[j:j + m, :] = rows[start:start + m]
+
+            self.n_buffered += m
+            start += m
+            if (self.n_buffered == self.chunk_rows
+                or time.time() - self.last_flush > self.flush_seconds):
+                self.flush()
+
+
+    def flush(self):
+        """ Writes the buffered rows and makes them visible to readers. """
+        n = self.n_buffered
+        start, end = self.n_written, self.n_written + n
+
+        for ds, buf in zip(self.datasets, self.buffers):
+            if ds.shape[1] == 0:
+                continue
+
+            ds.resize((end, ds.shape[1]))
+            ds[start:end] = buf[:n]
+            ds.flush()
+
+        self.t.resize((end,))
+        self.t[start:end] = self.t_buffer[:n]
+        self.t.flush()
+
+        self.n_written = end
+        self.n_buffered = 0
+        self.last_flush = time.time()
+
+
+    def close(self):
+        self.flush()
+        self.f.close()
@@ -1,12 +1,98 @@
 import sys
 import os
 import time
+import atexit
+import shutil
+import tempfile
+from warnings import warn
 from multiprocessing import Process, Pipe
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import h5py
 
 from runner import run
+import protocol
+from transport import open_receiver
+from textio import TailReader, CHUNK_SIZE
+from dircache import DirectoryCache
+from compressed import find_file, open_file
+from storage import GrowingArray, ColumnStore
+from seriescache import SeriesCache, DEF_MAX_BYTES
+from sources import SourceEngine
+from pyramid import MinMaxPyramid, pixel_edges
+
+# Layouts of the HDF5 files written by ModelData.save:
+#   LAYOUT_GROUPS: one dataset per item in the main/density, main/rate and
+#     main/condition groups.
+#   LAYOUT_MATRIX: main/density, main/rate and main/condition are 2D
+#     (time x item) datasets; the names are in main/species, main/reactions
+#     and main/conditions.
+LAYOUT_GROUPS = 1
+LAYOUT_MATRIX = 2
+
+# Number of rows in a chunk of the matrix layout.  Chunks are one column
+# wide so that reading a single series touches only its own chunks.
+CHUNK_ROWS = 16384
+
+# Compression profiles accepted by ModelData.save.  Besides these, 'gzip-N'
+# and 'shuffle+gzip-N' select gzip level N.
+COMPRESSION_PROFILES = {
+    'none': {},
+    'lzf': dict(compression='lzf'),
+    'gzip': dict(compression='gzip', compression_opts=4),
+    'shuffle+gzip': dict(shuffle=True, compression='gzip',
+                         compression_opts=4)}
+
+DEF_COMPRESSION = 'gzip'
+
+# DirectoryData switches to out-of-core storage when the tables take more
+# than this many bytes of text.
+OUT_OF_CORE_BYTES = 2 * 1024 * 1024 * 1024
+
+
+def compression_options(profile):
+    """ Returns the h5py dataset options of a compression profile. """
+    try:
+        return dict(COMPRESSION_PROFILES[profile])
+    except KeyError:
+        pass
+
+    base, _, level = profile.rpartition('-')
+    if base in ('gzip', 'shuffle+gzip') and level.isdigit():
+        opts = dict(COMPRESSION_PROFILES[base])
+        opts['compression_opts'] = int(level)
+        return opts
+
+    raise ValueError("Unknown compression profile '%s'" % profile)
+
+
+def column_chunking(n_t, n_items, compression=DEF_COMPRESSION):
+    """ Returns the chunking and compression options of a (n_t x n_items)
+    dataset in the matrix layout. """
+    if n_t == 0 or n_items == 0:
+        return {}
+
+    opts = compression_options(compression)
+    opts['chunks'] = (min(n_t, CHUNK_ROWS), 1)
+    return opts
+
+
+def _owned_nbytes(arrays):
+    """ Adds the sizes of the memory blocks that hold the given arrays,
+    counting only once blocks shared by several views and skipping
+    memory maps. """
+    owners = {}
+    for a in arrays:
+        if not isinstance(a, np.ndarray):
+            continue
+        while isinstance(a.base, np.ndarray):
+            a = a.base
+        if a.base is None:
+            owners[id(a)] = a.nbytes
+
+    return sum(owners.itervalues())
+
 
 class ModelData(object):
     """ This class abstracts the reading of model data and its output
@@ -24,11 +110,178 @@ class ModelData(object):
     
     def update(self):
         pass
-    
-    def save(self, ofile, metadata={}):
+
+
+    def close(self):
+        """ Releases files and threads.  The object cannot be used after
+        this. """
+        pool = self.__dict__.get('_pool')
+        if pool is not None:
+            pool.close()
+            self._pool = None
+
+
+    def memory_bytes(self):
+        """ Returns an estimate of the memory held by the data, in bytes.
+        Memory-mapped arrays do not count. """
+        arrays = [getattr(self, 't', None),
+                  getattr(self, 'source_matrix', None)]
+        arrays.extend(self.bulk(name)
+                      for name in ('density', 'rate', 'condition'))
+        for p in self.__dict__.get('_pyramids', {}).itervalues():
+            arrays.extend(a for level in p.levels for a in level)
+
+        return _owned_nbytes(arrays)
+
+
+    @property
+    def source_engine(self):
+        """ The SourceEngine of the current source matrix.  It is rebuilt
+        only when the source matrix is replaced. """
+        engine = getattr(self, '_source_engine', None)
+        if engine is None or self._engine_matrix is not self.source_matrix:
+            self._source_engine = SourceEngine(self.source_matrix)
+            self._engine_matrix = self.source_matrix
+
+        return self._source_engine
+
+
+    def time_slice(self, window=None):
+        """ Converts a time window into a slice of time indices.  window can
+        be None (all times), a slice of indices or a (tmin, tmax) pair, that
+        is located in t by binary search.  All the accessors accept such a
+        window and return only the data inside it. """
+        n = len(self.t)
+        if window is None:
+            return slice(0, n, 1)
+
+        if isinstance(window, slice):
+            return slice(*window.indices(n))
+
+        tmin, tmax = window
+        return slice(np.searchsorted(self.t, tmin, side='left'),
+                     np.searchsorted(self.t, tmax, side='right'), 1)
+
+
+    def t_window(self, window=None):
+        """ Returns the times inside window. """
+        return self.t[self.time_slice(window)]
+
+
+    def _species_index(self, key):
+        # Converts a species key into a 0-based index.
+        return key - 1
+
+
+    def rate_block(self, indices, window=None):
+        """ Returns a (len(indices) x n_t) array with the rates of the
+        reactions with the given (0-based) indices inside window. """
+        sl = self.time_slice(window)
+        r = np.empty((len(indices), len(xrange(sl.start, sl.stop, sl.step))))
+        for j, ri in enumerate(indices):
+            r[j, :] = self.rate(ri + 1, window=sl)
+        return r
+
+
+    def sources(self, key, window=None):
+        """ Returns the indices of the reactions that change the density of
+        species key and a (n_reactions x n_t) array with the contribution
+        of each of them inside window. """
+        indices, c = self.source_engine.row(self._species_index(key))
+        return indices, self.rate_block(indices, window) * c[:, np.newaxis]
+
+
+    def production_loss(self, keys, window=None):
+        """ Returns the production and loss rates of the given species as two
+        (len(keys) x n_t) arrays.  Only the rates of the reactions that
+        affect these species are read. """
+        species = [self._species_index(k) for k in keys]
+        engine = self.source_engine
+        reactions = engine.reactions_of(species)
+        return engine.production_loss(self.rate_block(reactions, window),
+                                      species=species, reactions=reactions)
+
+
+    def net_sources(self, keys, window=None):
+        """ Returns the net source (production - loss) of the given species
+        as a (len(keys) x n_t) array. """
+        p, l = self.production_loss(keys, window)
+        return p - l
+
+
+    def source_totals(self, window=None):
+        """ Returns the production, loss and net source of all species, each
+        a (n_species x n_t) array, in a single pass over all rates. """
+        rates = self.bulk('rate')
+        if rates is not None:
+            rates = rates[self.time_slice(window)].T
+        else:
+            rates = self.rate_block(np.arange(len(self.reactions)), window)
+
+        return self.source_engine.totals(rates)
+
+    def series(self, kind, key, window=None):
+        """ Returns a series of the given kind ('density', 'rate' or
+        'condition'). """
+        accessor = {'density': self.density,
+                    'rate': self.rate,
+                    'condition': self.condition}[kind]
+        return accessor(key, window=window)
+
+
+    def pyramid(self, kind, key):
+        """ Returns the MinMaxPyramid of a series.  It is built on first
+        access and rebuilt only if the length of t changes. """
+        pyramids = self.__dict__.setdefault('_pyramids', {})
+        p = pyramids.get((kind, key))
+        if p is None or p.n != len(self.t):
+            p = self._build_pyramid(kind, key)
+            pyramids[(kind, key)] = p
+
+        return p
+
+
+    def _build_pyramid(self, kind, key):
+        return MinMaxPyramid(self.series(kind, key))
+
+
+    def decimated(self, kind, key, npixels, window=None, log=False):
+        """ Returns (t, y) to plot a series inside window on npixels pixels
+        (equally spaced in log t if log is True).  If there are more than
+        2 * npixels samples, only the minimum and maximum in each pixel are
+        returned. """
+        sl = self.time_slice(window)
+        if sl.stop - sl.start <= 2 * npixels:
+            return self.t[sl], self.series(kind, key, window=sl)
+
+        edges = pixel_edges(self.t, sl, npixels, log=log)
+        return self.pyramid(kind, key).decimate(self.t, edges)
+
+
+    def bulk(self, name):
+        """ Returns the full (time x item) array of 'density', 'rate' or
+        'condition' if the backend has it in memory, or None.  This lets
+        save write large blocks at once instead of going series by series.
+        """
+        return None
+
+
+    def save(self, ofile, metadata={}, layout=None,
+             compression=DEF_COMPRESSION, progress=None):
+        """ Saves the data into the HDF5 file ofile.  layout is one of
+        LAYOUT_GROUPS or LAYOUT_MATRIX (the default).  HDF5Data reads both.
+        compression is one of the profiles in COMPRESSION_PROFILES or
+        'gzip-N'.  If progress is not None it is called as
+        progress(fraction, message) while writing.
+        """
+        if layout is None:
+            layout = LAYOUT_MATRIX
+
+        if progress is None:
+            progress = lambda fraction, message: None
+
         f = h5py.File(ofile, 'w')
         g = f.create_group('main')
-        ref_dtype = h5py.special_dtype(ref=h5py.Reference)
         
         for k, val in metadata.iteritems():
             g.attrs[k] = val
@@ -36,38 +289,88 @@ class ModelData(object):
         # We always write at least these two metadata
         g.attrs['command'] = ' '.join(sys.argv)
         g.attrs['timestamp'] = time.ctime()
+        g.attrs['layout'] = layout
 
-        cond = g.create_group('condition')
-        for i, condition in enumerate(self.conditions):
-            ds = cond.create_dataset('%.4d' % (i + 1),
-                                data=self.condition(i + 1), compression='gzip')
-            ds.attrs['name'] = condition
-            
-        dens = g.create_group('density')
-
-        for i, species in enumerate(self.species):
-            print "Writing density of species `%s'" % species
-            ds = dens.create_dataset('%.4d' % (i + 1), data=self.density(i + 1),
-                                     compression='gzip')
-            ds.attrs['name'] = species
-            
-        dens = g.create_group('rate')
-
-        for i, reaction in enumerate(self.reactions):
-            try:
-                ds = dens.create_dataset('%.4d' % (i + 1),
-                                         data=self.rate(i + 1),
-                                         compression='gzip')
-                ds.attrs['name'] = reaction
-                print "Writing reaction `%s'" % reaction
-            except (RuntimeError, ValueError):
-                print "Error in reaction %d `%s'" % (i + 1, reaction)
+        if layout == LAYOUT_MATRIX:
+            self._save_matrices(g, compression, progress)
+        else:
+            self._save_groups(g, compression, progress)
 
         g.create_dataset('t', data=self.t)
         g.create_dataset('source_matrix', data=self.source_matrix,
-                         compression='gzip')
-       
-        
+                         **compression_options(compression))
+        f.close()
+        progress(1.0, "Done")
+
+
+    def _saved_series(self):
+        return (('condition', 'conditions', self.conditions, self.condition),
+                ('density', 'species', self.species, self.density),
+                ('rate', 'reactions', self.reactions, self.rate))
+
+
+    def _save_groups(self, g, compression, progress):
+        """ Writes one dataset per species, reaction and condition. """
+        opts = compression_options(compression)
+        n_total = len(self.conditions) + len(self.species) + len(self.reactions)
+        done = 0
+
+        for name, _, names, accessor in self._saved_series():
+            group = g.create_group(name)
+            full = self.bulk(name)
+
+            for i, item in enumerate(names):
+                progress(float(done) / n_total,
+                         "Writing %s `%s'" % (name, item))
+                if full is not None:
+                    data = full[:, i]
+                else:
+                    data = accessor(i + 1)
+
+                # One bad item (e.g. a name that h5py rejects) should not
+                # spoil the whole file.
+                try:
+                    ds = group.create_dataset('%.4d' % (i + 1), data=data,
+                                              **opts)
+                    ds.attrs['name'] = item
+                except (RuntimeError, ValueError):
+                    warn("Error writing %s %d `%s'" % (name, i + 1, item))
+                done += 1
+
+
+    def _save_matrices(self, g, compression, progress):
+        """ Writes a single (time x item) dataset for each of densities,
+        rates and conditions, plus string datasets with their names. """
+        str_dtype = h5py.special_dtype(vlen=str)
+        n_t = len(self.t)
+        n_total = len(self.conditions) + len(self.species) + len(self.reactions)
+        done = 0
+
+        for name, names_name, names, accessor in self._saved_series():
+            g.create_dataset(names_name,
+                             data=np.array(names, dtype=object),
+                             dtype=str_dtype)
+
+            ds = g.create_dataset(name, shape=(n_t, len(names)), dtype='d',
+                                  **column_chunking(n_t, len(names),
+                                                    compression))
+            full = self.bulk(name)
+            if full is not None:
+                # Blocks of whole chunk rows.
+                for start in xrange(0, n_t, CHUNK_ROWS):
+                    progress((done + len(names) * float(start) / n_t)
+                             / n_total, "Writing %s" % name)
+                    ds[start:start + CHUNK_ROWS] = \
+                        full[start:start + CHUNK_ROWS]
+            else:
+                for i, item in enumerate(names):
+                    progress(float(done + i) / n_total,
+                             "Writing %s `%s'" % (name, item))
+                    ds[:, i] = accessor(i + 1)
+
+            done += len(names)
+
+
     def old_save(self, ofile, metadata={}):
         """ Saves the data in an old format.
         and some metadata into output file ofile.
@@ -109,12 +412,13 @@ class ModelData(object):
 
         gsources = g.create_group('source')
 
-        for species in self.species:
+        for si, species in enumerate(self.species):
             print "Writing sources for species `%s'" % species
             s_group = gsources.create_group(species)
 
-            react_dict = self.sources(species)
-            for reaction, rate in react_dict.iteritems():
+            indices, rates = self.sources(si + 1)
+            for ri, rate in zip(indices, rates):
+                reaction = self.reactions[ri]
                 print "   Writing reaction `%s'" % reaction
                 try:
                     s_group.create_dataset(reaction.replace('.', '_'),
@@ -125,24 +429,75 @@ class ModelData(object):
 
 
 class HDF5Data(ModelData):
-    """ ModelData from a HDF5 file. """
-    def __init__(self, fname):
-        self.fname = fname
-        self.h5 = h5py.File(fname)
-        self.h5_density = self.h5['main/density'] 
-        self.h5_rate = self.h5['main/rate'] 
-        self.h5_condition = self.h5['main/condition'] 
+    """ ModelData from a HDF5 file.  Decompressed series are kept in an LRU
+    cache limited to cache_bytes. """
 
-        self.species = self._read_datasets(self.h5_density)
-        self.reactions = self._read_datasets(self.h5_rate)
-        self.conditions = self._read_datasets(self.h5_condition)
+    # Number of threads used to read many series in the old layout.
+    READ_THREADS = 4
 
-        self.t = np.array(self.h5['main']['t'])
-        self.source_matrix = np.array(self.h5['main']['source_matrix'])
+    def __init__(self, fname, cache_bytes=DEF_MAX_BYTES, swmr=False,
+                 persist_pyramids=False):
+        self.fname = fname
+        self.swmr = swmr
+        self.persist_pyramids = persist_pyramids
+        if swmr:
+            # A file that is still being written by h5stream.StreamWriter.
+            # New rows are picked up by update().
+            self.h5 = h5py.File(fname, 'r', libver='latest', swmr=True)
+        else:
+            self.h5 = h5py.File(fname)
+        main = self.h5['main']
+        self.layout = main.attrs.get('layout', LAYOUT_GROUPS)
+
+        self.h5_density = main['density']
+        self.h5_rate = main['rate']
+        self.h5_condition = main['condition']
+
+        if self.layout == LAYOUT_MATRIX:
+            self.species = list(main['species'])
+            self.reactions = list(main['reactions'])
+            self.conditions = list(main['conditions'])
+        else:
+            self.species = self._read_datasets(self.h5_density)
+            self.reactions = self._read_datasets(self.h5_rate)
+            self.conditions = self._read_datasets(self.h5_condition)
+
+        self.h5_t = main['t']
+        self.t = np.array(self.h5_t)
+        self.source_matrix = np.array(main['source_matrix'])
+
+        self.cache = SeriesCache(cache_bytes)
+        self._pool = None
 
         super(HDF5Data, self).__init__()
 
 
+    def update(self):
+        """ In SWMR mode, picks up the rows appended since the last call. """
+        if not self.swmr:
+            return
+
+        # The writer extends t last, so after refreshing t first all the
+        # other datasets have at least len(t) rows.
+        self.h5_t.refresh()
+        for ds in (self.h5_density, self.h5_rate, self.h5_condition):
+            ds.refresh()
+
+        n = self.h5_t.shape[0]
+        if n != len(self.t):
+            self.t = self.h5_t[:n]
+            self.cache.clear()
+
+
+    def close(self):
+        super(HDF5Data, self).close()
+        self.h5.close()
+
+
+    def memory_bytes(self):
+        return super(HDF5Data, self).memory_bytes() + self.cache.nbytes
+
+
     def _read_datasets(self, group):
         sindices = list(group)
         sindices.sort()
@@ -155,26 +510,117 @@ class HDF5Data(ModelData):
     def _index_key(i):
         return '%.4d' % i
         
-    def density(self, key):
-        return np.array(self.h5_density[self._index_key(key)])
+    def _series(self, group, key, window):
+        # Full series go through the cache.  Windows are sliced from a cached
+        # series if there is one and otherwise read as a hyperslab.
+        sl = self.time_slice(window)
+        ckey = (group.name, key)
+        if sl == slice(0, len(self.t), 1):
+            return self.cache.get(ckey,
+                                  lambda: self._read_series(group, key, sl))
+
+        if ckey in self.cache:
+            return self.cache.get(ckey, None)[sl]
+
+        return self._read_series(group, key, sl)
+
+
+    def _build_pyramid(self, kind, key):
+        # Decimation pyramids can be stored in main/pyramid/<kind>/<key>
+        y = self.series(kind, key)
+        path = 'main/pyramid/%s/%s' % (kind, self._index_key(key))
+        if path in self.h5:
+            g = self.h5[path]
+            if g.attrs['n'] == len(y):
+                levels = [(np.array(g['min%d' % k]), np.array(g['max%d' % k]))
+                          for k in xrange(1, g.attrs['levels'] + 1)]
+                return MinMaxPyramid(y, factor=g.attrs['factor'],
+                                     levels=levels)
+
+        p = MinMaxPyramid(y)
+        if self.persist_pyramids and self.h5.mode == 'r+':
+            if path in self.h5:
+                del self.h5[path]
 
+            g = self.h5.create_group(path)
+            g.attrs['n'] = p.n
+            g.attrs['factor'] = p.factor
+            g.attrs['levels'] = len(p.stored_levels())
+            for k, (lo, hi) in enumerate(p.stored_levels()):
+                g.create_dataset('min%d' % (k + 1), data=lo)
+                g.create_dataset('max%d' % (k + 1), data=hi)
 
-    def rate(self, key):
-        return np.array(self.h5_rate[self._index_key(key)])
+        return p
 
 
-    def condition(self, key):
-        return np.array(self.h5_condition[self._index_key(key)])
+    def _read_series(self, group, key, sl):
+        if sl.start >= sl.stop:
+            return np.zeros((0,))
+
+        if self.layout == LAYOUT_MATRIX:
+            return group[sl, key - 1]
+
+        return group[self._index_key(key)][sl]
+
+
+    def density(self, key, window=None):
+        return self._series(self.h5_density, key, window)
+
+
+    def rate(self, key, window=None):
+        return self._series(self.h5_rate, key, window)
+
+
+    def condition(self, key, window=None):
+        return self._series(self.h5_condition, key, window)
     
         
-    def sources(self, key):
-        c = self.source_matrix[key - 1, :]
-        d = {}
-        for ri in np.nonzero(c)[0]:
-            reaction = self.reactions[ri]
-            d[ri] = self.rate(ri + 1) * c[ri]
+    def rate_block(self, indices, window=None):
+        """ Returns a (len(indices) x n_t) array with the rates of the
+        reactions with the given (0-based, increasing) indices inside
+        window.  Those that are not cached are read in a single hyperslab
+        selection in the matrix layout, or by a pool of threads in the old
+        layout. """
+        sl = self.time_slice(window)
+        full = (sl == slice(0, len(self.t), 1))
+        n_t = len(xrange(sl.start, sl.stop, sl.step))
+
+        r = np.empty((len(indices), n_t))
+        missing = []
+        for j, ri in enumerate(indices):
+            key = (self.h5_rate.name, ri + 1)
+            if key in self.cache:
+                r[j, :] = self.cache.get(key, None)[sl]
+            else:
+                missing.append(j)
+
+        if not missing or n_t == 0:
+            return r
+
+        mindices = [int(indices[j]) for j in missing]
+        if self.layout == LAYOUT_MATRIX:
+            r[missing, :] = self.h5_rate[sl, mindices].T
+        else:
+            block = np.empty((len(missing), n_t))
+
+            def read(j):
+                ds = self.h5_rate[self._index_key(mindices[j] + 1)]
+                ds.read_direct(block[j], source_sel=sl)
+
+            if self._pool is None:
+                self._pool = ThreadPool(self.READ_THREADS)
+            self._pool.map(read, range(len(missing)))
+            r[missing, :] = block
+
+        if full:
+            for j in missing:
+                row = r[j].copy()
+                self.cache.get((self.h5_rate.name, indices[j] + 1),
+                               lambda: row)
+
+        return r
+
 
-        return d
 
 
 
@@ -197,26 +643,34 @@ class ResultsData(ModelData):
         super(ResultsData, self).__init__()
 
 
-    def density(self, key):
-        return self.raw_density[:, self.d_species[key]]
+    def bulk(self, name):
+        if name == 'density':
+            return self.raw_density
+        elif name == 'rate':
+            return self.raw_rates
+        elif name == 'condition':
+            return np.column_stack([self.conditions_dict[k]
+                                    for k in self.conditions])
+
+
+    def density(self, key, window=None):
+        return self.raw_density[self.time_slice(window), self.d_species[key]]
 
 
-    def rate(self, key):
-        return self.raw_rates[:, self.d_reactions[key]]
+    def rate(self, key, window=None):
+        return self.raw_rates[self.time_slice(window), self.d_reactions[key]]
 
 
-    def condition(self, key):
-        return self.conditions_dict[key]
+    def condition(self, key, window=None):
+        return self.conditions_dict[key][self.time_slice(window)]
     
         
-    def sources(self, key):
-        si = self.d_species[key]
-        c = self.source_matrix[si, :]
-        d = {}
-        for ri in np.nonzero(c)[0]:
-            d[self.reactions[ri]] = self.raw_rates[:, ri] * c[ri]
+    def _species_index(self, key):
+        return self.d_species[key]
 
-        return d
+
+    def rate_block(self, indices, window=None):
+        return self.raw_rates[self.time_slice(window), indices].T
 
 
 class DirectoryData(ModelData):
@@ -230,7 +684,8 @@ class DirectoryData(ModelData):
     out_rate.txt
     source_matrix.txt
     out_condition.txt (out_temperatures.txt would also work).
-    
+
+    Any of them may be compressed with gzip, bzip2 or xz (.gz, .bz2, .xz).
     """
 
     F_SPECIES_LIST = 'qt_species_list.txt'
@@ -243,9 +698,24 @@ class DirectoryData(ModelData):
 
     # If true, assumes that lists are numbered and ignores the leading number
     NUMBERED_LISTS = True
+
+    # Number of threads that read the tables concurrently.  They overlap
+    # reading and decompression; the parsing holds the GIL.
+    LOAD_THREADS = 4
     
-    def __init__(self, dirname):
+    def __init__(self, dirname, use_cache=True, out_of_core=None,
+                 chunk_size=CHUNK_SIZE, workers=None):
+        """ With out_of_core the tables are parsed chunk by chunk into
+        memory-mapped .npy files (in the cache directory if use_cache) and
+        the accessors return views of those.  Peak memory is then set by
+        chunk_size and not by the length of the run.  If out_of_core is
+        None, it is used for tables larger than OUT_OF_CORE_BYTES.
+
+        workers is the number of threads that read the tables (default
+        LOAD_THREADS); with 1 they are read one after another. """
         self.dirname = dirname
+        self.workers = workers if workers is not None else self.LOAD_THREADS
+        self._pool = None
 
         self.species = self._read_list(self.F_SPECIES_LIST)
         self.reactions = self._read_list(self.F_REACTIONS_LIST)
@@ -254,13 +724,64 @@ class DirectoryData(ModelData):
         self.n_species = len(self.species)
         self.n_reactions = len(self.reactions)
 
+        # Any of the files may be compressed (qt_rates.txt.gz, ...).
+        tables = [find_file(self._path(f))
+                  for f in (self.F_DENSITIES, self.F_RATES,
+                            self.F_CONDITIONS, self.F_MATRIX)]
+        if out_of_core is None:
+            out_of_core = (sum(os.path.getsize(f) for f in tables
+                               if os.path.exists(f)) > OUT_OF_CORE_BYTES)
+
+        self.out_of_core = out_of_core
+        self._cache = DirectoryCache(dirname) if use_cache else None
+        spills = self._spills(tables) if out_of_core else [None] * 4
+
+        # The source matrix is written once at the beginning of the run but
+        # reading it like the other tables also protects us from reading
+        # it half-written.
+        self._readers = [TailReader(fname, skiprows=skiprows,
+                                    chunk_size=chunk_size, spill=spill)
+                         for fname, skiprows, spill
+                         in zip(tables, (1, 1, 1, 0), spills)]
+
+        # A column of a memory-mapped table is spread over the whole file,
+        # so out of core we keep a copy of t, which is needed all the time.
+        self._t = GrowingArray(1)
+        self._t_table = None
+
+        # With the cache we only have to parse what was appended to the
+        # files since the last time that the directory was opened.
+        if self._cache is not None:
+            for reader in self._readers:
+                self._cache.restore(reader)
+
         self.update()
 
+        if self._cache is not None:
+            self._cache.store(self._readers)
+
         super(DirectoryData, self).__init__()
 
+    def _spills(self, tables):
+        # Names of the .npy files where out-of-core readers write.
+        if self._cache is not None:
+            try:
+                return [self._cache.spill(f) for f in tables]
+            except (IOError, OSError):
+                pass
+
+        tmpdir = tempfile.mkdtemp(prefix='qtplaskin')
+        atexit.register(shutil.rmtree, tmpdir, True)
+        return [os.path.join(tmpdir, os.path.splitext(os.path.basename(f))[0]
+                             + '.npy') for f in tables]
+
+
     def _read_list(self, fname):
-        with open(self._path(fname)) as fp:
+        fp = open_file(find_file(self._path(fname)))
+        try:
             r = [s.strip() for s in fp.read().strip().split('\n')]
+        finally:
+            fp.close()
 
         if self.NUMBERED_LISTS:
             r = [' '.join(s.split()[1:]) for s in r]
@@ -269,19 +790,29 @@ class DirectoryData(ModelData):
         return r
 
     def update(self):
-        """ Reads or re-reads those files that may change during the execution.
+        """ Reads those parts of the files that may have been appended
+        since the last call.  Only new complete lines are parsed, so the cost
+        of an update scales with the amount of new data.  The files are
+        independent, so they are read in concurrent threads.  Only reading
+        and decompressing release the GIL: they overlap with the parsing
+        of other tables, but the parsing itself (np.fromstring) runs one
+        table at a time.
         """
-        _raw_density = np.loadtxt(self._path(self.F_DENSITIES), skiprows=1)
-
-        i_dens = _raw_density.shape[0]
-
-        _raw_rates = np.loadtxt(self._path(self.F_RATES), skiprows=1)
-
-        self.source_matrix = np.loadtxt(self._path(self.F_MATRIX),
-                                        dtype='d')
-
-        _raw_conditions = np.loadtxt(self._path(self.F_CONDITIONS),
-                                     skiprows=1)
+        if self.workers > 1:
+            if self._pool is None:
+                self._pool = ThreadPool(min(self.workers, len(self._readers)))
+            nrows = self._pool.map(TailReader.update, self._readers)
+        else:
+            nrows = [reader.update() for reader in self._readers]
+
+        _raw_density, _raw_rates, _raw_conditions = \
+            [reader.data for reader in self._readers[:3]]
+
+        # reader.data is a new view on each call: we only replace the
+        # source matrix when it has changed, so that the SourceEngine built
+        # from it is kept.
+        if nrows[3] or getattr(self, 'source_matrix', None) is None:
+            self.source_matrix = self._readers[3].data
 
         latest_i = min(d.shape[0] for d in
                        (_raw_density, _raw_rates, _raw_conditions))
@@ -289,7 +820,20 @@ class DirectoryData(ModelData):
         self.raw_conditions = _raw_conditions[:latest_i, 1:]
         self.raw_rates = _raw_rates[:latest_i, 1:]
         self.raw_density = _raw_density[:latest_i, 1:]
-        self.t = _raw_density[:latest_i, 0]
+
+        if not self.out_of_core:
+            self.t = _raw_density[:latest_i, 0]
+            return
+
+        # The reader starts a new table if the file was re-created.
+        table = self._readers[0].table
+        if table is not self._t_table or latest_i < len(self._t):
+            self._t.clear()
+            self._t_table = table
+
+        if latest_i > len(self._t):
+            self._t.append(_raw_density[len(self._t):latest_i, 0:1])
+        self.t = self._t.data[:, 0]
         
 
                                  
@@ -298,27 +842,26 @@ class DirectoryData(ModelData):
         return os.path.join(self.dirname, fname)
 
 
-    def density(self, key):
-        return self.raw_density[:, key - 1]
+    def bulk(self, name):
+        return {'density': self.raw_density,
+                'rate': self.raw_rates,
+                'condition': self.raw_conditions}[name]
+
 
+    def density(self, key, window=None):
+        return self.raw_density[self.time_slice(window), key - 1]
 
-    def rate(self, key):
-        return self.raw_rates[:, key - 1]
 
+    def rate(self, key, window=None):
+        return self.raw_rates[self.time_slice(window), key - 1]
 
-    def condition(self, key):
-        return self.raw_conditions[:, key - 1]
 
+    def condition(self, key, window=None):
+        return self.raw_conditions[self.time_slice(window), key - 1]
 
-    def sources(self, key):
-        # The +/-1 in this function are to move to the FORTRAN/ZdPlaskin
-        # array numbering convention.
-        c = self.source_matrix[key - 1, :]
-        d = {}
-        for ri in np.nonzero(c)[0]:
-            d[ri] = self.raw_rates[:, ri] * c[ri]
 
-        return d
+    def rate_block(self, indices, window=None):
+        return self.raw_rates[self.time_slice(window), indices].T
 
     
 class OldDirectoryData(DirectoryData):
@@ -337,89 +880,99 @@ class OldDirectoryData(DirectoryData):
 
 
 class RealtimeData(ModelData):
-    tracked_conditions =  ['gas_temperature',
-                           'reduced_field',
-                           'reduced_frequency',
-                           'elec_temperature',
-                           'elec_drift_velocity',
-                           'elec_diff_coeff',
-                           'elec_frequency_n',
-                           'elec_power_n',
-                           'elec_power_elastic_n',
-                           'elec_power_inelastic_n']
+    """ ModelData from a simulation that runs in a subprocess.  The
+    timesteps computed so far are collected by update().  Source terms are
+    computed from the rates when they are requested, as in the other
+    backends.  The arguments are passed to runner.run; in particular,
+    transport='shm' passes the timesteps through shared memory.  Besides,
+    dtype and max_bytes set how the values are stored (see
+    storage.ColumnStore). """
 
     def __init__(self, *args, **kwargs):
-        # The arguments are passed to run.
-        self.conn, self.conn_child = Pipe()
-        self.sub = Process(target=run, args=(self.conn_child,) + args,
+        # Storage options; the others are for run.
+        dtype = kwargs.pop('dtype', 'd')
+        max_bytes = kwargs.pop('max_bytes', None)
+
+        self.conn, conn_child = Pipe(False)
+        self.sub = Process(target=run, args=(conn_child,) + args,
                            kwargs=kwargs)
         self.sub.start()
 
-        # With the subprocess already running, we can already ask for some data
-        # First we get t, the species list and the reactions list.
-        self.t_, self.species, self.reactions = self.conn.recv()
-        n_species = len(self.species)
-        n_reactions = len(self.reactions)
-        
-        # With that info we can already initialize the storage arrays
-        self.raw_density = np.zeros((self.t_.shape[0], n_species))
-        self.raw_rates = np.zeros((self.t_.shape[0], n_reactions))
-        self.conditions_dict = dict((cond, np.zeros(self.t_.shape))
-                                    for cond in self.tracked_conditions)
-        self.conditions = self.conditions_dict.keys()
-        
+        # With the subprocess already running, we can already ask for some
+        # data.  First we get the header (see protocol.py).
+        header = protocol.receive_header(self.conn)
+        self.species = header['species']
+        self.reactions = header['reactions']
+        self.conditions = header['conditions']
+        self.source_matrix = header['source_matrix']
+        self.layout = protocol.RecordLayout.from_header(header)
+        self.receiver = open_receiver(self.conn, header)
+
+        # The storage grows with the records that arrive, whatever the
+        # times announced in the header.  Values may be kept in single
+        # precision and moved to disk beyond max_bytes; t is always double.
+        self._t = ColumnStore(1)
+        self.values = ColumnStore(self.layout.width - self.layout.values.start,
+                                  dtype=dtype, max_bytes=max_bytes)
+        self.finished = False
+        self._set_views()
 
-        # We will store sources in a list of dictionaries
-        # e.g. rrt[index('E')][index('E + O2 -> 2E + O2^+')]
-        # is the rate of creation of
-        # electrons due to that reaction.  Only reactions with some effect
-        # will appear as keys in the dictionary.
-        self.sources = [dict() for s in self.species]
+        super(RealtimeData, self).__init__()
 
-        # This indicates how much data has been read
-        self.i = 0
 
-        super(RealtimeData, self).__init__()
+    def _set_views(self):
+        # The storage may be reallocated when it grows.
+        self.t = self._t.data[:, 0]
+        self.raw_density, self.raw_rates, self.raw_conditions = \
+            self.layout.split(self.values.data)
 
 
-    @property
-    def t(self):
-        return self.t_[:self.i]
+    def update(self, timeout=0):
+        """ Collects the records that have arrived, waiting up to timeout
+        seconds for the first one. """
+        while not self.finished and self.receiver.poll(timeout):
+            block = self.receiver.receive()
+            if block is None:
+                self.finished = True
+                self.sub.join()
+                break
 
-    
-    def flush(self, timeout=2):
-        self.conn.send('flush')
-        try:
-            while self.conn.poll(timeout):
-                data = self.conn.recv()
-                if data is None:
-                    # I have to do this bc conn.recv does not raise EOFError when
-                    # the other end is closed
-                    raise EOFError
-
-                i, c_density, c_rates, c_rrt, c_conditions = data
-
-                self.raw_density[i, :] = c_density
-                self.raw_rates[i, :] = c_rates
-
-                for k, a in self.conditions_dict.iteritems():
-                    a[i] = c_conditions[k]
-
-                # To save space we will store only nonzero species/reaction pairs
-                for si, ri in zip(*np.nonzero(c_rrt)):
-                    # si is the species index, ri is the reaction index
-                    try:
-                        self.sources[si][ri][i] = c_rrt[si, ri]
-                        s = self.species[si]
-                        r = self.reactions[ri]
-                    except KeyError:
-                        self.sources[si][ri] = np.zeros((self.t_.shape[0],))
-                        self.sources[si][ri][i] = c_rrt[si, ri]
-
-                self.i = i
-        except EOFError:
-            pass
+            self._t.append(block[:, 1:2])
+            self.values.append(block[:, self.layout.values])
+            timeout = 0
 
-        
-    def density(self, key):
-        return self.raw_density[:self.i, key]
+        self._set_views()
+
+
+    def flush(self):
+        self.update()
+
+
+    def close(self):
+        super(RealtimeData, self).close()
+        if self.sub.is_alive():
+            self.sub.terminate()
+        self.conn.close()
+        self.values.close()
+
+
+    def bulk(self, name):
+        return {'density': self.raw_density,
+                'rate': self.raw_rates,
+                'condition': self.raw_conditions}[name]
+
+
+    def density(self, key, window=None):
+        return self.raw_density[self.time_slice(window), key - 1]
+
+
+    def rate(self, key, window=None):
+        return self.raw_rates[self.time_slice(window), key - 1]
+
+
+    def condition(self, key, window=None):
+        return self.raw_conditions[self.time_slice(window), key - 1]
+
+
+    def rate_block(self, indices, window=None):
+        return self.raw_rates[self.time_slice(window), indices].T
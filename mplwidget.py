@@ -4,7 +4,7 @@ import time
 import numpy as np
 
 # Python Qt4 bindings for GUI objects
-from PyQt4 import QtGui
+from PyQt4 import QtGui, QtCore
 
 # import the Qt4Agg FigureCanvas object, that binds Figure to
 # Qt4Agg backend. It also inherits from QWidget
@@ -21,6 +21,10 @@ except ImportError:
 # Matplotlib Figure object
 from matplotlib.figure import Figure
 
+# After a zoom, data is requested for the visible time range extended by
+# this fraction of its width at each side.
+ZOOM_MARGIN = 0.5
+
 
 class MplCanvas(FigureCanvas):
     """Class to represent the FigureCanvas widget"""
@@ -93,6 +97,52 @@ class MplWidget(QtGui.QWidget):
 
         self.clear_data()
 
+        # The zoom of the user.  on_zoom is called (from the Qt event loop)
+        # after each zoom, to re-read the data in zoom_window.  Changes of
+        # the x limits while replotting is True are not zooms.
+        self.on_zoom = None
+        self.replotting = False
+        self.zoom_pending = False
+        self.reset_zoom()
+
+    def reset_zoom(self):
+        self.zoom_xlim = None
+        self.zoom_window = None
+
+    def restore_zoom(self):
+        """ Sets the x limits back to the zoomed view after a replot. """
+        if self.zoom_xlim is None or not self.axes:
+            return
+
+        for ax in self.axes:
+            ax.set_xlim(self.zoom_xlim)
+        self.draw()
+
+    def _watch(self, ax):
+        ax.callbacks.connect('xlim_changed', self._xlim_changed)
+
+    def _xlim_changed(self, ax):
+        if self.replotting or self.on_zoom is None:
+            return
+
+        xmin, xmax = ax.get_xlim()
+        self.zoom_xlim = (xmin, xmax)
+        if ax.get_xscale() == 'log' and xmin > 0:
+            margin = (xmax / xmin) ** ZOOM_MARGIN
+            self.zoom_window = (xmin / margin, xmax * margin)
+        else:
+            margin = (xmax - xmin) * ZOOM_MARGIN
+            self.zoom_window = (xmin - margin, xmax + margin)
+
+        # We do not replot from inside a matplotlib callback.
+        if not self.zoom_pending:
+            self.zoom_pending = True
+            QtCore.QTimer.singleShot(0, self._zoomed)
+
+    def _zoomed(self):
+        self.zoom_pending = False
+        self.on_zoom()
+
     def clear_data(self):
         # This is for the correct export of data.
         self.xdata = None
@@ -103,6 +153,7 @@ class MplWidget(QtGui.QWidget):
         """ Adds axes to this widget.  """
         ax = self.fig.add_axes(*args, **kwargs)
         self.axes.append(ax)
+        self._watch(ax)
 
         return ax
 
@@ -118,6 +169,8 @@ class MplWidget(QtGui.QWidget):
     def clear(self):
         for ax in self.axes:
             ax.clear()
+            # Clearing the axes also removes their callbacks.
+            self._watch(ax)
 
         self.grid()
         self.draw()
@@ -135,6 +188,8 @@ class MplWidget(QtGui.QWidget):
             self.draw()
             
     def add_data(self, x, y, label):
+        """ Adds data for export.  y can also be a function that returns the
+        data, so that it is only read if it is exported. """
         if self.xdata is None:
             self.xdata = x
             self.labels.append('Time')
@@ -143,7 +198,8 @@ class MplWidget(QtGui.QWidget):
         self.labels.append(label)
 
     def savedata(self, fname, location):
-        d = np.c_[tuple([self.xdata,] + self.ydata)]
+        ydata = [y() if callable(y) else y for y in self.ydata]
+        d = np.c_[tuple([self.xdata,] + ydata)]
         
         with open(fname, "w") as fout:
             fout.write("# Input: %s\n" % location)
@@ -0,0 +1,142 @@
+""" The messages that a running simulation (runner.run) sends to whoever
+collects its results (run_model.receiver, run_model.stream_receiver and
+modeldata.RealtimeData).
+
+The first message is a header, a dictionary sent with Connection.send:
+
+  version        VERSION, checked by the receiver.
+  t              the times at which the simulation will output, or None
+                 if they are not known in advance.
+  species, reactions, conditions
+                 the names of the items in each record.
+  source_matrix  the (species x reactions) stoichiometric matrix.
+  transport      how the records are sent, with its own fields (see
+                 transport.py).
+
+Then each timestep is sent as a record of float64 numbers:
+
+  [i, t, density..., rates..., conditions...]
+
+with the conditions in the order of header['conditions'].  With the 'pipe'
+transport, records are sent with Connection.send_bytes and a message may
+hold several consecutive records.  With any transport, an empty message
+marks the end of the run.  Source terms are not sent: receivers compute
+them from the rates and the source matrix.
+"""
+
+import numpy as np
+
+# Increase this with any change of the format of the messages.
+VERSION = 3
+
+# Conditions sent in each record, by default.
+TRACKED_CONDITIONS = ['gas_temperature',
+                      'reduced_field',
+                      'reduced_frequency',
+                      'elec_temperature',
+                      'elec_drift_velocity',
+                      'elec_diff_coeff',
+                      'elec_frequency_n',
+                      'elec_power_n',
+                      'elec_power_elastic_n',
+                      'elec_power_inelastic_n']
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def make_header(t, species, reactions, source_matrix,
+                conditions=TRACKED_CONDITIONS):
+    return {'version': VERSION,
+            't': np.asarray(t) if t is not None else None,
+            'species': list(species),
+            'reactions': list(reactions),
+            'conditions': list(conditions),
+            'source_matrix': np.asarray(source_matrix)}
+
+
+def receive_header(conn):
+    """ Receives the header and checks that we understand its version. """
+    header = conn.recv()
+    if not isinstance(header, dict) or header.get('version') != VERSION:
+        raise ProtocolError("Unsupported message header (expected "
+                            "version %d): %r" % (VERSION, header))
+    return header
+
+
+class RecordLayout(object):
+    """ Positions of the fields in a record. """
+
+    def __init__(self, n_species, n_reactions, n_conditions):
+        self.density = slice(2, 2 + n_species)
+        self.rates = slice(self.density.stop, self.density.stop + n_reactions)
+        self.conditions = slice(self.rates.stop,
+                                self.rates.stop + n_conditions)
+        self.width = self.conditions.stop
+        self.values = slice(self.density.start, self.width)
+
+
+    @classmethod
+    def from_header(cls, header):
+        return cls(len(header['species']), len(header['reactions']),
+                   len(header['conditions']))
+
+
+    def empty(self, nrecords=None):
+        """ Returns an uninitialized record, or block of records. """
+        if nrecords is None:
+            return np.empty((self.width,))
+        return np.empty((nrecords, self.width))
+
+
+    def pack(self, record, i, t, density, rates, conditions):
+        """ Fills a record in place. """
+        record[0] = i
+        record[1] = t
+        record[self.density] = density
+        record[self.rates] = rates
+        record[self.conditions] = conditions
+        return record
+
+
+    def split(self, values):
+        """ Splits a (records x fields) array of the fields after t into
+        views of density, rates and conditions. """
+        o = self.density.start
+        return tuple(values[:, sl.start - o:sl.stop - o]
+                     for sl in (self.density, self.rates, self.conditions))
+
+
+    def unpack(self, buf):
+        """ Returns the records in a message as a (records x width) array. """
+        records = np.frombuffer(buf, dtype='d')
+        if records.size % self.width:
+            raise ProtocolError("Message of %d numbers is not made of "
+                                "records of width %d"
+                                % (records.size, self.width))
+        return records.reshape((-1, self.width))
+
+
+def send_records(conn, records):
+    """ Sends a record or a (records x width) block of them. """
+    conn.send_bytes(np.ascontiguousarray(records, dtype='d'))
+
+
+def send_end(conn):
+    conn.send_bytes(b'')
+
+
+def receive(conn, layout):
+    """ Receives one message.  Returns its records, or None at the end of
+    the run. """
+    try:
+        buf = conn.recv_bytes()
+    except EOFError:
+        return None
+
+    if not buf:
+        return None
+
+    return layout.unpack(buf)
+
@@ -0,0 +1,176 @@
+""" Min/max decimation of long time series for plotting.
+
+A series with millions of points is drawn with, at most, a few thousand
+pixels.  For each pixel it is enough to draw the minimum and the maximum of
+the samples that fall into it.  MinMaxPyramid precomputes those extremes
+over buckets of factor**k samples for k = 1, 2, ... so that the envelope of
+any range at any resolution costs O(number of pixels).
+"""
+
+import numpy as np
+
+# Each level has this many times fewer buckets than the previous one.
+FACTOR = 4
+
+# We stop building levels when they have fewer buckets than this.
+MIN_BUCKETS = 256
+
+
+def _reduce(a, factor, ufunc):
+    # a has a trailing NaN pad; the result also gets one.
+    r = ufunc.reduceat(a[:-1], np.arange(0, len(a) - 1, factor))
+    return np.append(r, np.nan)
+
+
+def _reduce_short(a, start, end, width, ufunc):
+    # Reduces a over ranges shorter than width by gathering them.  Short
+    # ranges repeat their last item, which changes no minimum or maximum.
+    idx = start[:, np.newaxis] + np.arange(width)
+    idx = np.minimum(idx, end[:, np.newaxis] - 1)
+    return ufunc.reduce(a[idx], axis=1)
+
+
+class MinMaxPyramid(object):
+    """ Minima and maxima of a series y over buckets of growing size.  Level
+    0 is the series itself.  levels can be a list of precomputed (min, max)
+    pairs for levels 1, 2,... as returned by stored_levels(). """
+
+    def __init__(self, y, factor=FACTOR, levels=None):
+        self.factor = factor
+        self.n = len(y)
+
+        # All levels carry a trailing NaN so that ufunc.reduceat can be given
+        # the end of the last bucket as an index.  fmin/fmax ignore it.
+        y0 = np.append(np.asarray(y, dtype='d'), np.nan)
+        self.levels = [(y0, y0)]
+
+        if levels is not None:
+            self.levels.extend(levels)
+            return
+
+        lo, hi = y0, y0
+        while len(lo) - 1 > MIN_BUCKETS:
+            lo = _reduce(lo, factor, np.fmin)
+            hi = _reduce(hi, factor, np.fmax)
+            self.levels.append((lo, hi))
+
+
+    def stored_levels(self):
+        """ The levels that are worth storing, i.e. all except level 0. """
+        return self.levels[1:]
+
+
+    def envelope(self, edges):
+        """ Returns the minimum and maximum of the series between consecutive
+        index edges.  Empty intervals give NaN.  The extremes are exact: each
+        interval is covered by the whole buckets of the coarsest level that
+        fit into it and, at its ends, by those of finer and finer levels,
+        down to single samples. """
+        edges = np.asarray(edges, dtype='i8')
+        start, end = edges[:-1], edges[1:]
+        nonempty = end > start
+
+        # The first and past-the-last buckets of each level that lie wholly
+        # inside each interval.  The last bucket of a level may be short.
+        first, last = [], []
+        for k, (lo, _) in enumerate(self.levels):
+            b = self.factor ** k
+            first.append(-(-start // b))
+            last.append(np.where(end >= self.n, len(lo) - 1, end // b))
+
+        top = np.zeros(len(start), dtype='i')
+        for k in xrange(1, len(self.levels)):
+            top[first[k] < last[k]] = k
+
+        ymin = np.empty(len(start))
+        ymax = np.empty(len(start))
+        ymin.fill(np.nan)
+        ymax.fill(np.nan)
+
+        for k, (lo, hi) in enumerate(self.levels):
+            # At the top level of an interval we take all its whole buckets.
+            at_top = np.flatnonzero(nonempty & (top == k))
+            if len(at_top):
+                bstart, bend = first[k][at_top], last[k][at_top]
+
+                # reduceat on interleaved (start, end) pairs reduces over
+                # each pair; the results for (end, next start) are
+                # discarded.  The last index reduces to the end of the
+                # array, so we cut it there.
+                idx = np.empty(2 * len(bstart), dtype='i8')
+                idx[0::2] = bstart
+                idx[1::2] = bend
+                stop = bend.max() + 1
+
+                ymin[at_top] = np.fmin(ymin[at_top], np.fmin.reduceat(
+                    lo[:stop], idx)[0::2])
+                ymax[at_top] = np.fmax(ymax[at_top], np.fmax.reduceat(
+                    hi[:stop], idx)[0::2])
+
+            # Below it, only those before and after the buckets of the next
+            # level, which are fewer than factor at each end.
+            below = np.flatnonzero(nonempty & (top > k))
+            if not len(below):
+                continue
+
+            f0, l0 = first[k][below], last[k][below]
+            f1, l1 = first[k + 1][below], last[k + 1][below]
+            for bstart, bend in ((f0, np.minimum(f1 * self.factor, l0)),
+                                 (np.minimum(l1 * self.factor, l0), l0)):
+                use = bend > bstart
+                which, bstart, bend = below[use], bstart[use], bend[use]
+                ymin[which] = np.fmin(ymin[which],
+                                      _reduce_short(lo, bstart, bend,
+                                                    self.factor, np.fmin))
+                ymax[which] = np.fmax(ymax[which],
+                                      _reduce_short(hi, bstart, bend,
+                                                    self.factor, np.fmax))
+
+        return ymin, ymax
+
+
+    def decimate(self, t, edges):
+        """ Returns (x, y) arrays to plot the series between edges[0] and
+        edges[-1] with one vertical stroke per interval. """
+        return envelope_xy(t, edges, *self.envelope(edges))
+
+
+def envelope_xy(t, edges, ymin, ymax):
+    """ Interleaves the minima and maxima of the intervals given by edges
+    into a line that can be plotted. """
+    edges = np.asarray(edges)
+    nonempty = edges[1:] > edges[:-1]
+    x = np.repeat(t[edges[:-1][nonempty]], 2)
+    y = np.column_stack((ymin[nonempty], ymax[nonempty])).ravel()
+    return x, y
+
+
+def decimate(t, y, edges):
+    """ Decimates a series in a single pass, without a pyramid.  Use this
+    for series that are computed on the fly.  If edges is None, returns the
+    series unchanged. """
+    if edges is None:
+        return t, y
+
+    return MinMaxPyramid(y, levels=[]).decimate(t, edges)
+
+
+def pixel_edges(t, sl, npixels, log=False):
+    """ Returns the index edges of npixels intervals, equally spaced in t
+    (or in log t) that cover the indices in the slice sl of t. """
+    ts = t[sl]
+    if log:
+        ts = ts[ts > 0]
+
+    if len(ts) < 2:
+        return np.array([sl.start, sl.stop])
+
+    if log:
+        tedges = np.logspace(np.log10(ts[0]), np.log10(ts[-1]), npixels + 1)
+    else:
+        tedges = np.linspace(ts[0], ts[-1], npixels + 1)
+
+    edges = np.searchsorted(t[sl], tedges) + sl.start
+    edges[0] = sl.start
+    edges[-1] = sl.stop
+    return np.maximum.accumulate(edges)
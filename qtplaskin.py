@@ -3,6 +3,7 @@ import sys
 import os
 from itertools import cycle, izip
 import traceback
+from functools import wraps
 
 # Qt4 bindings for core Qt functionalities (non-GUI)
 from PyQt4 import QtCore
@@ -17,6 +18,8 @@ from numpy import *
 # import the MainWindow widget from the converted .ui files
 from mainwindow import Ui_MainWindow
 from modeldata import HDF5Data, RealtimeData, DirectoryData, OldDirectoryData
+from pyramid import decimate, pixel_edges
+from session import SessionCache
 
 COLOR_SERIES = ["#5555ff", "#ff5555", "#909090",
                 "#ff55ff", "#008800", "#8d0ade",
@@ -24,6 +27,9 @@ COLOR_SERIES = ["#5555ff", "#ff5555", "#909090",
                 "#7777ff", "#77ff77"]
 LINE_WIDTH = 1.7
 
+# Interval (in ms) between updates of files that are being written
+UPDATE_INTERVAL = 5000
+
 # We do not plot densities or rates below these thresholds
 DENS_THRESHOLD = 1e-10
 RATE_THRESHOLD = 1e-20
@@ -57,6 +63,24 @@ CONDITIONS_PRETTY_NAMES = {
             "Electron reduced inelastic power [eV cm$^\mathdefault{3}$s$^\mathdefault{-1}$]"}
 
 
+def replots(widget_name):
+    """ Decorator for the methods that redraw the plot widget widget_name.
+    While they run, changes of the x limits are not taken as zooms of the
+    user and afterwards the zoomed view, if any, is restored. """
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args):
+            widget = getattr(self, widget_name)
+            widget.replotting = True
+            try:
+                return method(self, *args)
+            finally:
+                widget.restore_zoom()
+                widget.replotting = False
+        return wrapper
+    return decorator
+
+
 class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
     """Customization for Qt Designer created window"""
     def __init__(self, parent = None):
@@ -80,9 +104,21 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
                              self.reactWidget,
                              self.sourceWidget]
         
+        # After a zoom we re-read only the visible time window
+        self.condWidget.on_zoom = self.update_cond_graph
+        self.densWidget.on_zoom = self.update_spec_graph
+        self.reactWidget.on_zoom = self.update_react_graph
+        self.sourceWidget.on_zoom = self.update_source_graph
+
         self.update_timer = QtCore.QTimer()
         self.latest_dir = "."
 
+        # Runs opened in this session stay in memory, so going back to one
+        # of them is instant.
+        self.session = SessionCache()
+        self.menuRecent = QtGui.QMenu("Open &recent", self)
+        self.menuFile.insertMenu(self.actionExport_data, self.menuRecent)
+
         # connect the signals with the slots
         QtCore.QObject.connect(self.condButton, 
                                QtCore.SIGNAL("clicked()"),
@@ -136,6 +172,10 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
                                QtCore.SIGNAL("timeout()"),
                                self.data_update)
 
+        QtCore.QObject.connect(self.menuRecent,
+                               QtCore.SIGNAL('aboutToShow()'),
+                               self.update_recent_menu)
+
     # Drag'n'Drop.  Implemented by Marc Foletto.
     def dragEnterEvent(self, event):
         if event.mimeData().hasUrls():
@@ -163,6 +203,28 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
                 self.load_h5file(path)
 
 
+    def update_recent_menu(self):
+        """ Lists the recently opened runs; those marked with * are still
+        in memory. """
+        self.menuRecent.clear()
+        for path in self.session.recent:
+            label = ("* " if path in self.session else "   ") + path
+            action = self.menuRecent.addAction(label)
+            QtCore.QObject.connect(action, QtCore.SIGNAL('triggered()'),
+                                   lambda path=path: self.open_recent(path))
+
+        self.menuRecent.setEnabled(bool(self.session.recent))
+
+
+    def open_recent(self, path):
+        try:
+            self.import_file_or_dir(path)
+            self.set_location(path)
+        except IOError as e:
+            QtGui.QErrorMessage(self).showMessage(
+                "Failed to open %s <%s>" % (path, e))
+
+
     def set_location(self, location):
         """ Sets the opened location. """
         self.setWindowTitle("%s - QtPlaskin" % location)
@@ -174,14 +236,22 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
             return 'log'
         else:
             return 'linear'
-        
+
+    def decimated(self, widget, kind, key):
+        """ Returns the (t, y) to plot a series in widget, with at most two
+        points per pixel. """
+        return self.data.decimated(kind, key, widget.canvas.width(),
+                                   window=widget.zoom_window,
+                                   log=(self.xscale == 'log'))
+
+    @replots('condWidget')
     def update_cond_graph(self):
         """Updates the graph with densities"""
 
 
         try:
             condition = list(iter_2_selected(self.condList))[0][0]
-        except AttributeError:
+        except (AttributeError, IndexError):
             return
 
         # clear the Axes
@@ -192,12 +262,14 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
 
         QtGui.QApplication.setOverrideCursor(QtGui.QCursor(Qt.WaitCursor))
         
-        y = array(self.data.condition(condition))
+        window = self.condWidget.zoom_window
+        t = self.data.t_window(window)
+        tp, y = self.decimated(self.condWidget, 'condition', condition)
         condition_name = self.data.conditions[condition - 1]
         
         flt = y > 0
         label = CONDITIONS_PRETTY_NAMES.get(condition_name, condition_name)
-        self.condWidget.axes[0].plot(self.data.t[flt], y[flt], lw=LINE_WIDTH,
+        self.condWidget.axes[0].plot(tp[flt], y[flt], lw=LINE_WIDTH,
                                      label=label,
                                      zorder=10)
 
@@ -208,10 +280,12 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
         # force an image redraw
         self.condWidget.draw()
         
-        self.condWidget.add_data(self.data.t, y, label)
+        self.condWidget.add_data(
+            t, lambda: self.data.condition(condition, window=window), label)
         QtGui.QApplication.restoreOverrideCursor()
 
 
+    @replots('densWidget')
     def update_spec_graph(self):
         """Updates the graph with densities"""
         # clear the Axes
@@ -227,16 +301,20 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
         QtGui.QApplication.setOverrideCursor(QtGui.QCursor(Qt.WaitCursor))
         self.data.flush()
         citer = cycle(COLOR_SERIES)
-        
+
+        window = self.densWidget.zoom_window
+        t = self.data.t_window(window)
         for item in iter_2_selected(self.speciesList):
             name = item[1]
-            dens = self.data.density(item[0])
+            tp, dens = self.decimated(self.densWidget, 'density', item[0])
             flt = dens > DENS_THRESHOLD
-            self.densWidget.axes[0].plot(self.data.t[flt], dens[flt],
+            self.densWidget.axes[0].plot(tp[flt], dens[flt],
                                          lw=LINE_WIDTH,
                                          c=citer.next(), label=name,
                                          zorder=10)
-            self.densWidget.add_data(self.data.t, dens, name)
+            self.densWidget.add_data(
+                t, lambda key=item[0]: self.data.density(key, window=window),
+                name)
 
         self.densWidget.set_scales(yscale='log', xscale=self.xscale)
         self.densWidget.axes[0].set_xlabel("t [s]")
@@ -249,11 +327,12 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
         QtGui.QApplication.restoreOverrideCursor()
 
 
+    @replots('sourceWidget')
     def update_source_graph(self):
         """Updates the graph with sources rates"""
         try:
             species = list(iter_2_selected(self.speciesSourceList))[0]
-        except AttributeError:
+        except (AttributeError, IndexError):
             return
         
         # clear the Axes
@@ -264,13 +343,10 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
 
         QtGui.QApplication.setOverrideCursor(QtGui.QCursor(Qt.WaitCursor))
         
-        dreactions = self.data.sources(species[0])
-        reactions = dreactions.keys()
-        
-        r = zeros((len(reactions), len(self.data.t)))
-        for i, react in enumerate(reactions):
-            r[i, :] = dreactions[react]
-            
+        window = self.sourceWidget.zoom_window
+        t = self.data.t_window(window)
+        reactions, r = self.data.sources(species[0], window=window)
+
         # Find the reactions that are at some point at least a delta of the total
         filters = {0: (0.1, -1),
                    1: (0.01, -1),
@@ -295,35 +371,45 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
         icreation = select_rates(fpos, delta, max_rates=max_rates)
         idestruct = select_rates(fneg, delta, max_rates=max_rates)
 
+        # The contributions are computed on the fly, so we decimate them
+        # without a pyramid.
+        npixels = self.sourceWidget.canvas.width()
+        edges = None
+        if len(t) > 2 * npixels:
+            edges = pixel_edges(t, slice(0, len(t)), npixels,
+                                log=(self.xscale == 'log'))
+
         citer = cycle(COLOR_SERIES)
         for i in icreation:
             name = self.data.reactions[reactions[i]]
-            flt = abs(r[i, :]) > RATE_THRESHOLD
+            tp, ri = decimate(t, abs(r[i, :]), edges)
+            flt = ri > RATE_THRESHOLD
             label = "[%d] %s" % (reactions[i] + 1, name)
 
-            self.sourceWidget.creationAx.plot(self.data.t[flt],
-                                              abs(r[i, flt]),
+            self.sourceWidget.creationAx.plot(tp[flt],
+                                              ri[flt],
                                               c=citer.next(),
                                               lw=LINE_WIDTH,
                                               label=label,
                                               zorder=10)
 
-            self.sourceWidget.add_data(self.data.t, r[i, :], label)
+            self.sourceWidget.add_data(t, r[i, :], label)
 
         citer = cycle(COLOR_SERIES)
         for i in idestruct:
             name = self.data.reactions[reactions[i]]
-            flt = abs(r[i, :]) > RATE_THRESHOLD
+            tp, ri = decimate(t, abs(r[i, :]), edges)
+            flt = ri > RATE_THRESHOLD
             label = "[%d] %s" % (reactions[i] + 1, name)
 
-            self.sourceWidget.removalAx.plot(self.data.t[flt],
-                                             abs(r[i, flt]),
+            self.sourceWidget.removalAx.plot(tp[flt],
+                                             ri[flt],
                                              c=citer.next(),
                                              lw=LINE_WIDTH,
                                              label=label,
                                              zorder=10)
 
-            self.sourceWidget.add_data(self.data.t, r[i, :], "- " + label)
+            self.sourceWidget.add_data(t, r[i, :], "- " + label)
 
         self.sourceWidget.creationAx.set_ylabel(
             "Production [cm$^\mathdefault{-3}$s$^\mathdefault{-1}$]")
@@ -347,6 +433,7 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
         QtGui.QApplication.restoreOverrideCursor()
 
 
+    @replots('reactWidget')
     def update_react_graph(self):
         """Updates the graph with reaction rates"""
         if not self.reactList.selectedItems():
@@ -361,19 +448,23 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
         QtGui.QApplication.setOverrideCursor(QtGui.QCursor(Qt.WaitCursor))
 
         citer = cycle(COLOR_SERIES)
+        window = self.reactWidget.zoom_window
+        t = self.data.t_window(window)
         for item in iter_2_selected(self.reactList):
             name = item[1]
-            rate = array(self.data.rate(item[0]))
+            tp, rate = self.decimated(self.reactWidget, 'rate', item[0])
             
             flt = rate > RATE_THRESHOLD
             label = "[%d] %s" % (item[0], name)
 
-            self.reactWidget.axes[0].plot(self.data.t[flt], rate[flt],
+            self.reactWidget.axes[0].plot(tp[flt], rate[flt],
                                           c=citer.next(),
                                           lw=LINE_WIDTH,
                                           label=label,
                                           zorder=10)
-            self.reactWidget.add_data(self.data.t, rate, label)
+            self.reactWidget.add_data(
+                t, lambda key=item[0]: self.data.rate(key, window=window),
+                label)
 
         self.reactWidget.set_scales(yscale='log', xscale=self.xscale)
             
@@ -417,6 +508,9 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
                                  max_dt=10e-3)
         self.update_lists()
 
+        # New timesteps are collected by data_update.
+        self.update_timer.start(UPDATE_INTERVAL)
+
 
     def import_from_directory(self):
         fname = QtGui.QFileDialog.getExistingDirectory(
@@ -428,8 +522,10 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
 
     def _import_from_directory(self, fname):
         try:
+            fname = unicode(fname)
             try:
-                self.data = DirectoryData(unicode(fname))
+                self.data = self.session.get(
+                    fname, lambda: DirectoryData(fname))
             except IOError as e:
                 em = QtGui.QErrorMessage(self)
                 em.setModal(True)
@@ -439,7 +535,8 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
                 # If we do not call exec_ here, two dialogs may appear at
                 # the same time, confusing the user.
                 em.exec_()
-                self.data = OldDirectoryData(unicode(fname))
+                self.data = self.session.get(
+                    fname, lambda: OldDirectoryData(fname))
 
             self.set_location(fname)
             self.update_lists()
@@ -471,7 +568,21 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
 
         # if a file is selected
         if fname:
-            self.data.save(unicode(fname))
+            dialog = QtGui.QProgressDialog("Saving...", QtCore.QString(),
+                                           0, 100, self)
+            dialog.setWindowModality(Qt.WindowModal)
+            dialog.setMinimumDuration(500)
+
+            def progress(fraction, message):
+                dialog.setLabelText(message)
+                dialog.setValue(int(100 * fraction))
+                QtGui.QApplication.processEvents()
+
+            # lzf is much faster than gzip and the files are only slightly
+            # larger.
+            self.data.save(unicode(fname), compression='lzf',
+                           progress=progress)
+            dialog.close()
     
 
     def export_data(self):
@@ -493,10 +604,23 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
             
     def action_set_logtime(self):
         for w in self.plot_widgets:
+            w.replotting = True
             w.set_scales(xscale=self.xscale, redraw=True)
+            w.replotting = False
 
     def load_h5file(self, file):
-        self.data = HDF5Data(file)
+        try:
+            self.data = self.session.get(file, lambda: HDF5Data(file))
+        except IOError:
+            # Maybe the file is still being written by a simulation.
+            self.data = self.session.get(file,
+                                         lambda: HDF5Data(file, swmr=True))
+
+        if self.data.swmr:
+            self.update_timer.start(UPDATE_INTERVAL)
+        else:
+            self.update_timer.stop()
+
         self.update_lists()
         self.clear()
         
@@ -534,6 +658,7 @@ class DesignerMainWindow(QtGui.QMainWindow, Ui_MainWindow):
         
     def clear(self):
         for w in self.plot_widgets:
+            w.reset_zoom()
             w.clear()
         
         
@@ -8,25 +8,23 @@ from collections import namedtuple
 
 from numpy import *
 import scipy.constants as co
+import h5py
 
 import config
 from modeldata import ResultsData
+from h5stream import StreamWriter
+from storage import ColumnStore
 from runner import run
+from zdplaskin import Kinetics
+from checkpoint import newest, discard, CHECKPOINT_SECONDS
+from fieldsource import open_source
+import protocol
+from transport import (open_receiver, TRANSPORTS, DEF_TRANSPORT,
+                       BATCH_STEPS, BATCH_MS)
 
 # Default name of the file to read densities from
 DEF_INIT_DENS_FILE = 'init_species.dat'
 
-tracked_conditions =  ['gas_temperature',
-                       'reduced_field',
-                       'reduced_frequency',
-                       'elec_temperature',
-                       'elec_drift_velocity',
-                       'elec_diff_coeff',
-                       'elec_frequency_n',
-                       'elec_power_n',
-                       'elec_power_elastic_n',
-                       'elec_power_inelastic_n']
-
 # This is an object class to simplify the storage and passing of
 # a simulation's results
 Results = namedtuple('Results', ['t',
@@ -37,59 +35,88 @@ Results = namedtuple('Results', ['t',
                                  'rates',
                                  'source_matrix'])
     
-def receiver(conn):
+def receiver(conn, dtype='d', max_bytes=None):
     """ This function receives data from the running process and collects it.
+    Densities, rates and conditions are stored with the given dtype and
+    spill to a temporary file beyond max_bytes (see storage.ColumnStore).
     """
 
-    # First we get t, the species list and the reactions list.
-    t, species, reactions, source_matrix = conn.recv()
-    n_species = len(species)
-    n_reactions = len(reactions)
-    
-    # With that info we can already initialize the storage arrays
-    density = zeros((t.shape[0], n_species))
-    rates = zeros((t.shape[0], n_reactions))
-    conditions = dict((cond, zeros(t.shape))
-                      for cond in tracked_conditions)
-    
-    # We will store sources in a list of dictionaries
-    # e.g. rrt[index('E')][index('E + O2 -> 2E + O2^+')]
-    # is the rate of creation of
-    # electrons due to that reaction.  Only reactions with some effect
-    # will appear as keys in the dictionary.
-    sources = [dict() for s in species]
-    try:
-        while True:
-            data = conn.recv()
-            if data is None:
-                # I have to do this bc conn.recv does not raise EOFError when
-                # the other end is closed
-                raise EOFError
-            
-            i, c_density, c_rates, c_conditions = data
-
-            density[i, :] = c_density
-            rates[i, :] = c_rates
+    # First we get t, the species and reactions lists and the source
+    # matrix (see protocol.py).
+    header = protocol.receive_header(conn)
+    layout = protocol.RecordLayout.from_header(header)
 
-            for k, a in conditions.iteritems():
-                a[i] = c_conditions[k]
+    # The run may end before the last time in the header or go beyond it,
+    # so the storage grows with the records received.
+    t = ColumnStore(1)
+    values = ColumnStore(layout.width - layout.values.start, dtype=dtype,
+                         max_bytes=max_bytes)
+    for block in open_receiver(conn, header):
+        t.append(block[:, 1:2])
+        values.append(block[:, layout.values])
 
-    except EOFError:
-        pass
+    density, rates, c = layout.split(values.data)
+    conditions = dict((cond, c[:, j])
+                      for j, cond in enumerate(header['conditions']))
 
-
-    res = Results(t=t,
-                  species=species,
-                  reactions=reactions,
+    res = Results(t=t.data[:, 0],
+                  species=header['species'],
+                  reactions=header['reactions'],
                   conditions=conditions,
                   density=density,
                   rates=rates,
-                  source_matrix=source_matrix)
+                  source_matrix=header['source_matrix'])
 
     
     return res
 
 
+def stream_receiver(conn, fname, compression='gzip', append=False,
+                    nrows=None):
+    """ Receives data from the running process and appends it to the HDF5
+    file fname as it arrives, so memory use does not grow with the length
+    of the run.  The file can be opened in SWMR mode while it is written.
+    With append, the data goes after the first nrows timesteps of an
+    existing file (see StreamWriter).
+    """
+    header = protocol.receive_header(conn)
+    layout = protocol.RecordLayout.from_header(header)
+    writer = StreamWriter(fname, header['species'], header['reactions'],
+                          header['conditions'], header['source_matrix'],
+                          compression=compression, append=append,
+                          nrows=nrows)
+    try:
+        for block in open_receiver(conn, header):
+            writer.append_block(block[:, 1], block[:, layout.density],
+                                block[:, layout.rates],
+                                block[:, layout.conditions])
+    finally:
+        writer.close()
+
+
+def find_restart(fname, checkpoint_dir):
+    """ Returns the newest checkpoint that the streamed output in fname has
+    reached, and its step, or (None, None) if there is none. """
+    try:
+        with h5py.File(fname, 'r', libver='latest', swmr=True) as f:
+            n = len(f['main/t'])
+    except (IOError, KeyError):
+        n = 0
+
+    state = newest(checkpoint_dir, max_step=n)
+    if state is None:
+        print "No checkpoint to restart from: starting from the beginning"
+        return None, None
+
+    step = int(state['step'])
+    print "Restarting from t = %g (step %d)" % (state['t'], step)
+    return state, step
+
+
+def print_progress(fraction, message):
+    print "[%3d%%] %s" % (int(100 * fraction), message)
+
+
 def main():
     global zdplaskin
     parser = OptionParser()
@@ -106,10 +133,87 @@ def main():
                       help=("Longest allowed dt."), 
                       type="float", default=inf)
 
+    parser.add_option("--follow", dest="follow",
+                      help=("The field profile (text or .npy) is still being "
+                            "written: wait for it to grow until it has not "
+                            "grown for this many seconds"),
+                      type="float", default=None)
+
     parser.add_option("-o", "--output", dest="output",
                       help="Output (HDF5) file", 
                       type="str", default='out.h5')
 
+    parser.add_option("--compression", dest="compression",
+                      help=("Compression of the output file: none, lzf, "
+                            "gzip, gzip-N or shuffle+gzip [%default]"),
+                      type="str", default='gzip')
+
+    parser.add_option("--stream", dest="stream", action="store_true",
+                      help=("Write each timestep to the output file as it is "
+                            "computed (the file can be opened while the "
+                            "simulation runs)"),
+                      default=False)
+
+    parser.add_option("--transport", dest="transport",
+                      help=("How timesteps are passed from the simulation: "
+                            "%s [%%default]" % ", ".join(TRANSPORTS)),
+                      type="choice", choices=list(TRANSPORTS),
+                      default=DEF_TRANSPORT)
+
+    parser.add_option("--batch-steps", dest="batch_steps",
+                      help=("Send timesteps in batches of up to this many "
+                            "[%default]"),
+                      type="int", default=BATCH_STEPS)
+
+    parser.add_option("--batch-ms", dest="batch_ms",
+                      help=("... or of those computed in this many "
+                            "milliseconds [%default]"),
+                      type="float", default=BATCH_MS)
+
+    parser.add_option("--single", dest="single", action="store_true",
+                      help=("Keep results in single precision while the "
+                            "simulation runs"),
+                      default=False)
+
+    parser.add_option("--max-memory", dest="max_memory",
+                      help=("Move results to a temporary file when they "
+                            "take more than this many MB"),
+                      type="float", default=None)
+
+    parser.add_option("--adaptive", dest="adaptive",
+                      action="store_true",
+                      help=("Adapt the substeps to the density changes "
+                            "instead of splitting long timesteps into equal "
+                            "substeps"),
+                      default=False)
+
+    parser.add_option("--max-change", dest="max_change",
+                      help=("Largest relative change of a density in an "
+                            "adaptive substep [%default]"),
+                      type="float", default=Kinetics.MAX_CHANGE)
+
+    parser.add_option("--min-dt", dest="min_dt",
+                      help="Shortest adaptive substep [%default]",
+                      type="float", default=Kinetics.MIN_SUBSTEP)
+
+    parser.add_option("--checkpoint-steps", dest="checkpoint_steps",
+                      help="Save a checkpoint every this many timesteps",
+                      type="int", default=None)
+
+    parser.add_option("--checkpoint-minutes", dest="checkpoint_minutes",
+                      help="Save a checkpoint every this many minutes",
+                      type="float", default=None)
+
+    parser.add_option("--checkpoint-dir", dest="checkpoint_dir",
+                      help=("Directory of the checkpoints "
+                            "[OUTPUT.checkpoints]"),
+                      type="str", default=None)
+
+    parser.add_option("--restart", dest="restart", action="store_true",
+                      help=("Continue from the newest checkpoint, appending "
+                            "to the output file"),
+                      default=False)
+
     (opts, args) = parser.parse_args()
 
 
@@ -119,22 +223,60 @@ def main():
 
 
     try:
-        field_file = args[0]
+        field = open_source(args[0], follow=opts.follow)
         species = args[1:]
     except IndexError:
         print ', '.join("'%s'" % s for s in modelspecies())
         sys.exit(0)
 
+    # Checkpoints are only useful with the output streamed to its file.
+    checkpoints, resume, nrows = None, None, None
+    if (opts.checkpoint_steps or opts.checkpoint_minutes is not None
+        or opts.restart):
+        opts.stream = True
+        checkpoint_dir = opts.checkpoint_dir or opts.output + '.checkpoints'
+        checkpoints = dict(dirname=checkpoint_dir,
+                           every_steps=opts.checkpoint_steps,
+                           every_seconds=(opts.checkpoint_minutes * 60
+                                          if opts.checkpoint_minutes
+                                          is not None
+                                          else CHECKPOINT_SECONDS))
+        if opts.restart:
+            resume, nrows = find_restart(opts.output, checkpoint_dir)
+
+        # Checkpoints after ours belong to an output that is lost.
+        discard(checkpoint_dir, after=nrows or 0)
+
     conn_recv, conn_send = Pipe(False)
     p = Process(target=run,
-                args=(conn_send, opts.kinetics, opts.init_dens_file, field_file),
-                kwargs=dict(max_dt=opts.max_dt))
+                args=(conn_send, opts.kinetics, opts.init_dens_file, field),
+                kwargs=dict(max_dt=opts.max_dt, transport=opts.transport,
+                            batch_steps=opts.batch_steps,
+                            batch_ms=opts.batch_ms,
+                            substepping=dict(adaptive=opts.adaptive,
+                                             max_change=opts.max_change,
+                                             min_dt=opts.min_dt),
+                            checkpoints=checkpoints, resume=resume))
 
     p.start()
-    
-    res = receiver(conn_recv)
+
+    if opts.stream:
+        try:
+            stream_receiver(conn_recv, opts.output,
+                            compression=opts.compression,
+                            append=resume is not None, nrows=nrows)
+        except:
+            # Otherwise the simulation would wait forever for us to read.
+            p.terminate()
+            raise
+        return
+
+    res = receiver(conn_recv, dtype='f' if opts.single else 'd',
+                   max_bytes=(opts.max_memory * 1024 * 1024
+                              if opts.max_memory is not None else None))
     data = ResultsData(res)
-    data.save(opts.output)
+    data.save(opts.output, compression=opts.compression,
+              progress=print_progress)
 
     #save(res, opts.output)
     
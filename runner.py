@@ -1,16 +1,46 @@
 from numpy import *
 
 from zdplaskin import Kinetics
+import protocol
+from fieldsource import open_source
+from checkpoint import CheckpointWriter
+from transport import open_sender, DEF_TRANSPORT, BATCH_STEPS, BATCH_MS
 
+# Each record also carries, as conditions, the substeps accepted and
+# rejected by controlled_timestep on the way to its time.
+SUBSTEP_COUNTS = ['substeps_accepted', 'substeps_rejected']
 
-def run(conn, model, init_file, field_file, max_dt=inf):
+# Arguments of Kinetics.set_config, unless run is given others.
+DEF_CONFIG = dict(stat_accum=True, atol=1e-8, rtol=1e-8,
+                  bolsig_ee_frac=0.0, silence_mode=True)
+
+
+def run(conn, model, init_file, field, max_dt=inf,
+        transport=DEF_TRANSPORT, batch_steps=BATCH_STEPS, batch_ms=BATCH_MS,
+        substepping=None, config=None, blocked=None, monitor=None,
+        checkpoints=None, resume=None):
+    """ Runs model with the field profile in field, a file name or a
+    fieldsource.FieldSource, and sends the results through conn.  The
+    profile is read as the run goes.  substepping holds keyword arguments for
+    Kinetics.set_substepping and config those for Kinetics.set_config
+    that differ from DEF_CONFIG.  The reactions with the (0-based) indices
+    in blocked are disabled.  monitor, if given, is called as
+    monitor(i, t, density) after each record is sent; the run stops when
+    it returns True.  checkpoints holds keyword arguments for a
+    checkpoint.CheckpointWriter that saves the state of the run.  With
+    resume, a checkpoint, the run continues from it and sends only the
+    records from there on. """
     if isinstance(model, str):
         model = Kinetics(model)
 
+    if substepping is not None:
+        model.set_substepping(**substepping)
+
     # Initialize zdplaskin
     model.init()
-    model.set_config(stat_accum=True, atol=1e-8, rtol=1e-8,
-                         bolsig_ee_frac=0.0, silence_mode=True)
+    model.set_config(**dict(DEF_CONFIG, **(config or {})))
+    if blocked is not None:
+        model.block_reactions(blocked)
     model.set_conditions(gas_temperature=200,
                              spec_heat_ratio=1.4,
                              reduced_field=1.0,
@@ -22,21 +52,49 @@ def run(conn, model, init_file, field_file, max_dt=inf):
     model.load_densities(init_file)
     model.truncate_densities()
 
-    # Loads the electric field profile
-    t, EN = loadtxt(field_file, unpack=True)
-    dt = t[1:] - t[:-1]
+    # The electric field profile, with a minimum field
+    source = open_source(field)
+
+    # The other end of the connection first wants the lists of species
+    # and reactions and the source matrix (see protocol.py).
+    header = protocol.make_header(None, model.SPECIES, model.REACTIONS,
+                                  model.get_stech_matrix(),
+                                  conditions=(protocol.TRACKED_CONDITIONS
+                                              + SUBSTEP_COUNTS))
+    layout = protocol.RecordLayout.from_header(header)
+    sender = open_sender(transport, conn, layout, batch_steps=batch_steps,
+                         batch_ms=batch_ms)
+    header.update(sender.header)
+    conn.send(header)
+
+    record = layout.empty()
+    conditions = protocol.TRACKED_CONDITIONS
+    counts = record[layout.conditions][len(conditions):]
+    counts[:] = 0
 
-    # Correct the field with a minimum field
-    min_EN = 1.0
-    EN = where(EN > min_EN, EN, min_EN)
+    start = 0
+    if resume is not None:
+        model.restore(resume)
+        start = int(resume['step'])
+        counts[:] = resume['counts']
 
-    # The other end of the connection wants first wants t, the list of species
-    # and the list of reactions
-    conn.send([t, model.SPECIES, model.REACTIONS, model.get_stech_matrix()])
+    writer = None
+    if checkpoints is not None:
+        writer = CheckpointWriter(**checkpoints)
+
+    # Models with a bulk interface (see Kinetics.snapshot) fill the record
+    # directly.
+    bulk = hasattr(model, 'snapshot')
+    fields = (record[layout.density], record[layout.rates],
+              record[layout.conditions][:len(conditions)])
 
     # This is the main loop:
-    for i, (it, idt, iEN) \
-            in enumerate(zip(t[:-1], dt, EN)):
+    for i, it, idt, iEN in source.steps(start):
+        if writer is not None and i > start and writer.due(i):
+            state = model.state()
+            state.update(step=i, t=it, counts=counts.copy())
+            writer.save(i, state)
+
         print "t = %g, E/N = %g Td" % (it, iEN)
 
         # model.set_conditions(reduced_field=iEN)
@@ -47,17 +105,27 @@ def run(conn, model, init_file, field_file, max_dt=inf):
                              gas_heating=False)
         model.truncate_densities()
 
-        
-        density = [model.get_density(s)
-                         for s in model.SPECIES]
-        rates = model.get_reaction_rates()
-
-        current_conditions = model.get_conditions()
-        
         # Send the present status to the other end of the connection
-        conn.send([i, density, rates, current_conditions])
-                
-        model.controlled_timestep(it, idt, max_dt)
+        if bulk:
+            record[0], record[1] = i, it
+            model.snapshot(it, conditions, out=fields)
+        else:
+            density = [model.get_density(s)
+                       for s in model.SPECIES]
+            rates = model.get_reaction_rates()
+            current_conditions = model.get_conditions()
+            layout.pack(record, i, it, density, rates,
+                        [current_conditions[k] for k in conditions]
+                        + list(counts))
+        sender.send(record)
+
+        if monitor is not None and monitor(i, it, fields[0]):
+            break
+
+        # Models without substep control return None.
+        counts[:] = model.controlled_timestep(it, idt, max_dt) or 0
 
-    conn.send(None)
+    sender.end()
     conn.close()
+    if writer is not None:
+        writer.close()
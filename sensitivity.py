@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+""" Sensitivity of a kinetic mechanism to each of its reactions.
+
+The mechanism is run once as it is (the baseline) and then once with each
+reaction, or group of reactions, disabled through lreaction_block.  The
+densities of some target species are sampled at some times and each
+knockout is ranked by the largest relative change of a sample with
+respect to the baseline.  The knockouts run in a pool of processes, one
+per core by default.
+
+A knockout run stops after the last sampled time or, with --threshold,
+as soon as a sample deviates from the baseline by more than the
+threshold: the reaction clearly matters and we need not know by how much.
+
+The results are kept in the 'sensitivity' group of an HDF5 file:
+
+  targets, times    the target species and the sampled times.
+  baseline          the (target x time) samples of the baseline.
+  groups            the reactions of each knockout, separated by GROUP_SEP.
+  values            the (knockout x target x time) samples, in single
+                    precision.  Those after an early exit are NaN.
+  effect            the largest relative change of each knockout, or NaN
+                    for those that have not finished.
+  diverged          whether the knockout exited early.
+
+Finished knockouts are skipped when the same study is run again.
+"""
+
+import os
+import sys
+import json
+from optparse import OptionParser
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import h5py
+
+from zdplaskin import Kinetics
+from runner import run
+from run_model import DEF_INIT_DENS_FILE
+from sweep import quiet_worker
+from fieldsource import open_source
+
+# Separator of the reactions of a group, in --groups files and in the
+# output.
+GROUP_SEP = ';'
+
+
+class NullConnection(object):
+    """ A connection that discards everything: a knockout run only needs
+    what its monitor samples. """
+
+    def send(self, obj):
+        pass
+
+
+    def send_bytes(self, buf):
+        pass
+
+
+    def close(self):
+        pass
+
+
+def relative_change(values, baseline, floor=Kinetics.DENSITY_FLOOR):
+    """ Returns the largest relative change between values and baseline,
+    ignoring the NaN samples.  Densities below floor count as floor. """
+    change = np.abs(values - baseline) / np.maximum(np.abs(baseline), floor)
+    change = change[~np.isnan(change)]
+    return change.max() if change.size else 0.0
+
+
+class Probe(object):
+    """ Monitor of runner.run that samples the densities of the species
+    with the given (0-based) indices at the given steps.  It stops the run
+    after the last step or, if a baseline and a threshold are given, when a
+    sample deviates from the baseline by more than threshold. """
+
+    def __init__(self, species, steps, baseline=None, threshold=None):
+        self.species = species
+        self.columns = {}
+        for k, i in enumerate(steps):
+            self.columns.setdefault(i, []).append(k)
+        self.last = max(steps)
+        self.baseline = baseline
+        self.threshold = threshold
+        self.values = np.full((len(species), len(steps)), np.nan)
+        self.diverged = False
+
+
+    def __call__(self, i, t, density):
+        columns = self.columns.get(i)
+        if columns is None:
+            return False
+
+        for k in columns:
+            self.values[:, k] = density[self.species]
+
+        if self.threshold is not None and self.baseline is not None:
+            if relative_change(self.values[:, columns],
+                               self.baseline[:, columns]) > self.threshold:
+                self.diverged = True
+                return True
+
+        return i >= self.last
+
+
+def run_probe(args):
+    """ Runs the model with the reactions in blocked disabled.  Returns j
+    and the probe after the run. """
+    j, kinetics, init_file, field_file, max_dt, blocked, probe = args
+    run(NullConnection(), kinetics, init_file, field_file, max_dt=max_dt,
+        batch_steps=1, blocked=blocked, monitor=probe)
+    return j, probe
+
+
+def read_groups(fname, reactions):
+    """ Reads groups of reactions, one group per line with the reactions
+    separated by GROUP_SEP. """
+    groups = []
+    with open(fname) as fp:
+        for line in fp:
+            group = [r.strip() for r in line.split('#')[0].split(GROUP_SEP)]
+            group = [r for r in group if r]
+            if not group:
+                continue
+            for r in group:
+                if r not in reactions:
+                    raise ValueError("Unknown reaction '%s' in %s"
+                                     % (r, fname))
+            groups.append(group)
+    return groups
+
+
+class SensitivityFile(object):
+    """ The HDF5 file of a study.  It is created unless it exists and
+    describes the same study, in which case it is opened to complete it. """
+
+    def __init__(self, fname, study, targets, times, groups,
+                 overwrite=False):
+        description = json.dumps(study, sort_keys=True)
+        str_dtype = h5py.special_dtype(vlen=str)
+
+        if os.path.exists(fname) and not overwrite:
+            self.f = h5py.File(fname, 'r+')
+            self.g = self.f['sensitivity']
+            if self.g.attrs['study'] != description:
+                self.f.close()
+                raise ValueError("%s holds the results of a different study"
+                                 % fname)
+            return
+
+        self.f = h5py.File(fname, 'w')
+        g = self.g = self.f.create_group('sensitivity')
+        g.attrs['study'] = description
+        g.create_dataset('targets', data=np.array(targets, dtype=object),
+                         dtype=str_dtype)
+        g.create_dataset('times', data=times)
+        g.create_dataset('groups',
+                         data=np.array([GROUP_SEP.join(group)
+                                        for group in groups], dtype=object),
+                         dtype=str_dtype)
+        g.create_dataset('values', shape=(len(groups), len(targets),
+                                          len(times)),
+                         dtype='f', fillvalue=np.nan)
+        g.create_dataset('effect', data=np.full(len(groups), np.nan))
+        g.create_dataset('diverged', data=np.zeros(len(groups), dtype=bool))
+
+
+    @property
+    def baseline(self):
+        if 'baseline' not in self.g:
+            return None
+        return np.array(self.g['baseline'])
+
+
+    def write_baseline(self, values):
+        self.g.create_dataset('baseline', data=values)
+        self.f.flush()
+
+
+    def pending(self):
+        return [int(j) for j in np.flatnonzero(np.isnan(self.g['effect'][:]))]
+
+
+    def write(self, j, probe):
+        self.g['values'][j] = probe.values
+        self.g['diverged'][j] = probe.diverged
+        # Only now is the knockout done.
+        self.g['effect'][j] = relative_change(probe.values, self.baseline)
+        self.f.flush()
+
+
+    def ranking(self):
+        """ Returns (effect, diverged, group) for the finished knockouts,
+        those with the largest effect first. """
+        r = [(e, d, group) for e, d, group
+             in zip(self.g['effect'][:], self.g['diverged'][:],
+                    self.g['groups'][:])
+             if not np.isnan(e)]
+        r.sort(key=lambda item: (item[1], item[0]), reverse=True)
+        return r
+
+
+    def close(self):
+        self.f.close()
+
+
+def sensitivity(kinetics, init_file, field_file, targets, times, fname,
+                groups=None, max_dt=np.inf, threshold=None, processes=None,
+                overwrite=False):
+    """ Runs a sensitivity study and returns the ranking of its file (see
+    SensitivityFile.ranking). """
+    model = Kinetics(kinetics)
+    species = [model.SPECIES_INDEX[s] for s in targets]
+    if groups is None:
+        groups = [[r] for r in model.REACTIONS]
+    blocked = [[model.REACTION_INDEX[r] for r in group] for group in groups]
+
+    # The probes sample the step closest to each time.  There is no record
+    # at the last time of the profile.
+    t = open_source(field_file).times()
+    steps = [min(int(np.abs(t - ti).argmin()), len(t) - 2) for ti in times]
+
+    study = {'kinetics': kinetics,
+             'init': os.path.abspath(init_file),
+             'field': os.path.abspath(field_file),
+             'targets': list(targets),
+             'steps': steps,
+             'max_dt': max_dt,
+             'threshold': threshold}
+    out = SensitivityFile(fname, study, targets, t[steps], groups,
+                          overwrite=overwrite)
+    try:
+        pool = Pool(processes or cpu_count(), initializer=quiet_worker,
+                    maxtasksperchild=1)
+        try:
+            if out.baseline is None:
+                print "Running the baseline"
+                _, probe = pool.apply(run_probe, [(None, kinetics, init_file,
+                                                   field_file, max_dt, [],
+                                                   Probe(species, steps))])
+                out.write_baseline(probe.values)
+
+            pending = out.pending()
+            print "%d of %d knockouts to run" % (len(pending), len(groups))
+            tasks = [(j, kinetics, init_file, field_file, max_dt, blocked[j],
+                      Probe(species, steps, out.baseline, threshold))
+                     for j in pending]
+            for k, (j, probe) in enumerate(pool.imap_unordered(run_probe,
+                                                               tasks)):
+                out.write(j, probe)
+                print "[%d/%d] %s" % (k + 1, len(pending),
+                                      GROUP_SEP.join(groups[j]))
+        finally:
+            pool.terminate()
+            pool.join()
+
+        return out.ranking()
+    finally:
+        out.close()
+
+
+def main():
+    parser = OptionParser(usage="%prog -k module -f FIELD -s SPECIES "
+                          "-t TIME [options]")
+    parser.add_option("-k", "--kinetics", dest="kinetics",
+                      help="Use this kinetic module",
+                      type="str", default=None)
+
+    parser.add_option("-i", "--initial-densities", dest="init_dens_file",
+                      help=("Read the initial densities from this file "
+                            "[%default]"),
+                      type="str", default=DEF_INIT_DENS_FILE)
+
+    parser.add_option("-f", "--field", dest="field",
+                      help="Field profile", type="str", default=None)
+
+    parser.add_option("-s", "--target", dest="targets", action="append",
+                      help="Target species (repeat for several)",
+                      type="str", default=[])
+
+    parser.add_option("-t", "--time", dest="times", action="append",
+                      help="Sampled time (repeat for several)",
+                      type="float", default=[])
+
+    parser.add_option("--groups", dest="groups",
+                      help=("Knock out the groups of reactions in this "
+                            "file, one per line separated by '%s', "
+                            "instead of each reaction" % GROUP_SEP),
+                      type="str", default=None)
+
+    parser.add_option("--max-dt", dest="max_dt",
+                      help="Longest allowed dt", type="float",
+                      default=np.inf)
+
+    parser.add_option("--threshold", dest="threshold",
+                      help=("Stop a run when a sample changes by more than "
+                            "this fraction"),
+                      type="float", default=None)
+
+    parser.add_option("-o", "--output", dest="output",
+                      help="Output (HDF5) file [%default]",
+                      type="str", default='sensitivity.h5')
+
+    parser.add_option("-j", "--processes", dest="processes",
+                      help="Number of simulations run at once [cores]",
+                      type="int", default=None)
+
+    parser.add_option("--top", dest="top",
+                      help="Print this many of the top reactions [%default]",
+                      type="int", default=20)
+
+    parser.add_option("--overwrite", dest="overwrite", action="store_true",
+                      help=("Overwrite the output file instead of "
+                            "completing it"),
+                      default=False)
+
+    (opts, args) = parser.parse_args()
+
+    if (opts.kinetics is None or opts.field is None or not opts.targets
+        or not opts.times):
+        parser.error("You need a kinetic module (-k), a field profile (-f) "
+                     "and at least one target species (-s) and time (-t).")
+
+    model = Kinetics(opts.kinetics)
+    for s in opts.targets:
+        if s not in model.SPECIES_INDEX:
+            parser.error("Unknown species '%s'" % s)
+
+    groups = None
+    if opts.groups is not None:
+        try:
+            groups = read_groups(opts.groups, model.REACTIONS)
+        except ValueError as e:
+            parser.error(str(e))
+
+    try:
+        ranking = sensitivity(opts.kinetics, opts.init_dens_file, opts.field,
+                              opts.targets, opts.times, opts.output,
+                              groups=groups, max_dt=opts.max_dt,
+                              threshold=opts.threshold,
+                              processes=opts.processes,
+                              overwrite=opts.overwrite)
+    except ValueError as e:
+        sys.stderr.write("%s (use --overwrite to overwrite it)\n" % e)
+        sys.exit(-1)
+
+    for effect, diverged, group in ranking[:opts.top]:
+        print "%10.3g %s %s" % (effect, '!' if diverged else ' ', group)
+
+
+if __name__ == '__main__':
+    main()
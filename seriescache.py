@@ -0,0 +1,64 @@
+""" A least-recently-used cache of time series, bounded by memory. """
+
+from collections import OrderedDict
+
+# Default memory budget of a cache, in bytes.
+DEF_MAX_BYTES = 256 * 1024 * 1024
+
+
+class SeriesCache(object):
+    """ Caches arrays under arbitrary keys (e.g. (group, index)) and evicts
+    the least recently used ones when their total size exceeds max_bytes.
+    The cached arrays are made read-only, as they are shared by all
+    callers. """
+
+    def __init__(self, max_bytes=DEF_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, key, loader):
+        """ Returns the array stored under key.  If it is not in the cache,
+        it is obtained by calling loader() and stored. """
+        try:
+            a = self.items.pop(key)
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            a = loader()
+            a.flags.writeable = False
+            self.nbytes += a.nbytes
+
+        # Re-inserting makes it the most recently used.
+        self.items[key] = a
+        self._evict()
+        return a
+
+
+    def __contains__(self, key):
+        return key in self.items
+
+
+    def _evict(self):
+        # We always keep at least the latest item, even if it is larger than
+        # the budget.
+        while self.nbytes > self.max_bytes and len(self.items) > 1:
+            _, a = self.items.popitem(last=False)
+            self.nbytes -= a.nbytes
+
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+
+
+    def stats(self):
+        """ Returns a dictionary with usage statistics. """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'items': len(self.items),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes}
@@ -0,0 +1,108 @@
+""" A cache of the datasets opened during a session.
+
+Switching between runs would otherwise read them again every time.  The
+datasets are kept in memory (least-recently-used first out) while they fit
+in a memory budget and while their files do not change.
+"""
+
+import os
+from collections import OrderedDict
+
+# Default memory budget of the cache, in bytes.
+DEF_MAX_BYTES = 1024 * 1024 * 1024
+
+# Number of paths remembered in the list of recent runs.
+MAX_RECENT = 10
+
+
+def identity(path):
+    """ Returns something that changes when the file, or any file in the
+    result directory, path is modified. """
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime
+
+    r = []
+    for name in sorted(os.listdir(path)):
+        # Hidden files include our own .qtplaskin_cache.
+        if name.startswith('.'):
+            continue
+        st = os.stat(os.path.join(path, name))
+        r.append((name, st.st_size, st.st_mtime))
+    return tuple(r)
+
+
+class SessionCache(object):
+    """ Keeps ModelData objects under the absolute path of their file or
+    directory.  A cached object is returned only if its path has not been
+    modified since it was loaded.  The least recently used ones are closed
+    and dropped when their memory_bytes() add up to more than max_bytes. """
+
+    def __init__(self, max_bytes=DEF_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.recent = []
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, path, loader):
+        """ Returns the data of path, calling loader() to load it if it is
+        not in the cache or it has changed. """
+        path = os.path.abspath(path)
+        ident = identity(path)
+
+        entry = self.items.pop(path, None)
+        if entry is not None and entry[0] == ident:
+            self.hits += 1
+            data = entry[1]
+        else:
+            if entry is not None:
+                entry[1].close()
+            self.misses += 1
+            data = loader()
+
+        self.items[path] = (ident, data)
+        self._remember(path)
+        self._evict()
+        return data
+
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self.items
+
+
+    def _remember(self, path):
+        if path in self.recent:
+            self.recent.remove(path)
+        self.recent.insert(0, path)
+        del self.recent[MAX_RECENT:]
+
+
+    @property
+    def nbytes(self):
+        # Cached datasets keep growing as their series are read, so we
+        # measure them every time.
+        return sum(data.memory_bytes() for _, data in self.items.itervalues())
+
+
+    def _evict(self):
+        # We always keep the latest item, which is the one on display.
+        while self.nbytes > self.max_bytes and len(self.items) > 1:
+            _, (_, data) = self.items.popitem(last=False)
+            data.close()
+
+
+    def clear(self):
+        for _, data in self.items.itervalues():
+            data.close()
+        self.items.clear()
+
+
+    def stats(self):
+        """ Returns a dictionary with usage statistics. """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'items': len(self.items),
+                'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes}
@@ -0,0 +1,75 @@
+""" Production and loss analysis from the stoichiometric (source) matrix. """
+
+import numpy as np
+from scipy import sparse
+
+
+class SourceEngine(object):
+    """ Keeps the species x reactions source matrix in sparse (CSR) form and
+    computes production, loss and net sources of any set of species with
+    sparse-dense products.  All indices here are 0-based.
+
+    Rate arrays are always (reactions x time), i.e. one row per reaction,
+    which is how ModelData.rate_block returns them. """
+
+    def __init__(self, source_matrix):
+        self.matrix = sparse.csr_matrix(np.asarray(source_matrix, dtype='d'))
+        self.matrix.eliminate_zeros()
+        self.n_species, self.n_reactions = self.matrix.shape
+
+        self.production = self._select(self.matrix.data > 0)
+        self.loss = self._select(self.matrix.data < 0)
+        self.loss.data *= -1
+
+
+    def _select(self, mask):
+        m = self.matrix.copy()
+        m.data = np.where(mask, m.data, 0.0)
+        m.eliminate_zeros()
+        return m
+
+
+    def row(self, si):
+        """ Returns the indices of the reactions that affect species si and
+        their stoichiometric coefficients. """
+        start, end = self.matrix.indptr[si], self.matrix.indptr[si + 1]
+        indices = self.matrix.indices[start:end]
+        order = np.argsort(indices)
+        return indices[order], self.matrix.data[start:end][order]
+
+
+    def reactions_of(self, species):
+        """ Returns the sorted indices of the reactions that affect any of
+        the given species. """
+        return np.unique(self.matrix[species, :].indices)
+
+
+    def _sub(self, m, species, reactions):
+        if species is not None:
+            m = m[species, :]
+        if reactions is not None:
+            m = m[:, reactions]
+        return m
+
+
+    def production_loss(self, rates, species=None, reactions=None):
+        """ Returns the production and loss rates, each a
+        (len(species) x n_t) array, of the given species (all if None).
+        rates contains the rates of the given reactions (all if None). """
+        p = self._sub(self.production, species, reactions).dot(rates)
+        l = self._sub(self.loss, species, reactions).dot(rates)
+        return np.asarray(p), np.asarray(l)
+
+
+    def net(self, rates, species=None, reactions=None):
+        """ Returns the net sources (production - loss) of the given
+        species. """
+        return np.asarray(self._sub(self.matrix, species,
+                                    reactions).dot(rates))
+
+
+    def totals(self, rates):
+        """ Returns production, loss and net sources of all species in one
+        pass over the (n_reactions x n_t) rates array. """
+        p, l = self.production_loss(rates)
+        return p, l, p - l
@@ -0,0 +1,286 @@
+""" Storage helpers for time series whose final length is not known in
+advance. """
+
+import os
+import atexit
+import tempfile
+
+import numpy as np
+
+
+class GrowingArray(object):
+    """ A 2D array that grows along its first axis.  Rows are appended into
+    a preallocated buffer whose capacity is doubled when it runs out, so the
+    cost of appending n rows is O(n) amortized. """
+
+    def __init__(self, ncols, dtype='d', initial_rows=1024):
+        self.ncols = ncols
+        self.n = 0
+        self.buf = np.empty((initial_rows, ncols), dtype=dtype)
+
+
+    @classmethod
+    def wrap(cls, array):
+        """ Creates a GrowingArray around existing rows (e.g. a memory-mapped
+        array) without copying them.  They are copied only when more rows
+        are appended. """
+        self = cls.__new__(cls)
+        self.ncols = array.shape[1]
+        self.n = array.shape[0]
+        self.buf = array
+        return self
+
+
+    @property
+    def data(self):
+        """ A view of the rows appended so far. """
+        return self.buf[:self.n]
+
+
+    def __len__(self):
+        return self.n
+
+
+    def reserve(self, nrows):
+        """ Makes sure that there is room for at least nrows rows. """
+        capacity = self.buf.shape[0]
+        if nrows <= capacity:
+            return
+
+        while capacity < nrows:
+            capacity = max(2 * capacity, 1)
+
+        new_buf = np.empty((capacity, self.ncols), dtype=self.buf.dtype)
+        new_buf[:self.n] = self.buf[:self.n]
+        self.buf = new_buf
+
+
+    def append(self, block):
+        """ Appends a block of rows (or a single row). """
+        block = np.atleast_2d(block)
+        if block.shape[1] != self.ncols:
+            raise ValueError("Expected %d columns, got %d"
+                             % (self.ncols, block.shape[1]))
+
+        m = block.shape[0]
+        self.reserve(self.n + m)
+        self.buf[self.n:self.n + m] = block
+        self.n += m
+
+
+    def clear(self):
+        self.n = 0
+
+
+# We reserve a fixed size for the headers of the .npy files that we write.
+# That way the shape in the header can be rewritten in place when rows are
+# appended to the file.
+NPY_HEADER_SIZE = 128
+
+
+def _npy_header(shape, dtype):
+    header = ("{'descr': %r, 'fortran_order': False, 'shape': (%s), }"
+              % (np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                 ''.join('%d, ' % n for n in shape)))
+    prefix = np.lib.format.magic(1, 0)
+    pad = NPY_HEADER_SIZE - len(prefix) - 2 - len(header) - 1
+    if pad < 0:
+        raise ValueError("Shape %r does not fit in the .npy header"
+                         % (shape,))
+
+    header = header + ' ' * pad + '\n'
+    return (prefix + np.array([len(header)], dtype='<u2').tostring()
+            + header.encode('latin1'))
+
+
+class NpyAppender(object):
+    """ Writes a 2D .npy file row block by row block.  The file is always a
+    valid .npy file that can be memory-mapped with np.load(mmap_mode='r'). """
+
+    def __init__(self, fname, ncols, dtype='d', append=False, nrows=None):
+        self.fname = fname
+        self.ncols = ncols
+        self.dtype = np.dtype(dtype)
+
+        if append and os.path.exists(fname):
+            self.fp = open(fname, 'r+b')
+            self.fp.seek(0, os.SEEK_END)
+            nbytes = self.fp.tell() - NPY_HEADER_SIZE
+            self.nrows = nbytes // (self.ncols * self.dtype.itemsize)
+            if nrows is not None and nrows < self.nrows:
+                # Drop rows written after the ones that we trust.
+                self.nrows = nrows
+                self.fp.truncate(self.end)
+        else:
+            # An old file may still be memory-mapped somewhere, so we
+            # replace it instead of truncating it.
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+
+            self.fp = open(fname, 'w+b')
+            self.nrows = 0
+            self._write_header()
+
+
+    def _write_header(self):
+        self.fp.seek(0)
+        self.fp.write(_npy_header((self.nrows, self.ncols), self.dtype))
+
+
+    @property
+    def end(self):
+        """ Offset in the file of the end of the last row. """
+        return NPY_HEADER_SIZE + self.nrows * self.ncols * self.dtype.itemsize
+
+
+    def append(self, block):
+        """ Appends a block of rows. """
+        block = np.ascontiguousarray(block, dtype=self.dtype)
+        self.fp.seek(self.end)
+        self.fp.write(block.tostring())
+        self.nrows += block.shape[0]
+
+
+    def flush(self):
+        """ Updates the header and flushes the file, so that it can be read
+        while we keep appending to it. """
+        self._write_header()
+        self.fp.flush()
+
+
+    def close(self):
+        self._write_header()
+        self.fp.close()
+
+
+class MappedArray(object):
+    """ A 2D array that grows along its first axis, like GrowingArray, but
+    lives in a .npy file on disk.  data is a read-only memory map, so the
+    memory used does not depend on the number of rows. """
+
+    def __init__(self, fname, ncols, dtype='d', append=False, nrows=None):
+        self.ncols = ncols
+        self.npy = NpyAppender(fname, ncols, dtype=dtype, append=append,
+                               nrows=nrows)
+        self.map = None
+
+
+    @property
+    def fname(self):
+        return self.npy.fname
+
+
+    @property
+    def n(self):
+        return self.npy.nrows
+
+
+    @property
+    def data(self):
+        """ A memory map of the rows appended so far. """
+        if self.n == 0:
+            return np.zeros((0, self.ncols), dtype=self.npy.dtype)
+
+        if self.map is None or self.map.shape[0] != self.n:
+            self.npy.flush()
+            self.map = np.memmap(self.fname, dtype=self.npy.dtype, mode='r',
+                                 offset=NPY_HEADER_SIZE,
+                                 shape=(self.n, self.ncols))
+        return self.map
+
+
+    def __len__(self):
+        return self.n
+
+
+    def append(self, block):
+        """ Appends a block of rows (or a single row). """
+        block = np.atleast_2d(block)
+        if block.shape[1] != self.ncols:
+            raise ValueError("Expected %d columns, got %d"
+                             % (self.ncols, block.shape[1]))
+
+        self.npy.append(block)
+
+
+    def flush(self):
+        self.npy.flush()
+
+
+    def close(self):
+        self.map = None
+        self.npy.close()
+
+
+class ColumnStore(object):
+    """ Rows of a fixed number of columns for runs of unknown length.  Rows
+    are kept in a GrowingArray until they would take more than max_bytes;
+    then they are moved to a MappedArray in a file in spill_dir (the
+    temporary directory by default) and later rows are appended there.
+    data is always a view of all the rows, without copies.  With
+    dtype='f' the rows take half the memory. """
+
+    def __init__(self, ncols, dtype='d', max_bytes=None, spill_dir=None,
+                 initial_rows=1024):
+        self.ncols = ncols
+        self.dtype = np.dtype(dtype)
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.table = GrowingArray(ncols, dtype=dtype,
+                                  initial_rows=initial_rows)
+        self.spill = None
+
+
+    @property
+    def data(self):
+        return self.table.data
+
+
+    def __len__(self):
+        return len(self.table)
+
+
+    @property
+    def spilled(self):
+        return self.spill is not None
+
+
+    def append(self, block):
+        """ Appends a block of rows (or a single row). """
+        block = np.atleast_2d(block)
+        if (not self.spilled and self.max_bytes is not None and
+            (len(self) + block.shape[0]) * self.ncols * self.dtype.itemsize
+            > self.max_bytes):
+            self._spill()
+
+        self.table.append(block)
+
+
+    def _spill(self):
+        fd, self.spill = tempfile.mkstemp(prefix='qtplaskin-', suffix='.npy',
+                                          dir=self.spill_dir)
+        os.close(fd)
+        atexit.register(_remove, self.spill)
+
+        table = MappedArray(self.spill, self.ncols, dtype=self.dtype)
+        table.append(self.table.data)
+        self.table = table
+
+
+    def close(self):
+        """ Drops the rows and removes the spill file, if any. """
+        if self.spilled:
+            self.table.close()
+            _remove(self.spill)
+            self.spill = None
+
+        self.table = GrowingArray(self.ncols, dtype=self.dtype)
+
+
+def _remove(fname):
+    try:
+        os.remove(fname)
+    except OSError:
+        pass
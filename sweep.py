@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+""" Runs a kinetic module over a grid of cases and stores all the results
+in a single HDF5 file.
+
+Each case is a combination of a field profile, an initial densities file,
+a max_dt and a set of options for Kinetics.set_config.  The grid is the
+product of the values given for each of them, e.g.
+
+  sweep.py -k mymodule -f pulse1.dat -f pulse2.dat -i air.dat \\
+      --max-dt 1e-9 --max-dt 1e-10 --config atol=1e-10 -o sweep.h5
+
+runs four cases.  The cases run in a pool of processes, one per core by
+default.  The output file has a 'sweep' group with
+
+  cases          the JSON description of every case.
+  n_t            the number of timesteps of each case, or -1 for the
+                 cases that have not finished.
+  species, reactions, conditions
+                 the names of the items, as in the matrix layout of
+                 ModelData.save.
+  source_matrix  the (species x reactions) stoichiometric matrix.
+  t              a (case x time) dataset.
+  density, rate, condition
+                 (case x time x item) datasets.
+
+Cases shorter than the longest one are padded with NaN.  A case is marked
+as finished in n_t only after its data is written, so if the sweep is
+interrupted, running it again with the same grid runs only the missing
+cases.  A case that fails is reported and left pending.
+"""
+
+import os
+import sys
+import json
+import itertools
+import threading
+import traceback
+from optparse import OptionParser
+from multiprocessing import Pool, Pipe, cpu_count
+
+import numpy as np
+import h5py
+
+from runner import run
+from run_model import receiver, Results, DEF_INIT_DENS_FILE
+from modeldata import DEF_COMPRESSION, compression_options
+
+# Rows per chunk in the time axis.  Chunks hold a single case and item.
+SWEEP_CHUNK_ROWS = 4096
+
+
+def make_grid(fields, inits, max_dts, configs):
+    """ Returns the list of cases of the product of the given values. """
+    return [{'field': os.path.abspath(field),
+             'init': os.path.abspath(init),
+             'max_dt': max_dt,
+             'config': config}
+            for field, init, max_dt, config
+            in itertools.product(fields, inits, max_dts, configs)]
+
+
+def parse_config(s):
+    """ Parses a comma-separated list of KEY=VALUE options for
+    Kinetics.set_config. """
+    config = {}
+    for item in s.split(','):
+        key, _, value = item.partition('=')
+        if not value:
+            raise ValueError("Expected KEY=VALUE in '%s'" % item)
+
+        if value.lower() in ('true', 'false'):
+            config[key.strip()] = (value.lower() == 'true')
+        else:
+            config[key.strip()] = float(value)
+    return config
+
+
+def quiet_worker():
+    # runner.run reports every step.
+    sys.stdout = open(os.devnull, 'w')
+
+
+def run_case(args):
+    """ Runs case number i in this process.  Returns i, its Results and
+    None or, if the case failed, i, None and the traceback. """
+    i, kinetics, case = args
+    conn_recv, conn_send = Pipe(False)
+    errors = []
+
+    def target():
+        try:
+            run(conn_send, kinetics, case['init'], case['field'],
+                max_dt=case['max_dt'], config=case['config'])
+        except:
+            errors.append(traceback.format_exc())
+            # The receiver then gets EOF instead of waiting forever.
+            conn_send.close()
+
+    # The receiver keeps the pipe drained while the model runs.
+    thread = threading.Thread(target=target)
+    thread.start()
+    res = None
+    try:
+        res = receiver(conn_recv)
+    except:
+        if not errors:
+            errors.append(traceback.format_exc())
+        # And the model fails when it sends again.
+        conn_recv.close()
+    thread.join()
+
+    if errors:
+        return i, None, errors[0]
+    return i, res, None
+
+
+class SweepFile(object):
+    """ The HDF5 file of a sweep.  If it exists and holds the same cases, it
+    is opened to complete it; otherwise it is created, unless it holds
+    other cases and overwrite is false. """
+
+    def __init__(self, fname, cases, compression=DEF_COMPRESSION,
+                 overwrite=False):
+        self.compression = compression
+        descriptions = [json.dumps(case, sort_keys=True) for case in cases]
+
+        if os.path.exists(fname) and not overwrite:
+            self.f = h5py.File(fname, 'r+')
+            self.g = self.f['sweep']
+            if list(self.g['cases']) != descriptions:
+                self.f.close()
+                raise ValueError("%s holds the results of a different sweep"
+                                 % fname)
+        else:
+            self.f = h5py.File(fname, 'w')
+            self.g = self.f.create_group('sweep')
+            self.g.create_dataset('cases',
+                                  data=np.array(descriptions, dtype=object),
+                                  dtype=h5py.special_dtype(vlen=str))
+            self.g.create_dataset('n_t', data=np.full(len(cases), -1, 'i'))
+
+        self.n_t = self.g['n_t']
+
+
+    def pending(self):
+        """ Returns the indices of the cases that have not finished. """
+        return [int(i) for i in np.flatnonzero(self.n_t[:] < 0)]
+
+
+    def _create(self, res):
+        g = self.g
+        n_cases = len(self.n_t)
+        str_dtype = h5py.special_dtype(vlen=str)
+
+        g.create_dataset('t', shape=(n_cases, 0), maxshape=(n_cases, None),
+                         dtype='d', chunks=(1, SWEEP_CHUNK_ROWS),
+                         fillvalue=np.nan)
+        g.create_dataset('source_matrix', data=res.source_matrix)
+
+        for name, names_name, names in (
+                ('condition', 'conditions', res.conditions.keys()),
+                ('density', 'species', res.species),
+                ('rate', 'reactions', res.reactions)):
+            g.create_dataset(names_name, data=np.array(names, dtype=object),
+                             dtype=str_dtype)
+            n = len(names)
+            g.create_dataset(name, shape=(n_cases, 0, n),
+                             maxshape=(n_cases, None, n), dtype='d',
+                             chunks=(1, SWEEP_CHUNK_ROWS, 1),
+                             fillvalue=np.nan,
+                             **compression_options(self.compression))
+
+
+    def write(self, i, res):
+        """ Writes the Results of case i and marks it as finished. """
+        g = self.g
+        if 't' not in g:
+            self._create(res)
+
+        if (list(g['species']) != list(res.species)
+            or list(g['reactions']) != list(res.reactions)):
+            raise ValueError("All the cases of a sweep must use the same "
+                             "species and reactions")
+
+        n = len(res.t)
+        if n > g['t'].shape[1]:
+            for name in ('t', 'density', 'rate', 'condition'):
+                shape = list(g[name].shape)
+                shape[1] = n
+                g[name].resize(shape)
+
+        conditions = np.column_stack([res.conditions[k]
+                                      for k in g['conditions']])
+        g['t'][i, :n] = res.t
+        g['density'][i, :n] = res.density
+        g['rate'][i, :n] = res.rates
+        g['condition'][i, :n] = conditions.reshape((n, -1))
+
+        # Only now is the case done.
+        self.n_t[i] = n
+        self.f.flush()
+
+
+    def close(self):
+        self.f.close()
+
+
+def read_case(fname, i):
+    """ Returns the Results of case i in the sweep file fname. """
+    with h5py.File(fname, 'r') as f:
+        g = f['sweep']
+        n = g['n_t'][i]
+        if n < 0:
+            raise ValueError("Case %d of %s has not finished" % (i, fname))
+
+        c = g['condition'][i, :n]
+        return Results(t=g['t'][i, :n],
+                       species=list(g['species']),
+                       reactions=list(g['reactions']),
+                       conditions=dict((k, c[:, j]) for j, k
+                                       in enumerate(g['conditions'])),
+                       density=g['density'][i, :n],
+                       rates=g['rate'][i, :n],
+                       source_matrix=np.array(g['source_matrix']))
+
+
+def sweep(kinetics, cases, fname, processes=None, compression=DEF_COMPRESSION,
+          overwrite=False):
+    """ Runs the cases that are not yet in fname.  Returns the indices of
+    the cases that failed. """
+    out = SweepFile(fname, cases, compression=compression,
+                    overwrite=overwrite)
+    failed = []
+    try:
+        pending = out.pending()
+        print "%d of %d cases to run" % (len(pending), len(cases))
+        if not pending:
+            return failed
+
+        # A kinetic module cannot be initialized twice in the same process,
+        # so each case gets a fresh worker.
+        pool = Pool(processes or cpu_count(), initializer=quiet_worker,
+                    maxtasksperchild=1)
+        try:
+            tasks = [(i, kinetics, cases[i]) for i in pending]
+            for k, (i, res, error) in enumerate(
+                    pool.imap_unordered(run_case, tasks)):
+                if error is not None:
+                    failed.append(i)
+                    sys.stderr.write(error)
+                    print "[%d/%d] Case %d failed: %s" % (
+                        k + 1, len(pending), i, json.dumps(cases[i]))
+                    continue
+
+                out.write(i, res)
+                print "[%d/%d] Case %d finished: %s" % (
+                    k + 1, len(pending), i, json.dumps(cases[i]))
+        finally:
+            pool.terminate()
+            pool.join()
+    finally:
+        out.close()
+
+    if failed:
+        print "%d cases failed and are still pending" % len(failed)
+    return failed
+
+
+def main():
+    parser = OptionParser(usage="%prog -k module -f FIELD [options]")
+    parser.add_option("-k", "--kinetics", dest="kinetics",
+                      help="Use this kinetic module",
+                      type="str", default=None)
+
+    parser.add_option("-f", "--field", dest="fields", action="append",
+                      help="Field profile (repeat for several)",
+                      type="str", default=[])
+
+    parser.add_option("-i", "--initial-densities", dest="inits",
+                      action="append",
+                      help=("Initial densities file (repeat for several) "
+                            "[%s]" % DEF_INIT_DENS_FILE),
+                      type="str", default=[])
+
+    parser.add_option("--max-dt", dest="max_dts", action="append",
+                      help="Longest allowed dt (repeat for several)",
+                      type="float", default=[])
+
+    parser.add_option("--config", dest="configs", action="append",
+                      help=("Options of set_config as KEY=VALUE,... "
+                            "(repeat for several)"),
+                      type="str", default=[])
+
+    parser.add_option("-o", "--output", dest="output",
+                      help="Output (HDF5) file [%default]",
+                      type="str", default='sweep.h5')
+
+    parser.add_option("--compression", dest="compression",
+                      help="Compression of the output file [%default]",
+                      type="str", default=DEF_COMPRESSION)
+
+    parser.add_option("-j", "--processes", dest="processes",
+                      help="Number of simulations run at once [cores]",
+                      type="int", default=None)
+
+    parser.add_option("--overwrite", dest="overwrite", action="store_true",
+                      help=("Overwrite the output file instead of "
+                            "completing it"),
+                      default=False)
+
+    (opts, args) = parser.parse_args()
+
+    if opts.kinetics is None or not opts.fields:
+        parser.error("You need to specify a kinetic module with -k module "
+                     "and at least one field profile with -f.")
+
+    try:
+        configs = [parse_config(c) for c in opts.configs]
+    except ValueError as e:
+        parser.error(str(e))
+
+    cases = make_grid(opts.fields,
+                      opts.inits or [DEF_INIT_DENS_FILE],
+                      opts.max_dts or [np.inf],
+                      configs or [{}])
+
+    try:
+        failed = sweep(opts.kinetics, cases, opts.output,
+                       processes=opts.processes,
+                       compression=opts.compression,
+                       overwrite=opts.overwrite)
+    except ValueError as e:
+        sys.stderr.write("%s (use --overwrite to overwrite it)\n" % e)
+        sys.exit(-1)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+""" Tests of sweep.py with the fake kinetic module of bench_substeps. """
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import bench_substeps
+import sweep
+
+KINETICS = 'test_sweep_kinetics'
+
+
+def install_kinetics():
+    """ Registers a fake kinetic module that the pool workers inherit. """
+    mech, _ = bench_substeps.two_reactions()
+    mod = bench_substeps.kinetic_module(mech)
+    mod.zdplaskin.zdplaskin_reac_source_matrix = lambda r: mech.net * r
+    sys.modules[KINETICS] = mod
+
+
+class TestSweep(unittest.TestCase):
+    def setUp(self):
+        install_kinetics()
+        self.dirname = tempfile.mkdtemp(prefix='test_sweep')
+        self.init = self._path('init.dat')
+        with open(self.init, 'w') as fp:
+            fp.write("e 1\nAr 2.5e19\nAr^+ 1\n")
+
+        self.field = self._path('field.dat')
+        t = np.linspace(0, 1e-8, 11)
+        np.savetxt(self.field, np.c_[t, np.full_like(t, 100.0)])
+        self.output = self._path('sweep.h5')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+
+    def _path(self, fname):
+        return os.path.join(self.dirname, fname)
+
+
+    def test_failing_case(self):
+        # The second case has no initial densities file.
+        cases = sweep.make_grid([self.field],
+                                [self.init, self._path('missing.dat')],
+                                [np.inf], [{}])
+        failed = sweep.sweep(KINETICS, cases, self.output, processes=1)
+        self.assertEqual(failed, [1])
+
+        out = sweep.SweepFile(self.output, cases)
+        try:
+            self.assertEqual(out.pending(), [1])
+        finally:
+            out.close()
+
+        res = sweep.read_case(self.output, 0)
+        self.assertEqual(len(res.t), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
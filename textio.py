@@ -0,0 +1,205 @@
+""" Reading of the numeric tables (qt_*.txt) written by ZdPlasKin. """
+
+import os
+from io import BytesIO
+
+import numpy as np
+
+from storage import GrowingArray, MappedArray
+from compressed import open_file, is_compressed
+
+
+# Tables are read in binary chunks of this size.  Each chunk is converted to
+# numbers in a single call, without going line by line through python.
+CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def parse_block(chunk, ncols=None):
+    """ Converts a string of complete lines of whitespace-separated numbers
+    into a 2D array.  If ncols is None it is taken from the first line.
+    Falls back to np.loadtxt (which also gives better error messages) if the
+    block is not a plain table. """
+    if ncols is None:
+        ncols = len(chunk[:chunk.index(b'\n')].split())
+
+    values = np.fromstring(chunk, sep=' ')
+    nrows = chunk.count(b'\n')
+    if ncols > 0 and values.size == nrows * ncols:
+        return values.reshape((nrows, ncols))
+
+    return np.loadtxt(BytesIO(chunk), ndmin=2)
+
+
+def read_table(fname, skiprows=0, chunk_size=CHUNK_SIZE):
+    """ Reads a whole table.  This is a faster replacement of np.loadtxt
+    for the qt_*.txt files. """
+    reader = TailReader(fname, skiprows=skiprows, chunk_size=chunk_size)
+    reader.update()
+    return reader.data
+
+
+def _stamp(fname):
+    st = os.stat(fname)
+    return st.st_size, st.st_mtime
+
+
+def _same_file(a, b):
+    return (a is not None and os.path.exists(a) and os.path.exists(b)
+            and os.path.samefile(a, b))
+
+
+class TailReader(object):
+    """ Incrementally reads a whitespace-separated numeric table that may
+    still be growing (e.g. while ZdPlasKin is running).  The reader remembers
+    how many bytes it has already parsed and on each call to update() reads
+    only the complete lines appended since then.  A half-written last line
+    is left for the next call.  Compressed files (see compressed.py) are
+    read whole, and read again only if they change.
+
+    If spill is the name of a .npy file, the parsed rows are written there
+    instead of being kept in memory and data is a memory map of that file.
+    Then no more than about chunk_size bytes are held in memory at any time,
+    however long the table is. """
+
+    def __init__(self, fname, skiprows=0, chunk_size=CHUNK_SIZE, spill=None):
+        self.fname = fname
+        self.skiprows = skiprows
+        self.chunk_size = chunk_size
+        self.spill = spill
+        self.compressed = is_compressed(fname)
+        self.reset()
+
+
+    def reset(self):
+        """ Forgets everything read so far. """
+        self.offset = 0
+        self.skipped = 0
+        self.table = None
+        self.stamp = None
+
+
+    def restore(self, array, offset, skipped):
+        """ Continues from rows previously read (e.g. from a cache) that
+        correspond to the first offset bytes of the file.  For a compressed
+        file they must be the rows of the whole file. """
+        if array.shape[0] == 0:
+            self.table = None
+        elif self.spill is None:
+            self.table = GrowingArray.wrap(array)
+        elif _same_file(getattr(array, 'filename', None), self.spill):
+            # The rows are already in our spill file: keep appending there.
+            self.table = MappedArray(self.spill, array.shape[1],
+                                     dtype=array.dtype, append=True,
+                                     nrows=array.shape[0])
+        else:
+            self.table = MappedArray(self.spill, array.shape[1],
+                                     dtype=array.dtype)
+            step = max(1, self.chunk_size // array[0].nbytes)
+            for i in xrange(0, array.shape[0], step):
+                self.table.append(array[i:i + step])
+
+        self.offset = offset
+        self.skipped = skipped
+        if self.compressed:
+            self.stamp = _stamp(self.fname)
+
+
+    @property
+    def data(self):
+        """ The rows read so far, as a 2D array. """
+        if self.table is None:
+            return np.zeros((0, 0))
+
+        return self.table.data
+
+
+    def update(self):
+        """ Reads new complete lines from the file.  Returns the number of
+        rows appended. """
+        if self.compressed:
+            return self._update_compressed()
+
+        with open(self.fname, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size < self.offset:
+                # The file has been truncated or re-created: start again.
+                self.reset()
+
+            fp.seek(self.offset)
+            return self._parse(fp, size - self.offset)
+
+
+    def _update_compressed(self):
+        # A compressed file is an archive that does not grow: we parse it
+        # whole and again only if it is replaced.
+        stamp = _stamp(self.fname)
+        if stamp == self.stamp:
+            return 0
+
+        self.reset()
+        fp = open_file(self.fname)
+        try:
+            nrows = self._parse(fp, None)
+        finally:
+            fp.close()
+
+        self.stamp = stamp
+        return nrows
+
+
+    def _parse(self, fp, nbytes):
+        """ Parses the complete lines in the next nbytes bytes of fp, or up
+        to the end of the file if nbytes is None. """
+        nrows = 0
+        read = 0
+        rest = b''
+        while nbytes is None or read < nbytes:
+            new = fp.read(self.chunk_size if nbytes is None
+                          else min(self.chunk_size, nbytes - read))
+            if not new:
+                break
+
+            read += len(new)
+            chunk = rest + new
+            end = chunk.rfind(b'\n')
+            if end < 0:
+                # Not even one complete line yet.
+                rest = chunk
+                continue
+
+            rest = chunk[end + 1:]
+            chunk = chunk[:end + 1]
+            self.offset += len(chunk)
+            nrows += self._append(self._skip_header(chunk))
+
+        if nbytes is None and rest.strip():
+            # The last line of a finished file may lack its newline.
+            self.offset += len(rest)
+            nrows += self._append(self._skip_header(rest + b'\n'))
+
+        return nrows
+
+
+    def _skip_header(self, chunk):
+        start = 0
+        while self.skipped < self.skiprows and start < len(chunk):
+            start = chunk.index(b'\n', start) + 1
+            self.skipped += 1
+
+        return chunk[start:]
+
+
+    def _append(self, chunk):
+        if not chunk.strip():
+            return 0
+
+        ncols = self.table.ncols if self.table is not None else None
+        block = parse_block(chunk, ncols)
+        if self.table is None and self.spill is not None:
+            self.table = MappedArray(self.spill, block.shape[1])
+        elif self.table is None:
+            self.table = GrowingArray(block.shape[1],
+                                      initial_rows=max(1024, block.shape[0]))
+
+        self.table.append(block)
+        return block.shape[0]
@@ -0,0 +1,273 @@
+""" Transports of the records of a running simulation (see protocol.py)
+from the simulation process to its receiver.
+
+  'pipe'  The records are sent through the connection with send_bytes.
+  'shm'   The records are written into a ring buffer in shared memory.
+          Only short notifications go through the connection, and only
+          when the receiver has caught up with the previous one.  This
+          saves pushing every record through the pipe, which dominates
+          when the timesteps are short.
+
+Python 2 has no multiprocessing.shared_memory, so the ring is a file in
+/dev/shm (or in the temporary directory where there is no /dev/shm) that
+both processes memory-map.  The sender creates it and puts its name in the
+header; the receiver maps it and removes its name.
+
+A sender is created with open_sender and adds its fields to the header.
+Senders batch records (see Batcher) to send fewer, larger messages.
+A receiver is created from the header with open_receiver; its receive()
+returns a block of records, or None at the end of the run.
+"""
+
+import os
+import mmap
+import time
+import tempfile
+
+import numpy as np
+
+import protocol
+
+TRANSPORTS = ('pipe', 'shm')
+DEF_TRANSPORT = 'pipe'
+
+# Size of the ring buffer.  If the receiver falls this much behind, the
+# sender waits.  A small ring stays in the CPU caches.
+RING_BYTES = 4 * 1024 * 1024
+
+# The ring starts with the counts of records written by the sender and
+# read by the receiver.
+RING_OFFSET = 64
+WRITTEN, READ = 0, 1
+
+# Seconds between checks of the ring while it is full.
+RING_WAIT = 0.001
+
+
+# Records are sent in batches of up to BATCH_STEPS records, or whatever
+# has been collected after BATCH_MS milliseconds.
+BATCH_STEPS = 64
+BATCH_MS = 100
+
+
+def open_sender(transport, conn, layout, batch_steps=BATCH_STEPS,
+                batch_ms=BATCH_MS, **kwargs):
+    """ Returns a sender of records.  Unless batch_steps is 1, records are
+    batched. """
+    if transport == 'pipe':
+        sender = PipeSender(conn, layout)
+    elif transport == 'shm':
+        sender = RingSender(conn, layout, **kwargs)
+    else:
+        raise ValueError("Unknown transport '%s' (use one of %s)"
+                         % (transport, ', '.join(TRANSPORTS)))
+
+    if batch_steps > 1:
+        sender = Batcher(sender, batch_steps, batch_ms)
+
+    return sender
+
+
+def open_receiver(conn, header):
+    layout = protocol.RecordLayout.from_header(header)
+    transport = header.get('transport', 'pipe')
+    if transport == 'pipe':
+        return PipeReceiver(conn, layout)
+    if transport == 'shm':
+        return RingReceiver(conn, layout, **header['ring'])
+
+    raise protocol.ProtocolError("Unknown transport '%s'" % transport)
+
+
+class PipeSender(object):
+    def __init__(self, conn, layout):
+        self.conn = conn
+        self.layout = layout
+        self.header = {'transport': 'pipe'}
+
+
+    def send(self, records):
+        protocol.send_records(self.conn, records)
+
+
+    def end(self):
+        protocol.send_end(self.conn)
+
+
+class Batcher(object):
+    """ Collects records into a contiguous block and passes it to sender
+    when it has max_steps records or when max_ms milliseconds have passed
+    since the previous block was sent, whichever comes first.  A record
+    that arrives after max_ms since the previous block is thus sent at
+    once: when timesteps are slower than max_ms, every record goes out as
+    soon as it is produced. """
+
+    def __init__(self, sender, max_steps=BATCH_STEPS, max_ms=BATCH_MS):
+        self.sender = sender
+        self.layout = sender.layout
+        self.header = sender.header
+        self.max_seconds = max_ms / 1000.
+        self.block = sender.layout.empty(max_steps)
+        self.n = 0
+        self.last_flush = time.time()
+
+
+    def send(self, records):
+        if records.ndim == 1:
+            records = records[np.newaxis, :]
+
+        start = 0
+        while start < len(records):
+            m = min(len(records) - start, len(self.block) - self.n)
+            self.block[self.n:self.n + m] = records[start:start + m]
+            self.n += m
+            start += m
+
+            if (self.n == len(self.block)
+                or time.time() - self.last_flush >= self.max_seconds):
+                self.flush()
+
+
+    def flush(self):
+        if self.n > 0:
+            self.sender.send(self.block[:self.n])
+            self.n = 0
+        self.last_flush = time.time()
+
+
+    def end(self):
+        self.flush()
+        self.sender.end()
+
+
+class PipeReceiver(object):
+    def __init__(self, conn, layout):
+        self.conn = conn
+        self.layout = layout
+
+
+    def poll(self, timeout=0):
+        return self.conn.poll(timeout)
+
+
+    def receive(self):
+        return protocol.receive(self.conn, self.layout)
+
+
+    def __iter__(self):
+        while True:
+            records = self.receive()
+            if records is None:
+                return
+            yield records
+
+
+def _shm_dir():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+def _map_ring(path, capacity, width):
+    # Plain arrays on an mmap are cheaper to index than np.memmap.
+    with open(path, 'r+b') as fp:
+        buf = mmap.mmap(fp.fileno(), RING_OFFSET + capacity * width * 8)
+    counts = np.frombuffer(buf, dtype='i8', count=2)
+    ring = np.frombuffer(buf, dtype='d', offset=RING_OFFSET,
+                         count=capacity * width).reshape((capacity, width))
+    return counts, ring
+
+
+class RingSender(object):
+    def __init__(self, conn, layout, ring_bytes=RING_BYTES):
+        self.conn = conn
+        self.layout = layout
+        self.capacity = capacity = max(2, ring_bytes // (8 * layout.width))
+
+        fd, self.path = tempfile.mkstemp(prefix='qtplaskin-', suffix='.ring',
+                                         dir=_shm_dir())
+        os.ftruncate(fd, RING_OFFSET + capacity * layout.width * 8)
+        os.close(fd)
+
+        self.counts, self.ring = _map_ring(self.path, capacity, layout.width)
+        self.written = 0
+        self.notified = 0
+        self.header = {'transport': 'shm',
+                       'ring': {'path': self.path, 'capacity': capacity}}
+
+
+    def send(self, records):
+        if records.ndim == 1:
+            records = records[np.newaxis, :]
+
+        start = 0
+        while start < len(records):
+            read = int(self.counts[READ])
+            free = self.capacity - (self.written - read)
+            if free == 0:
+                self._notify()
+                time.sleep(RING_WAIT)
+                continue
+
+            # We write only up to the end of the ring and wrap around in the
+            # next pass.
+            pos = self.written % self.capacity
+            n = min(free, len(records) - start, self.capacity - pos)
+            self.ring[pos:pos + n] = records[start:start + n]
+            start += n
+            self.written += n
+            self.counts[WRITTEN] = self.written
+
+            # If the receiver has not yet reached the previous notification
+            # it will find these records when it does.
+            if read >= self.notified:
+                self._notify()
+
+
+    def _notify(self):
+        if self.written > self.notified:
+            self.conn.send_bytes(b'\0')
+            self.notified = self.written
+
+
+    def end(self):
+        self._notify()
+        protocol.send_end(self.conn)
+
+
+class RingReceiver(PipeReceiver):
+    """ Receives records from a RingSender.  The blocks returned by receive
+    are views of the ring, valid until the next call. """
+
+    def __init__(self, conn, layout, path, capacity):
+        super(RingReceiver, self).__init__(conn, layout)
+        self.capacity = capacity
+        self.counts, self.ring = _map_ring(path, capacity, layout.width)
+        # Our mappings keep the memory while we need it.
+        os.remove(path)
+        self.read = 0
+
+
+    def poll(self, timeout=0):
+        return (int(self.counts[WRITTEN]) > self.read
+                or self.conn.poll(timeout))
+
+
+    def receive(self):
+        # The sender can now reuse the slots of the previous block.
+        self.counts[READ] = self.read
+
+        # Notifications only wake us up: the count of records is in the
+        # ring and we may have already read the ones they announce.
+        while int(self.counts[WRITTEN]) == self.read:
+            try:
+                buf = self.conn.recv_bytes()
+            except EOFError:
+                return None
+
+            if not buf:
+                return None
+
+        # Up to the end of the ring; the rest comes in the next call.
+        pos = self.read % self.capacity
+        n = min(int(self.counts[WRITTEN]) - self.read, self.capacity - pos)
+        self.read += n
+        return self.ring[pos:pos + n]
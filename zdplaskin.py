@@ -5,10 +5,31 @@ from warnings import warn
 
 from numpy import *
 
+# Scalar conditions in the order in which zdplaskin_get_conditions returns
+# them.  It then returns the EEDF.
+CONDITIONS = ['gas_temperature',
+              'reduced_frequency',
+              'reduced_field',
+              'elec_temperature',
+              'elec_drift_velocity',
+              'elec_diff_coeff',
+              'elec_frequency_n',
+              'elec_power_n',
+              'elec_power_elastic_n',
+              'elec_power_inelastic_n']
+
+
 class Kinetics(object):
     DEFAULT_FIXED_DENS = {'N2': True,
                           'O2': True}
 
+    # Defaults of the adaptive substepping (see set_substepping).
+    MAX_CHANGE = 0.05
+    MIN_SUBSTEP = 1e-15
+    MAX_GROWTH = 2.0
+    MAX_SHRINK = 0.2
+    DENSITY_FLOOR = 1.0
+
     def __init__(self, kinetics_name):
         """ Loads a kinetic module. """
         self.mod = __import__(kinetics_name).zdplaskin
@@ -16,7 +37,7 @@ class Kinetics(object):
         self.init = self.mod.zdplaskin_init
         self.set_conditions_ = self.mod.zdplaskin_set_conditions
         self.get_conditions_ = self.mod.zdplaskin_get_conditions
-        self.set_density = self.mod.zdplaskin_set_density
+        self.set_density_ = self.mod.zdplaskin_set_density
         self.get_density_ = self.mod.zdplaskin_get_density
         self.get_density_total_ = self.mod.zdplaskin_get_density_total
         self.timestep = self.mod.zdplaskin_timestep
@@ -25,9 +46,13 @@ class Kinetics(object):
         self.write_file = self.mod.zdplaskin_write_file
         self.get_rates = self.mod.zdplaskin_get_rates
         self.reac_source_matrix = self.mod.zdplaskin_reac_source_matrix
+        self.fex = self.mod.zdplaskin_fex
 
-        self.SPECIES = self.species()
-        self.REACTIONS = self.reactions()
+        # Decoding the names from the fortran arrays is slow, so we do it
+        # only once.
+        self.SPECIES = _decode(self.mod.species_name, self.mod.species_max)
+        self.REACTIONS = _decode(self.mod.reaction_sign,
+                                 self.mod.reactions_max)
 
         self.N_SPECIES = len(self.SPECIES)
         self.N_REACTIONS = len(self.REACTIONS)
@@ -35,22 +60,33 @@ class Kinetics(object):
         # This uses the python/c convention, starting with index 1
         self.REACTION_INDEX = dict((r, i) for i, r in enumerate(self.REACTIONS))
         self.SPECIES_INDEX = dict((s, i) for i, s in enumerate(self.SPECIES))
+
+        # Species whose density may be held fixed (see set_density).
+        # zdplaskin_init releases them all.
+        self.fixed = zeros((self.N_SPECIES,), dtype=bool)
         self.conditions = {
             'spec_heat_ratio': 1.4,
             'gas_heating': False,
             'soft_reset': False}
         self.conditions_set = False
-        
+
+        self.set_substepping()
+        self.substep = None
+        self.substep_counts = (0, 0)
+
+        # Buffers returned by snapshot()
+        self._density = empty((self.N_SPECIES,))
+        self._rates = empty((self.N_REACTIONS,))
+        self._conditions = empty((len(CONDITIONS),))
+
     def species(self):
         """ Returns a list of all species in the kinetic module. """
-        return [''.join(self.mod.species_name[:, i]).strip() 
-                for i in xrange(self.mod.species_max)]
+        return self.SPECIES
 
 
     def reactions(self):
         """ Returns a list of all reactions in the module. """
-        return [''.join(self.mod.reaction_sign[:, i]).strip() 
-                for i in xrange(self.mod.reactions_max)]
+        return self.REACTIONS
 
 
 
@@ -59,12 +95,33 @@ class Kinetics(object):
         return self.get_density_(s)[0]
 
 
+    def set_density(self, s, dens, const=None):
+        """ Sets the density of species s and, unless const is None, whether
+        it is held fixed. """
+        if const is None:
+            self.set_density_(s, dens)
+        else:
+            self.set_density_(s, dens, const)
+            self.fixed[self.SPECIES_INDEX[s]] = const
+
+
     def get_reaction_rates(self):
         """ Returns a list of all rates. """
         _, rates, _, _, _, _, _ = self.get_rates()
         return rates
 
 
+    def block_reactions(self, indices):
+        """ Disables the reactions with the given (0-based) indices, or
+        signatures, and enables all the others. """
+        block = self.mod.lreaction_block
+        block[:] = False
+        for r in indices:
+            if isinstance(r, basestring):
+                r = self.REACTION_INDEX[r]
+            block[r] = True
+
+
     def get_rates_list(self, lreact):
         """ Returns a list of selected rates. lreact is a list
         of reaction signatures. """
@@ -75,22 +132,38 @@ class Kinetics(object):
 
     def get_conditions(self):
         """ Returns a dictionary with the zdplaskin conditions.  """
+        data = self.get_conditions_()
+        d = dict(zip(CONDITIONS + ['elec_eedf'], data))
+        return d
 
-        conds = ['gas_temperature',
-                 'reduced_frequency',
-                 'reduced_field',
-                 'elec_temperature',
-                 'elec_drift_velocity',
-                 'elec_diff_coeff',
-                 'elec_frequency_n',
-                 'elec_power_n',
-                 'elec_power_elastic_n',
-                 'elec_power_inelastic_n',
-                 'elec_eedf']
+
+    def snapshot(self, t, conditions=CONDITIONS, out=None):
+        """ Returns arrays with all the densities, all the reaction rates and
+        the conditions named in conditions at time t, read in bulk from the
+        module.  The arrays are filled in place: out can give them (e.g. as
+        views of a record); otherwise they belong to this object and are
+        overwritten by the next call. """
+        if out is None:
+            out = (self._density, self._rates,
+                   self._conditions[:len(conditions)])
+        density, rates, conds = out
+
+        density[:] = self.mod.density
+
+        if self.conditions.get('gas_heating'):
+            # The temperature is then one more unknown of the solver.
+            rates[:] = self.get_reaction_rates()
+        else:
+            # zdplaskin_get_rates would also build the source matrices; we
+            # only need the right-hand side to update rrt.
+            self.fex(t, self.mod.density)
+            rates[:] = self.mod.rrt
 
         data = self.get_conditions_()
-        d = dict(zip(conds, data))
-        return d
+        for i, name in enumerate(conditions):
+            conds[i] = data[CONDITIONS.index(name)]
+
+        return density, rates, conds
 
     def set_conditions(self, **kwargs):
         """ Sets conditions for zdplaskin. """
@@ -145,11 +218,15 @@ class Kinetics(object):
         
     def truncate_densities(self, epsilon=1e-10):
         """ Checks that densities are not too small.  If they are smaller than
-        epsilon, they are set to epsilon.  """
-        for s in self.species():
-            dens = self.get_density(s)
-            if dens < epsilon:
-                self.set_density(s, 0.0, False)
+        epsilon, they are set to 0 and no longer held fixed.  The whole array
+        of densities of the module is truncated in place.  """
+        density = self.mod.density
+        low = density < epsilon
+        density[low] = 0.0
+
+        # Only zdplaskin_set_density can release a fixed density.
+        for i in flatnonzero(low & self.fixed):
+            self.set_density(self.SPECIES[i], 0.0, False)
 
 
     def print_densities(self):
@@ -182,19 +259,119 @@ class Kinetics(object):
             print "%20s = %g cm^-3" % ('[%s]' % s, self.get_density(s))
 
 
+    def set_substepping(self, adaptive=False, max_change=MAX_CHANGE,
+                        min_dt=MIN_SUBSTEP, max_growth=MAX_GROWTH,
+                        max_shrink=MAX_SHRINK, density_floor=DENSITY_FLOOR):
+        """ Configures how controlled_timestep divides its steps.  If
+        adaptive, each substep aims at changing no density by a relative
+        amount above max_change; densities below density_floor count as
+        density_floor.  From one substep to the next the substep grows at
+        most by max_growth and shrinks at least to max_shrink times its
+        size, and is never below min_dt.  Otherwise, as by default, steps
+        are split into equal substeps no larger than max_dt. """
+        self.adaptive = adaptive
+        self.max_change = max_change
+        self.min_dt = min_dt
+        self.max_growth = max_growth
+        self.max_shrink = max_shrink
+        self.density_floor = density_floor
+
+
     def controlled_timestep(self, t, attempt_dt, max_dt):
-        """ Attempts a timestep attempt_dt but only performs it if it smaller
-        that max_dt.  In other case, divides attempt_dt into pieces smaller
-        than max_dt and performs many timesteps.  """
-        
-        if attempt_dt < max_dt:
+        """ Performs a timestep attempt_dt in substeps no larger than max_dt.
+        Returns the number of accepted and rejected substeps, which are also
+        kept in substep_counts.  """
+        if self.adaptive:
+            counts = self._adaptive_timestep(t, attempt_dt, max_dt)
+        elif attempt_dt < max_dt:
             self.timestep(t, attempt_dt)
+            counts = (1, 0)
         else:
             nsteps = int(attempt_dt / max_dt) + 1
-            realized_dt = max_dt / nsteps
+            realized_dt = attempt_dt / nsteps
 
             for i in xrange(nsteps):
-                self.timestep(t, realized_dt)
+                self.timestep(t + i * realized_dt, realized_dt)
+            counts = (nsteps, 0)
+
+        self.substep_counts = counts
+        return counts
+
+
+    def _adaptive_timestep(self, t, attempt_dt, max_dt):
+        """ Covers attempt_dt with substeps sized from the relative change
+        of the densities in the previous ones.  A substep that changes the
+        densities too much is undone and retried with a smaller one.  The
+        last substep size is kept for the next call. """
+        density = self.mod.density
+        end = t + attempt_dt
+        h = min(self.substep or attempt_dt, max_dt)
+        accepted = rejected = 0
+
+        while t < end:
+            last = end - t <= h
+            dt = end - t if last else h
+
+            before = density.copy()
+            self.timestep(t, dt)
+            change = amax(abs(density - before)
+                          / maximum(before, self.density_floor))
+
+            if change > 0:
+                factor = 0.9 * self.max_change / change
+                factor = min(max(factor, self.max_shrink), self.max_growth)
+            else:
+                factor = self.max_growth
+
+            if change > self.max_change and dt > self.min_dt:
+                density[:] = before
+                self._reset_solver()
+                h = max(dt * factor, self.min_dt)
+                rejected += 1
+                continue
+
+            accepted += 1
+            t = end if last else t + dt
+
+            # A short last substep says nothing about the ones to come
+            # unless it had to be made even shorter.
+            if not last or dt * factor < h:
+                h = min(max(dt * factor, self.min_dt), max_dt)
+
+        self.substep = h
+        return accepted, rejected
+
+
+    def _reset_solver(self):
+        """ Makes the solver start afresh from the present densities. """
+        self.set_conditions(soft_reset=True)
+        self.conditions['soft_reset'] = False
+
+
+    def state(self):
+        """ Returns a dictionary of arrays with what is needed to continue
+        the simulation from its present point (see restore). """
+        conditions = self.get_conditions()
+        return {'density': self.mod.density.copy(),
+                'conditions': array([conditions[k] for k in CONDITIONS]),
+                'substep': self.substep or 0.0}
+
+
+    def restore(self, state):
+        """ Continues from a state returned by state().  The densities that
+        are held fixed must have been set as in the original run. """
+        self.mod.density[:] = state['density']
+        conditions = dict(zip(CONDITIONS, state['conditions']))
+        self.set_conditions(**dict((k, conditions[k]) for k in
+                                   ('gas_temperature', 'reduced_field',
+                                    'reduced_frequency')))
+        self._reset_solver()
+        self.substep = float(state['substep']) or None
+
+
+def _decode(names, n):
+    """ Decodes the fortran array of n names, one per column. """
+    return [''.join(names[:, i]).strip() for i in xrange(n)]
 
 
 def parse_densities(fname, allowed=None):